@@ -0,0 +1,112 @@
+"""Time of the gold flow's transform_dataframe against the old row-wise version
+
+Run from the repository root:
+
+    python -m benchmarks.bench_gold_transform --rows 100000
+
+row_wise_transform is the transform before it was vectorised, kept as the
+reference the regression test in tests/test_late_subway_gold.py compares
+with.
+"""
+
+from datetime import time
+import argparse
+import timeit
+import numpy as np
+import pandas as pd
+from late_subway_gold import transform_dataframe
+
+COLUMNS = ("arrival_time", "arrival_time_fixed", "timestamp", "late _", "late by")
+
+
+def row_wise_transform(
+    dataframe: pd.DataFrame,
+    column1: str,
+    column2: str,
+    column3: str,
+    column4: str,
+    column5: str,
+) -> pd.DataFrame:
+    dataframe[column1] = dataframe[column1].apply(lambda x: x.strftime("%H:%M %p"))
+
+    dataframe[column2] = dataframe[column2].dt.tz_convert("US/Eastern")
+
+    dataframe[column3] = dataframe[column3].dt.tz_convert("US/Eastern")
+
+    dataframe[column4] = dataframe[column3] - dataframe[column2]
+
+    dataframe[column4] = (
+        dataframe[column4]
+        .dt.total_seconds()
+        .apply(lambda s: f"{(s % 3600) // 60:02.0f}:{s % 60:02.0f}")
+    )
+
+    dataframe[column5] = dataframe[column4].astype(str)
+
+    dataframe[column5] = (
+        dataframe[column5].str[:2]
+        + " minutes and "
+        + dataframe[column5].str[3:]
+        + " seconds"
+    )
+
+    return dataframe
+
+
+def late_subways_frame(rows: int, seed: int = 0) -> pd.DataFrame:
+    """Scheduled times and vehicle timestamps up to two hours apart
+
+    Differences include fractions of a second and halves, which the old
+    formatting rounded half to even.
+    """
+
+    rng = np.random.default_rng(seed)
+
+    scheduled = rng.integers(0, 86400, rows)
+    arrival_time_fixed = pd.Timestamp("2023-08-07", tz="UTC") + pd.to_timedelta(
+        rng.integers(0, 86400, rows), unit="s"
+    )
+    late = rng.integers(-7200, 7200, rows) + rng.choice([0, 0.25, 0.5, 0.999], rows)
+
+    return pd.DataFrame(
+        {
+            "arrival_time": [
+                time(second // 3600, second // 60 % 60, second % 60)
+                for second in scheduled.tolist()
+            ],
+            "arrival_time_fixed": arrival_time_fixed,
+            "timestamp": arrival_time_fixed + pd.to_timedelta(late, unit="s"),
+        }
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    late_subways = late_subways_frame(args.rows)
+
+    pd.testing.assert_frame_equal(
+        row_wise_transform(late_subways.copy(), *COLUMNS),
+        transform_dataframe.fn(late_subways.copy(), *COLUMNS),
+    )
+
+    print(f"{'transform':12}{'rows':>10}{'best s':>9}")
+    for name, transform in [
+        ("row-wise", row_wise_transform),
+        ("vectorised", transform_dataframe.fn),
+    ]:
+        best = min(
+            timeit.repeat(
+                lambda: transform(late_subways.copy(), *COLUMNS),
+                repeat=args.repeat,
+                number=1,
+            )
+        )
+        print(f"{name:12}{args.rows:>10}{best:>9.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""Live/schedule join: ScheduleIndex.lookup against the old pandas merge
+
+Run from the repository root:
+
+    python -m benchmarks.bench_schedule_index
+
+"merge" is the old combine_live_trips_with_schedule. It merges the whole
+day's schedule with the vehicles on trip_id/direction_id/route_id, so every
+stop of every matched trip comes back. "lookup" finds each vehicle's
+scheduled stop in the index and returns one row per vehicle. Building the
+index happens once per service day and is reported separately.
+"""
+
+from datetime import datetime
+from pathlib import Path
+import argparse
+import tempfile
+import timeit
+import numpy as np
+import pandas as pd
+from compact_schedule import SCHEDULE_TABLES, CompactSchedule
+from route_selection import SUBWAY
+from schedule import (
+    add_stops_stoptimes_schedule,
+    schedule_feed,
+    schedule_service_days,
+    selected_shapes,
+    selected_stops,
+    service_calendar_index,
+    stop_stop_times,
+    stop_times_file,
+)
+from schedule_index import ScheduleIndex
+from storage_format import StorageFormat, read_table
+from subway_locations_schedules import tz
+from benchmarks.synthetic_feed import write_feed
+
+
+def todays_schedule(work_dir: Path, subway_trips: int) -> CompactSchedule:
+    """Build today's service day schedule of a synthetic feed"""
+
+    feed_path = write_feed(
+        work_dir / "feed.zip", subway_trips=subway_trips, bus_trips=0
+    )
+    storage = StorageFormat()
+    paths = {
+        name: work_dir / f"{name}{storage.suffix}"
+        for name in ["trips", "stops", "stop_times", "shapes"]
+    }
+
+    trips = add_stops_stoptimes_schedule.fn(
+        *schedule_feed.fn(feed_path), route_selection=SUBWAY
+    )
+    storage.write(trips, paths["trips"])
+    selected_stops.fn(feed_path, paths["stops"], SUBWAY)
+    stop_times_file.fn(feed_path, paths["trips"], paths["stops"], paths["stop_times"])
+    selected_shapes.fn(feed_path, paths["trips"], paths["shapes"])
+    service_calendar_index.fn(feed_path, work_dir / "calendar.npz")
+
+    schedule_service_days.fn(
+        stop_stop_times.fn(paths["trips"], paths["stop_times"], paths["stops"]),
+        service_calendar_path=work_dir / "calendar.npz",
+        shapes_path=paths["shapes"],
+        current_trips_filename="schedule_today",
+        schedule_dir=work_dir / "current_schedule",
+        days_ahead=1,
+        storage_format=storage.spec,
+    )
+
+    partition_dir = next((work_dir / "current_schedule").iterdir()) / "schedule_today"
+
+    return CompactSchedule(
+        **{
+            name: read_table(partition_dir / f"{name}{storage.suffix}")
+            for name in SCHEDULE_TABLES
+        }
+    )
+
+
+def live_locations(schedule: CompactSchedule, vehicles: int, seed: int = 0):
+    """One vehicle at a scheduled stop of each of a sample of today's trips"""
+
+    rng = np.random.default_rng(seed)
+    trips = rng.choice(schedule.trips.num_rows, vehicles, replace=False)
+    trip_rows = schedule.stop_times["trip_idx"].to_numpy()
+    rows = np.array([rng.choice(np.flatnonzero(trip_rows == trip)) for trip in trips])
+
+    stops = schedule.frame(rows)
+
+    return pd.DataFrame(
+        {
+            "id": [f"y{vehicle}" for vehicle in range(vehicles)],
+            "trip_id": stops["trip_id"],
+            "live_route_id": stops["route_id"],
+            "direction_id": stops["direction_id"],
+            "live_start_date": pd.to_datetime(stops["service_date"]),
+            "stop_id": stops["stop_id"],
+            "current_stop": stops["stop_sequence"],
+            "latitude": stops["stop_lat"],
+            "longitude": stops["stop_lon"],
+            "vehicle": [f"G-{vehicle}" for vehicle in range(vehicles)],
+        }
+    )
+
+
+def merge(trips_today: pd.DataFrame, live: pd.DataFrame) -> pd.DataFrame:
+    compare = trips_today.merge(
+        live,
+        left_on=["trip_id", "direction_id", "route_id"],
+        right_on=["trip_id", "direction_id", "live_route_id"],
+    )
+
+    return compare[
+        compare["live_start_date"].isna()
+        | (pd.to_datetime(compare["service_date"]) == compare["live_start_date"])
+    ]
+
+
+def best_ms(function, repeat: int) -> float:
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--subway-trips", type=int, default=4000)
+    parser.add_argument("--vehicles", type=int, nargs="+", default=[50, 150, 500, 1000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        schedule = todays_schedule(Path(tmp_dir), args.subway_trips)
+
+    service_date = datetime.now(tz).strftime("%Y%m%d")
+    trips_today = schedule.frame(np.arange(schedule.stop_times.num_rows))
+    build_ms = best_ms(lambda: ScheduleIndex(schedule), 1)
+    index = ScheduleIndex(schedule)
+
+    print(
+        f"{schedule.stop_times.num_rows} scheduled stops today,"
+        f" index built in {build_ms:.0f} ms"
+    )
+    print(
+        f"{'vehicles':>8}{'merge rows':>12}{'merge ms':>10}{'lookup rows':>13}", end=""
+    )
+    print(f"{'lookup ms':>11}")
+
+    for vehicles in args.vehicles:
+        live = live_locations(schedule, vehicles)
+        merged = merge(trips_today, live)
+        looked_up = index.lookup(live, service_date)
+
+        print(
+            f"{vehicles:>8}{len(merged):>12}"
+            f"{best_ms(lambda: merge(trips_today, live), args.repeat):>10.2f}"
+            f"{len(looked_up):>13}"
+            f"{best_ms(lambda: index.lookup(live, service_date), args.repeat):>11.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
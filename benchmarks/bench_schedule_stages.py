@@ -0,0 +1,147 @@
+"""Wall time of each stage of the schedules flow
+
+Run from the repository root:
+
+    python -m benchmarks.bench_schedule_stages --repeat 3
+
+Every stage runs on a synthetic feed in the order the flow runs it. The best
+of --repeat runs is reported, along with the rows each stage returns or
+writes.
+"""
+
+from pathlib import Path
+import argparse
+import tempfile
+import time
+from route_selection import SUBWAY
+from schedule import (
+    add_stops_stoptimes_schedule,
+    schedule_feed,
+    schedule_service_days,
+    selected_shapes,
+    selected_stops,
+    service_calendar_index,
+    stop_stop_times,
+    stop_times_file,
+)
+from storage_format import StorageFormat, read_table
+from benchmarks.synthetic_feed import write_feed
+
+
+def best_of(repeat: int, stage, *args, **kwargs):
+    """Run a stage repeat times, returning its last result and best time"""
+
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = stage(*args, **kwargs)
+        seconds.append(time.perf_counter() - start)
+
+    return result, min(seconds)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--subway-trips", type=int, default=4000)
+    parser.add_argument("--bus-trips", type=int, default=40000)
+    parser.add_argument("--days-ahead", type=int, default=7)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = Path(tmp_dir)
+        feed_path = write_feed(
+            work_dir / "feed.zip",
+            subway_trips=args.subway_trips,
+            bus_trips=args.bus_trips,
+        )
+        storage = StorageFormat()
+        trips_path = work_dir / f"trips{storage.suffix}"
+        stops_path = work_dir / f"stops{storage.suffix}"
+        stop_times_path = work_dir / f"stop_times{storage.suffix}"
+        shapes_path = work_dir / f"shapes{storage.suffix}"
+        calendar_path = work_dir / "service_calendar.npz"
+
+        timings = []
+
+        def run(name, stage, *stage_args, rows=None, **stage_kwargs):
+            result, seconds = best_of(args.repeat, stage, *stage_args, **stage_kwargs)
+            timings.append((name, seconds, rows(result) if rows else len(result)))
+            return result
+
+        tables = run(
+            "schedule_feed",
+            schedule_feed.fn,
+            feed_path,
+            rows=lambda tables: len(tables[2]),
+        )
+        trips = run(
+            "add_stops_stoptimes_schedule",
+            add_stops_stoptimes_schedule.fn,
+            *tables,
+            route_selection=SUBWAY,
+        )
+        storage.write(trips, trips_path)
+
+        run(
+            "selected_stops",
+            selected_stops.fn,
+            feed_path,
+            stops_path,
+            SUBWAY,
+            rows=lambda _: read_table(stops_path).num_rows,
+        )
+        run(
+            "stop_times_file",
+            stop_times_file.fn,
+            feed_path,
+            trips_routes_dates_path=trips_path,
+            stops_path=stops_path,
+            to_path=stop_times_path,
+            rows=lambda _: read_table(stop_times_path).num_rows,
+        )
+        run(
+            "selected_shapes",
+            selected_shapes.fn,
+            feed_path,
+            trips_routes_dates_path=trips_path,
+            to_path=shapes_path,
+            rows=lambda _: read_table(shapes_path).num_rows,
+        )
+        run(
+            "service_calendar_index",
+            service_calendar_index.fn,
+            feed_path,
+            calendar_path,
+            rows=lambda _: len(tables[3]),
+        )
+        trips_stops = run(
+            "stop_stop_times",
+            stop_stop_times.fn,
+            trips_path,
+            stop_times_path,
+            stops_path,
+        )
+        run(
+            "schedule_service_days",
+            schedule_service_days.fn,
+            trips_stops,
+            service_calendar_path=calendar_path,
+            shapes_path=shapes_path,
+            current_trips_filename="schedule_today",
+            schedule_dir=work_dir / "current_schedule",
+            days_ahead=args.days_ahead,
+            storage_format=storage.spec,
+            rows=lambda paths: sum(
+                read_table(path).num_rows for path in paths if "stop_times" in path.name
+            ),
+        )
+
+    print(f"{'stage':32}{'best ms':>10}{'rows':>10}")
+    for name, seconds, rows in timings:
+        print(f"{name:32}{seconds * 1000:>10.1f}{rows:>10}")
+    print(f"{'total':32}{sum(seconds for _, seconds, _ in timings) * 1000:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""Peak memory of joining the subway stop times, before and after the pushdown
+
+Run from the repository root:
+
+    python -m benchmarks.bench_stop_times_memory --bus-trips 40000
+
+"eager" is the old path: stop_times.txt and stops.txt are read whole and only
+then joined against the subway trips and RapidTransit stops. "pushdown" runs
+stop_times_file and stop_stop_times, which filter while decoding. Each mode
+runs in a fresh process, and its peak RSS is measured from the point the
+modules are imported (Linux only, through /proc/self/clear_refs).
+"""
+
+from pathlib import Path
+from zipfile import ZipFile
+import argparse
+import subprocess
+import sys
+import tempfile
+import time
+import polars as pl
+from gtfs_loader import decode_ids, load_members
+from route_selection import SUBWAY
+from schedule import selected_stops, stop_stop_times, stop_times_file
+from storage_format import StorageFormat
+from benchmarks.synthetic_feed import write_feed
+
+MODES = ("eager", "pushdown")
+
+
+def reset_peak_rss() -> float:
+    """Reset the peak RSS to the current RSS, returning the current RSS in MB"""
+
+    # Writing 5 to clear_refs resets VmHWM on Linux
+    with open("/proc/self/clear_refs", "w") as clear_refs:
+        clear_refs.write("5")
+
+    return proc_status_mb("VmRSS")
+
+
+def peak_rss_mb() -> float:
+    return proc_status_mb("VmHWM")
+
+
+def proc_status_mb(field: str) -> float:
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith(f"{field}:"):
+                return int(line.split()[1]) / 1024
+
+    raise KeyError(field)
+
+
+def prepare(feed_path: Path, work_dir: Path) -> None:
+    """Write the selected trips and stops both modes join against"""
+
+    agency, routes, trips = (
+        pl.from_arrow(decode_ids(table))
+        for table in load_members(
+            feed_path, ["agency.txt", "routes.txt", "trips.txt"]
+        ).values()
+    )
+    trips = trips.join(SUBWAY.select_routes(agency, routes), on="route_id")
+
+    storage = StorageFormat()
+    storage.write(trips, work_dir / "trips.parquet")
+    selected_stops.fn(feed_path, work_dir / "stops.parquet", SUBWAY)
+
+
+def eager(feed_path: Path, work_dir: Path) -> pl.DataFrame:
+    # The members are read whole before anything is filtered
+    with ZipFile(feed_path) as myzip:
+        stop_times = pl.read_csv(
+            myzip.read("stop_times.txt"), dtypes={"trip_id": str, "stop_id": str}
+        )
+        stops = pl.read_csv(myzip.read("stops.txt"), dtypes={"stop_id": str})
+
+    stops = stops.filter(pl.col("zone_id") == "RapidTransit")
+    trips = pl.read_parquet(work_dir / "trips.parquet")
+
+    return trips.join(stop_times, on="trip_id").join(stops, on="stop_id")
+
+
+def pushdown(feed_path: Path, work_dir: Path) -> pl.DataFrame:
+    stop_times_file.fn(
+        feed_path,
+        trips_routes_dates_path=work_dir / "trips.parquet",
+        stops_path=work_dir / "stops.parquet",
+        to_path=work_dir / "stop_times.parquet",
+    )
+
+    return stop_stop_times.fn(
+        work_dir / "trips.parquet",
+        work_dir / "stop_times.parquet",
+        work_dir / "stops.parquet",
+    )
+
+
+def run_mode(mode: str, feed_path: Path, work_dir: Path) -> None:
+    """Run one mode in this process and print its timings and memory"""
+
+    imported_mb = reset_peak_rss()
+
+    start = time.perf_counter()
+    rows = len(globals()[mode](feed_path, work_dir))
+    seconds = time.perf_counter() - start
+
+    peak_mb = peak_rss_mb()
+    print(
+        f"{mode:10}{rows:>10}{seconds:>9.2f}{peak_mb:>11.0f}"
+        f"{peak_mb - imported_mb:>12.0f}"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--subway-trips", type=int, default=4000)
+    parser.add_argument("--bus-trips", type=int, default=40000)
+    parser.add_argument("--mode", choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument("--work-dir", type=Path, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode is not None:
+        run_mode(args.mode, args.work_dir / "feed.zip", args.work_dir)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = Path(tmp_dir)
+        feed_path = write_feed(
+            work_dir / "feed.zip",
+            subway_trips=args.subway_trips,
+            bus_trips=args.bus_trips,
+        )
+        prepare(feed_path, work_dir)
+
+        print(f"{'mode':10}{'rows':>10}{'time s':>9}{'peak MB':>11}{'above start':>12}")
+        for mode in MODES:
+            subprocess.run(
+                [
+                    sys.executable,
+                    "-m",
+                    "benchmarks.bench_stop_times_memory",
+                    "--mode",
+                    mode,
+                    "--work-dir",
+                    str(work_dir),
+                ],
+                check=True,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Encode and decode time and size of each storage format and row group size
+
+Run from the repository root:
+
+    python -m benchmarks.bench_storage_format --rows 1000000
+
+A schedule-like table is written with every codec StorageFormat supports,
+sorted on route_id/trip_id as the writers do. Reads include the conversion
+to pandas. The last column is the rows a reader of route_id == "Red" has to
+decode once row groups are pruned on their statistics, Feather has no
+statistics and always reads everything.
+"""
+
+from pathlib import Path
+import argparse
+import tempfile
+import time
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+from storage_format import CODECS, StorageFormat, read_table
+from benchmarks.synthetic_feed import SUBWAY_ROUTES
+
+
+def schedule_table(rows: int, seed: int = 0) -> pa.Table:
+    rng = np.random.default_rng(seed)
+
+    def ids(prefix: str, count: int) -> np.ndarray:
+        return np.char.add(prefix, np.arange(count).astype(str))[
+            rng.integers(0, count, rows)
+        ]
+
+    return pa.table(
+        {
+            "route_id": np.array(SUBWAY_ROUTES)[
+                rng.integers(0, len(SUBWAY_ROUTES), rows)
+            ],
+            "trip_id": ids("T", 20000),
+            "service_id": np.array(["WK", "SA", "SU"])[rng.integers(0, 3, rows)],
+            "trip_headsign": np.array(["Alewife", "Ashmont", "Braintree", "Oak Grove"])[
+                rng.integers(0, 4, rows)
+            ],
+            "stop_id": ids("70", 300),
+            "stop_sequence": rng.integers(1, 40, rows, dtype=np.int32),
+            "arrival_s": rng.integers(5 * 3600, 26 * 3600, rows, dtype=np.int32),
+            "departure_s": rng.integers(5 * 3600, 26 * 3600, rows, dtype=np.int32),
+            "stop_lat": rng.normal(42.35, 0.05, rows),
+            "stop_lon": rng.normal(-71.06, 0.05, rows),
+        }
+    )
+
+
+def rows_read(path: Path, storage: StorageFormat, rows: int) -> int:
+    """Rows in the row groups whose statistics allow route_id Red"""
+
+    if storage.container != "parquet":
+        return rows
+
+    (fragment,) = ds.dataset(path).get_fragments()
+
+    return sum(
+        row_group.row_groups[0].num_rows
+        for row_group in fragment.split_by_row_group(ds.field("route_id") == "Red")
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument(
+        "--row-group-sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000]
+    )
+    args = parser.parse_args()
+
+    table = schedule_table(args.rows)
+
+    print(
+        f"{'format':24}{'rows/group':>11}{'write s':>9}{'read s':>8}{'MB':>8}"
+        f"{'Red rows':>10}"
+    )
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for container, codecs in CODECS.items():
+            for codec in codecs:
+                for row_group_size in args.row_group_sizes:
+                    storage = StorageFormat(container, codec, row_group_size)
+                    path = Path(tmp_dir) / f"bench{storage.suffix}"
+
+                    start = time.perf_counter()
+                    storage.write(table, path)
+                    write_s = time.perf_counter() - start
+
+                    start = time.perf_counter()
+                    read_table(path).to_pandas()
+                    read_s = time.perf_counter() - start
+
+                    print(
+                        f"{storage.spec:24}{row_group_size:>11}{write_s:>9.2f}"
+                        f"{read_s:>8.2f}{path.stat().st_size / 1e6:>8.1f}"
+                        f"{rows_read(path, storage, args.rows):>10}"
+                    )
+                    path.unlink()
+
+
+if __name__ == "__main__":
+    main()
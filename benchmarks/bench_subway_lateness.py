@@ -0,0 +1,128 @@
+"""Time of calculate_subway_lateness against the old pandas version
+
+Run from the repository root:
+
+    python -m benchmarks.bench_subway_lateness --stops 20
+
+The subway vehicles of each recorded VehiclePositions fixture are moved to
+the current time and given --stops scheduled stops each, the rows the old
+schedule merge returned. The schedule has them between 10 minutes early and
+20 minutes late. "pandas" is the old calculate_subway_lateness, which
+parses arrival_time and departure_time and builds both scheduled datetimes
+for every row. "numpy" is calculate_subway_lateness, which works on
+arrival_s and departure_s and only builds them for the late rows.
+"""
+
+from datetime import datetime, timedelta
+import argparse
+import timeit
+import numpy as np
+import pandas as pd
+from gtfs_realtime import decode_vehicle_positions
+from subway_locations_schedules import calculate_subway_lateness, tz
+from benchmarks.make_realtime_fixtures import FEED_TIMESTAMP, FIXTURES_DIR, SIZES
+from benchmarks.synthetic_feed import SUBWAY_ROUTES
+
+
+def pandas_lateness(compare: pd.DataFrame, now: pd.Timestamp) -> pd.DataFrame:
+    # Midnight of the service day each scheduled trip belongs to
+    service_day = pd.to_datetime(compare["service_date"]).dt.tz_localize(tz)
+
+    # Resolve times that flow over to next day (e.g., 26:00 hours)
+    compare.loc[:, "arrival_time_fixed"] = service_day + pd.to_timedelta(
+        compare["arrival_time"]
+    )
+    compare.loc[:, "departure_time_fixed"] = service_day + pd.to_timedelta(
+        compare["departure_time"]
+    )
+
+    compare["arrival_time_fixed"] = pd.to_datetime(
+        compare["arrival_time_fixed"], utc=True
+    )
+    compare["arrival_time_fixed"] = compare["arrival_time_fixed"].dt.tz_convert(
+        tz="US/Eastern"
+    )
+
+    compare["late_by"] = (
+        compare["timestamp"] - compare["arrival_time_fixed"]
+    ) / pd.Timedelta(minutes=1)
+
+    late_subways = compare[(now - compare["timestamp"]) / pd.Timedelta(minutes=1) <= 90]
+    late_subways_2 = late_subways[
+        (late_subways["late_by"] > 3) & (late_subways["late_by"] < 30)
+    ]
+
+    return late_subways_2[late_subways_2["stop_sequence"] != 1]
+
+
+def gtfs_times(seconds: np.ndarray) -> list:
+    return [
+        f"{second // 3600}:{second // 60 % 60:02d}:{second % 60:02d}"
+        for second in seconds.tolist()
+    ]
+
+
+def compare_frame(content: bytes, stops: int, seed: int = 0) -> pd.DataFrame:
+    """The vehicles of a fixture joined with stops scheduled stops each"""
+
+    rng = np.random.default_rng(seed)
+    vehicles = pd.DataFrame(
+        decode_vehicle_positions(content, frozenset(SUBWAY_ROUTES))
+    ).loc[lambda frame: frame.index.repeat(stops)]
+
+    now = int(datetime.now(tz).timestamp())
+    timestamp = vehicles["timestamp"].to_numpy() - FEED_TIMESTAMP + now
+
+    # Vehicles are at least four hours into the service day, so every GTFS time
+    # is positive
+    service_date = (datetime.now(tz) - timedelta(hours=4)).date()
+    day_start = int(tz.localize(datetime(*service_date.timetuple()[:3])).timestamp())
+    arrival_s = timestamp - day_start - rng.integers(-600, 1200, len(vehicles))
+    departure_s = arrival_s + 30
+
+    return vehicles.assign(
+        stop_id_x=vehicles["stop_id"],
+        stop_sequence=np.tile(np.arange(1, stops + 1), len(vehicles) // stops),
+        service_date=service_date,
+        arrival_time=gtfs_times(arrival_s),
+        departure_time=gtfs_times(departure_s),
+        arrival_s=arrival_s,
+        departure_s=departure_s,
+        position_s=np.nan,
+        timestamp=pd.to_datetime(timestamp, unit="s", utc=True).tz_convert(tz),
+    ).reset_index(drop=True)
+
+
+def best_ms(function, repeat: int) -> float:
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--stops", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'fixture':10}{'rows':>8}{'late':>8}{'pandas ms':>11}{'numpy ms':>10}")
+    for name in SIZES:
+        content = (FIXTURES_DIR / f"vehicle_positions_{name}.pb").read_bytes()
+        compare = compare_frame(content, args.stops)
+        now = pd.Timestamp(datetime.now(tz))
+
+        late = calculate_subway_lateness.fn(compare.copy())
+
+        pandas_ms = best_ms(lambda: pandas_lateness(compare.copy(), now), args.repeat)
+        numpy_ms = best_ms(
+            lambda: calculate_subway_lateness.fn(compare.copy()), args.repeat
+        )
+        print(
+            f"{name:10}{len(compare):>8}{len(late):>8}"
+            f"{pandas_ms:>11.2f}{numpy_ms:>10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
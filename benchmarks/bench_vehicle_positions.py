@@ -0,0 +1,91 @@
+"""Decode time of the recorded VehiclePositions fixtures
+
+Run from the repository root:
+
+    python -m benchmarks.bench_vehicle_positions
+
+"dicts" is the old decoder. It copies every entity into a list, builds one
+dict per entity, makes a DataFrame of all of them and then keeps the subway
+routes. "columns" is decode_vehicle_positions, which skips other routes
+before reading any field and fills typed arrays. "frame" adds building the
+DataFrame from those arrays.
+"""
+
+from datetime import datetime
+import argparse
+import timeit
+import pandas as pd
+from google.transit.gtfs_realtime_pb2 import FeedMessage
+from gtfs_realtime import decode_vehicle_positions
+from benchmarks.make_realtime_fixtures import FIXTURES_DIR, SIZES
+from benchmarks.synthetic_feed import SUBWAY_ROUTES
+
+
+def dicts(content: bytes) -> pd.DataFrame:
+    message = FeedMessage()
+    message.ParseFromString(content)
+
+    trips = []
+    for t in message.entity:
+        trips.append(t)
+
+    rows = [
+        {
+            "id": t.id,
+            "trip_id": t.vehicle.trip.trip_id,
+            "start_time": t.vehicle.trip.start_time,
+            "start_date": t.vehicle.trip.start_date,
+            "schedule_relationship": t.vehicle.trip.schedule_relationship,
+            "route_id": t.vehicle.trip.route_id,
+            "direction_id": t.vehicle.trip.direction_id,
+            "latitude": t.vehicle.position.latitude,
+            "longitude": t.vehicle.position.longitude,
+            "bearing": t.vehicle.position.bearing,
+            "speed": t.vehicle.position.speed,
+            "current_stop": t.vehicle.current_stop_sequence,
+            "current_status": t.vehicle.current_status,
+            "timestamp": datetime.utcfromtimestamp(t.vehicle.timestamp),
+            "stop_id": t.vehicle.stop_id,
+            "vehicle": t.vehicle.vehicle.id,
+            "label": t.vehicle.vehicle.label,
+        }
+        for t in trips
+    ]
+    frame = pd.DataFrame(rows)
+
+    return frame[frame["route_id"].isin(SUBWAY_ROUTES)]
+
+
+def columns(content: bytes) -> dict:
+    return decode_vehicle_positions(content, frozenset(SUBWAY_ROUTES))
+
+
+def frame(content: bytes) -> pd.DataFrame:
+    return pd.DataFrame(columns(content))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    decoders = [dicts, columns, frame]
+    print(f"{'fixture':10}{'entities':>10}{'subway':>8}", end="")
+    print("".join(f"{decoder.__name__ + ' ms':>12}" for decoder in decoders))
+
+    for name, entities in SIZES.items():
+        content = (FIXTURES_DIR / f"vehicle_positions_{name}.pb").read_bytes()
+        subway = len(frame(content))
+        assert len(dicts(content)) == subway
+
+        print(f"{name:10}{entities:>10}{subway:>8}", end="")
+        for decoder in decoders:
+            timer = timeit.Timer(lambda: decoder(content))
+            number, _ = timer.autorange()
+            best = min(timer.repeat(repeat=args.repeat, number=number)) / number
+            print(f"{best * 1000:>12.2f}", end="")
+        print()
+
+
+if __name__ == "__main__":
+    main()
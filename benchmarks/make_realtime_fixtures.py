@@ -0,0 +1,73 @@
+"""Write the VehiclePositions fixtures the decoder benchmark reads
+
+Run from the repository root:
+
+    python -m benchmarks.make_realtime_fixtures
+
+The fixtures mirror the MBTA feed: about one vehicle in seven is on a subway
+route, the others are buses and commuter rail. The output is deterministic,
+so rerunning leaves the committed fixtures unchanged.
+"""
+
+from pathlib import Path
+import numpy as np
+from google.transit.gtfs_realtime_pb2 import FeedMessage
+from benchmarks.synthetic_feed import SUBWAY_ROUTES
+
+FIXTURES_DIR = Path(__file__).parent / "fixtures"
+
+# Entities in each fixture, the medium one is about the size of the live feed
+SIZES = {"small": 250, "medium": 1000, "large": 4000}
+
+# 2023-08-07 08:00 US/Eastern
+FEED_TIMESTAMP = 1691409600
+
+
+def vehicle_positions(entities: int, seed: int = 0) -> bytes:
+    rng = np.random.default_rng(seed)
+
+    message = FeedMessage()
+    message.header.gtfs_realtime_version = "2.0"
+    message.header.timestamp = FEED_TIMESTAMP
+
+    for number in range(entities):
+        entity = message.entity.add()
+        entity.id = f"y{number}"
+        vehicle = entity.vehicle
+
+        subway = rng.random() < 1 / 7
+        if subway:
+            vehicle.trip.route_id = SUBWAY_ROUTES[rng.integers(len(SUBWAY_ROUTES))]
+        else:
+            vehicle.trip.route_id = str(rng.integers(1, 150))
+        vehicle.trip.trip_id = f"T{rng.integers(44000)}"
+        vehicle.trip.start_date = "20230807"
+        vehicle.trip.start_time = f"{rng.integers(5, 9):02d}:{rng.integers(60):02d}:00"
+        vehicle.trip.direction_id = int(rng.integers(2))
+
+        vehicle.position.latitude = 42.2 + rng.random() * 0.3
+        vehicle.position.longitude = -71.2 + rng.random() * 0.3
+        vehicle.position.bearing = float(rng.integers(360))
+        vehicle.position.speed = float(rng.random() * 20)
+
+        vehicle.current_stop_sequence = int(rng.integers(1, 20))
+        vehicle.current_status = int(rng.integers(3))
+        vehicle.timestamp = FEED_TIMESTAMP - int(rng.integers(30))
+        vehicle.stop_id = str(70000 + rng.integers(4000))
+        vehicle.vehicle.id = f"G-{10000 + number}"
+        vehicle.vehicle.label = str(3600 + number)
+
+    return message.SerializeToString()
+
+
+def main() -> None:
+    FIXTURES_DIR.mkdir(exist_ok=True)
+
+    for name, entities in SIZES.items():
+        path = FIXTURES_DIR / f"vehicle_positions_{name}.pb"
+        path.write_bytes(vehicle_positions(entities))
+        print(f"{path}: {entities} entities, {path.stat().st_size} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+from pathlib import Path
+from typing import Union
+from zipfile import ZIP_DEFLATED, ZipFile
+import numpy as np
+import polars as pl
+
+# Subway routes of the feed, the remaining routes are buses
+SUBWAY_ROUTES = [
+    "Red",
+    "Mattapan",
+    "Orange",
+    "Green-B",
+    "Green-C",
+    "Green-D",
+    "Green-E",
+    "Blue",
+]
+
+# Weekday, Saturday and Sunday services, running from 2020 to 2099
+SERVICES = ["WK", "SA", "SU"]
+
+
+def write_feed(
+    path: Union[str, Path],
+    subway_trips: int = 4000,
+    bus_trips: int = 40000,
+    stops_per_trip: int = 20,
+    bus_routes: int = 150,
+    seed: int = 0,
+) -> Path:
+    """Write a GTFS archive laid out like the MBTA feed
+
+    Most stop times belong to bus trips, as in the real feed, so the subway
+    filters of the schedule build have to skip most of stop_times.txt.
+    """
+
+    rng = np.random.default_rng(seed)
+    path = Path(path)
+
+    routes = SUBWAY_ROUTES + [str(route) for route in range(1, bus_routes + 1)]
+    subway = np.arange(len(routes)) < len(SUBWAY_ROUTES)
+
+    # Each route serves its own run of stops
+    route_stops = stops_per_trip + 5
+    stop_ids = np.array(
+        [f"{70000 + stop}" for stop in range(len(routes) * route_stops)]
+    )
+    stop_subway = np.repeat(subway, route_stops)
+    stop_lat = 42.2 + rng.random(len(stop_ids)) * 0.3
+    stop_lon = -71.2 + rng.random(len(stop_ids)) * 0.3
+
+    # Trips of each kind are spread over the routes of that kind
+    trip_routes = np.concatenate(
+        [
+            rng.integers(0, len(SUBWAY_ROUTES), subway_trips),
+            rng.integers(len(SUBWAY_ROUTES), len(routes), bus_trips),
+        ]
+    )
+    trips = len(trip_routes)
+    trip_ids = np.array([f"T{trip}" for trip in range(trips)])
+    direction = rng.integers(0, 2, trips)
+    first_stop = rng.integers(0, route_stops - stops_per_trip + 1, trips)
+    start_s = rng.integers(5 * 3600, 25 * 3600, trips)
+
+    # stop_times, one row per trip and stop
+    trip_of_row = np.repeat(np.arange(trips), stops_per_trip)
+    sequence = np.tile(np.arange(stops_per_trip), trips)
+    stop_of_row = trip_routes[trip_of_row] * route_stops + first_stop[trip_of_row]
+    stop_of_row += np.where(
+        direction[trip_of_row] == 0, sequence, stops_per_trip - 1 - sequence
+    )
+    arrival_s = start_s[trip_of_row] + sequence * 120
+
+    tables = {
+        "feed_info.txt": pl.DataFrame(
+            {
+                "feed_publisher_name": ["MBTA"],
+                "feed_lang": ["EN"],
+                "feed_version": [f"synthetic-{seed}-{trips}"],
+            }
+        ),
+        "agency.txt": pl.DataFrame(
+            {
+                "agency_id": ["1"],
+                "agency_name": ["MBTA"],
+                "agency_url": ["https://www.mbta.com"],
+                "agency_timezone": ["America/New_York"],
+            }
+        ),
+        "routes.txt": pl.DataFrame(
+            {
+                "route_id": routes,
+                "agency_id": "1",
+                "route_short_name": routes,
+                "route_long_name": [f"{route} Line" for route in routes],
+                "route_desc": np.where(subway, "Rapid Transit", "Local Bus"),
+                "route_type": np.where(subway, 1, 3),
+                "route_url": "https://www.mbta.com",
+                "route_fare_class": np.where(subway, "Rapid Transit", "Local Bus"),
+                "line_id": [f"line-{route}" for route in routes],
+                "network_id": np.where(subway, "rapid_transit", "local_bus"),
+            }
+        ),
+        "calendar.txt": pl.DataFrame(
+            {
+                "service_id": SERVICES,
+                "monday": [1, 0, 0],
+                "tuesday": [1, 0, 0],
+                "wednesday": [1, 0, 0],
+                "thursday": [1, 0, 0],
+                "friday": [1, 0, 0],
+                "saturday": [0, 1, 0],
+                "sunday": [0, 0, 1],
+                "start_date": "20200101",
+                "end_date": "20991231",
+            }
+        ),
+        "stops.txt": pl.DataFrame(
+            {
+                "stop_id": stop_ids,
+                "stop_name": [f"Stop {stop_id}" for stop_id in stop_ids],
+                "stop_desc": "",
+                "stop_lat": stop_lat,
+                "stop_lon": stop_lon,
+                "zone_id": np.where(stop_subway, "RapidTransit", "LocalBus"),
+            }
+        ),
+        "trips.txt": pl.DataFrame(
+            {
+                "route_id": np.array(routes)[trip_routes],
+                "service_id": np.array(SERVICES)[rng.integers(0, 3, trips)],
+                "trip_id": trip_ids,
+                "trip_headsign": "Outbound",
+                "direction_id": direction,
+                "wheelchair_accessible": 1,
+                "route_pattern_id": [
+                    f"{routes[route]}-pattern" for route in trip_routes
+                ],
+                "bikes_allowed": 0,
+                "shape_id": [
+                    f"{routes[route]}-{way}"
+                    for route, way in zip(trip_routes, direction)
+                ],
+            }
+        ),
+        "stop_times.txt": pl.DataFrame(
+            {
+                "trip_id": trip_ids[trip_of_row],
+                "arrival_time": gtfs_times(arrival_s),
+                "departure_time": gtfs_times(arrival_s + 30),
+                "stop_id": stop_ids[stop_of_row],
+                "stop_sequence": sequence + 1,
+            }
+        ),
+        "shapes.txt": shapes(routes, route_stops, stop_lat, stop_lon),
+    }
+
+    with ZipFile(path, "w", ZIP_DEFLATED) as myzip:
+        for member, table in tables.items():
+            myzip.writestr(member, table.write_csv())
+
+    return path
+
+
+def gtfs_times(seconds: np.ndarray) -> pl.Series:
+    """Format seconds past the service day start as HH:MM:SS"""
+
+    hours, rest = np.divmod(seconds, 3600)
+    minutes, seconds = np.divmod(rest, 60)
+    parts = pl.DataFrame({"hours": hours, "minutes": minutes, "seconds": seconds})
+
+    return parts.select(
+        pl.format(
+            "{}:{}:{}",
+            *(pl.col(part).cast(pl.Utf8).str.zfill(2) for part in parts.columns),
+        )
+    ).to_series()
+
+
+def shapes(routes, route_stops, stop_lat, stop_lon) -> pl.DataFrame:
+    """One shape per route and direction through the stops of the route"""
+
+    rows = {"shape_id": [], "shape_pt_lat": [], "shape_pt_lon": []}
+    rows["shape_pt_sequence"] = []
+    for route_number, route in enumerate(routes):
+        stops = np.arange(route_stops) + route_number * route_stops
+        for way, order in enumerate([stops, stops[::-1]]):
+            rows["shape_id"].extend([f"{route}-{way}"] * route_stops)
+            rows["shape_pt_lat"].extend(stop_lat[order])
+            rows["shape_pt_lon"].extend(stop_lon[order])
+            rows["shape_pt_sequence"].extend(range(1, route_stops + 1))
+
+    return pl.DataFrame(rows)
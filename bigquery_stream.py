@@ -0,0 +1,317 @@
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Callable, List, Optional
+import json
+import time
+import pyarrow as pa
+from google.api_core import exceptions
+from google.cloud import bigquery_storage_v1
+from google.cloud.bigquery_storage_v1 import types
+from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+from google.rpc import code_pb2
+from state_file import write_json_atomic
+
+# Storage Write API wire types of the BigQuery column types
+PROTO_TYPES = {
+    "STRING": descriptor_pb2.FieldDescriptorProto.TYPE_STRING,
+    "INT64": descriptor_pb2.FieldDescriptorProto.TYPE_INT64,
+    "FLOAT64": descriptor_pb2.FieldDescriptorProto.TYPE_DOUBLE,
+    "DATE": descriptor_pb2.FieldDescriptorProto.TYPE_INT32,
+    "TIME": descriptor_pb2.FieldDescriptorProto.TYPE_STRING,
+    "TIMESTAMP": descriptor_pb2.FieldDescriptorProto.TYPE_INT64,
+}
+
+
+class OffsetAlreadyExists(Exception):
+    """The rows at this offset were already written to the stream"""
+
+
+class StreamNotFound(Exception):
+    """The write stream no longer exists or no longer accepts rows"""
+
+
+class WriteStreamClient(ABC):
+    """The part of the Storage Write API that LateSubwaysStreamSink uses
+
+    An in-process fake only needs to implement these three methods, a client
+    missing one cannot be created.
+    """
+
+    @abstractmethod
+    def create_stream(self) -> str:
+        """Create a write stream and return its name"""
+
+    @abstractmethod
+    def append(self, stream_name: str, rows: pa.Table, offset: int) -> None:
+        """Append rows starting at offset
+
+        Raises OffsetAlreadyExists if rows were already written at offset and
+        StreamNotFound if the stream is gone.
+        """
+
+    @abstractmethod
+    def finalize(self, stream_name: str) -> int:
+        """Close the stream to appends and return how many rows it holds"""
+
+
+def row_descriptor(schema: list) -> descriptor_pb2.DescriptorProto:
+    """Describe one table row as a proto2 message, one field per column"""
+
+    descriptor = descriptor_pb2.DescriptorProto(name="Row")
+    for number, field in enumerate(schema, start=1):
+        descriptor.field.add(
+            name=field.name,
+            number=number,
+            type=PROTO_TYPES[field.field_type],
+            label=(
+                descriptor_pb2.FieldDescriptorProto.LABEL_REQUIRED
+                if field.mode == "REQUIRED"
+                else descriptor_pb2.FieldDescriptorProto.LABEL_OPTIONAL
+            ),
+        )
+
+    return descriptor
+
+
+def serialize_rows(rows: pa.Table, message_class) -> List[bytes]:
+    """Encode Arrow rows as serialized row messages"""
+
+    columns = []
+    for field in rows.schema:
+        column = rows.column(field.name)
+
+        # Timestamps are sent as microseconds, dates as days, times as text
+        if pa.types.is_timestamp(field.type):
+            column = column.cast(pa.timestamp("us", tz="UTC")).cast(pa.int64())
+        elif pa.types.is_date32(field.type):
+            column = column.cast(pa.int32())
+        elif pa.types.is_time(field.type):
+            column = column.cast(pa.string())
+
+        columns.append(column.to_pylist())
+
+    names = rows.column_names
+
+    return [
+        message_class(
+            **{name: value for name, value in zip(names, values) if value is not None}
+        ).SerializeToString()
+        for values in zip(*columns)
+    ]
+
+
+class BigQueryWriteStreamClient(WriteStreamClient):
+    """Append rows to a committed write stream of a BigQuery table"""
+
+    def __init__(
+        self, project: str, dataset: str, table: str, schema: list, credentials=None
+    ):
+        self.client = bigquery_storage_v1.BigQueryWriteClient(credentials=credentials)
+        self.table_path = self.client.table_path(project, dataset, table)
+
+        descriptor = row_descriptor(schema)
+        file_descriptor = descriptor_pb2.FileDescriptorProto(
+            name=f"{table}_row.proto", syntax="proto2", message_type=[descriptor]
+        )
+        pool = descriptor_pool.DescriptorPool()
+        pool.Add(file_descriptor)
+
+        self.message_class = message_factory.GetMessageClass(
+            pool.FindMessageTypeByName("Row")
+        )
+        self.proto_schema = types.ProtoSchema(proto_descriptor=descriptor)
+
+    def create_stream(self) -> str:
+        # Rows of a committed stream are visible as soon as they are appended
+        write_stream = self.client.create_write_stream(
+            parent=self.table_path,
+            write_stream=types.WriteStream(type_=types.WriteStream.Type.COMMITTED),
+        )
+
+        return write_stream.name
+
+    def append(self, stream_name: str, rows: pa.Table, offset: int) -> None:
+        request = types.AppendRowsRequest(
+            write_stream=stream_name,
+            offset=offset,
+            proto_rows=types.AppendRowsRequest.ProtoData(
+                writer_schema=self.proto_schema,
+                rows=types.ProtoRows(
+                    serialized_rows=serialize_rows(rows, self.message_class)
+                ),
+            ),
+        )
+
+        try:
+            response = next(
+                iter(
+                    self.client.append_rows(
+                        iter([request]), metadata=self.routing(stream_name)
+                    )
+                )
+            )
+        except exceptions.AlreadyExists as error:
+            raise OffsetAlreadyExists(offset) from error
+        except (exceptions.NotFound, exceptions.FailedPrecondition) as error:
+            raise StreamNotFound(stream_name) from error
+
+        # Finalized or expired streams reject appends as a failed precondition
+        if response.error.code == code_pb2.ALREADY_EXISTS:
+            raise OffsetAlreadyExists(offset)
+        elif response.error.code in (code_pb2.NOT_FOUND, code_pb2.FAILED_PRECONDITION):
+            raise StreamNotFound(stream_name)
+        elif response.error.code:
+            raise RuntimeError(response.error.message)
+
+        return None
+
+    def finalize(self, stream_name: str) -> int:
+        # The Storage Write API only reports the rows of a stream once it is
+        # finalized
+        response = self.client.finalize_write_stream(
+            name=stream_name, metadata=self.routing(stream_name)
+        )
+
+        return response.row_count
+
+    @staticmethod
+    def routing(stream_name: str) -> tuple:
+        """Request metadata that routes a call to the stream's backend"""
+
+        return (("x-goog-request-params", f"write_stream={stream_name}"),)
+
+
+class LateSubwaysStreamSink:
+    """Buffer rows in memory and stream them to BigQuery in batches
+
+    A batch is flushed once max_rows rows are buffered or the oldest buffered
+    row has waited max_seconds. Each batch is appended at the stream offset
+    after the previous one. If an append is rejected with ALREADY_EXISTS the
+    stream is finalized and its row count read back: the batch counts as
+    written only if an earlier attempt of it could have landed and the stream
+    ends right after it, otherwise it is retried on a new stream. Every row is
+    written exactly once. on_flush is called after each batch is written.
+    """
+
+    def __init__(
+        self,
+        client: WriteStreamClient,
+        max_rows: int = 500,
+        max_seconds: float = 60,
+        retries: int = 3,
+        state_path: Optional[str] = None,
+        on_flush: Optional[Callable[[], None]] = None,
+    ):
+        self.client = client
+        self.max_rows = max_rows
+        self.max_seconds = max_seconds
+        self.retries = retries
+        self.state_path = Path(state_path) if state_path is not None else None
+        self.on_flush = on_flush
+        self.stream_name = None
+        self.offset = 0
+        self.buffer = []
+        self.buffered_rows = 0
+        self.buffered_since = None
+
+        if self.state_path is not None and self.state_path.exists():
+            with open(self.state_path) as state_file:
+                state = json.load(state_file)
+
+            self.stream_name = state["stream_name"]
+            self.offset = state["offset"]
+
+    def write(self, rows: pa.Table) -> None:
+        """Buffer rows and flush if the batch is full or old enough"""
+
+        if rows.num_rows:
+            if self.buffered_since is None:
+                self.buffered_since = time.monotonic()
+            self.buffer.append(rows)
+            self.buffered_rows += rows.num_rows
+
+        if self.buffered_rows >= self.max_rows or self.due():
+            self.flush()
+
+        return None
+
+    def due(self) -> bool:
+        """Whether the oldest buffered row has waited max_seconds"""
+
+        return (
+            self.buffered_since is not None
+            and time.monotonic() - self.buffered_since >= self.max_seconds
+        )
+
+    def flush(self) -> None:
+        """Append the buffered rows as one batch"""
+
+        if not self.buffer:
+            return None
+
+        batch = pa.concat_tables(self.buffer)
+
+        attempt = 0
+        # Whether an attempt on the current stream may have landed unseen
+        maybe_written = False
+        while True:
+            if self.stream_name is None:
+                self.stream_name = self.client.create_stream()
+                self.offset = 0
+                maybe_written = False
+
+            try:
+                self.client.append(self.stream_name, batch, self.offset)
+                self.offset += batch.num_rows
+                break
+            except OffsetAlreadyExists:
+                rows = self.client.finalize(self.stream_name)
+                self.stream_name = None
+
+                # An earlier attempt landed but its response was lost
+                if maybe_written and rows == self.offset + batch.num_rows:
+                    break
+
+                # The rows at offset are another batch's, written after the
+                # state was last saved
+                continue
+            except Exception as error:
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+
+                if isinstance(error, StreamNotFound):
+                    # Nothing of this batch was written, start over on a new stream
+                    self.stream_name = None
+                else:
+                    maybe_written = True
+                    time.sleep(2**attempt)
+
+        self.buffer = []
+        self.buffered_rows = 0
+        self.buffered_since = None
+        self.save()
+
+        if self.on_flush is not None:
+            self.on_flush()
+
+        return None
+
+    def save(self) -> None:
+        """Write the stream name and next offset to state_path"""
+
+        if self.state_path is None:
+            return None
+
+        write_json_atomic(
+            self.state_path, {"stream_name": self.stream_name, "offset": self.offset}
+        )
+
+        return None
+
+    def close(self) -> None:
+        """Flush whatever is still buffered"""
+
+        self.flush()
+
+        return None
@@ -0,0 +1,253 @@
+from dataclasses import dataclass
+from pathlib import Path
+from typing import FrozenSet, List, Optional
+import numpy as np
+import pandas as pd
+import polars as pl
+import pyarrow as pa
+from storage_format import StorageFormat
+
+# Tables of a compact schedule, each written to <table><suffix>
+SCHEDULE_TABLES = ("stop_times", "trips", "routes", "stops", "shapes")
+
+# Columns of each dimension table, the row number of a dimension row is its idx
+ROUTE_COLUMNS = [
+    "route_id",
+    "agency_id",
+    "route_short_name",
+    "route_long_name",
+    "route_desc",
+    "route_type",
+    "route_url",
+    "route_fare_class",
+    "line_id",
+    "network_id",
+]
+STOP_COLUMNS = ["stop_id", "stop_name", "stop_desc", "stop_lat", "stop_lon", "zone_id"]
+TRIP_COLUMNS = [
+    "trip_id",
+    "service_date",
+    "route_idx",
+    "service_id",
+    "trip_headsign",
+    "direction_id",
+    "wheelchair_accessible",
+    "route_pattern_id",
+    "bikes_allowed",
+    "shape_id",
+    "monday",
+    "tuesday",
+    "wednesday",
+    "thursday",
+    "friday",
+    "saturday",
+    "sunday",
+    "start_date",
+    "end_date",
+]
+STOP_TIME_COLUMNS = [
+    "trip_idx",
+    "stop_idx",
+    "stop_sequence",
+    "arrival_s",
+    "departure_s",
+]
+
+# Points of the shapes the trips follow, sorted by shape_id and point sequence
+SHAPE_COLUMNS = ["shape_id", "shape_pt_lat", "shape_pt_lon"]
+
+# Columns of one stop of the schedule once the dimensions are joined back
+SCHEDULE_COLUMNS = [
+    "route_id",
+    "service_id",
+    "trip_id",
+    "trip_headsign",
+    "direction_id",
+    "wheelchair_accessible",
+    "route_pattern_id",
+    "bikes_allowed",
+    "agency_id",
+    "route_short_name",
+    "route_long_name",
+    "route_desc",
+    "route_type",
+    "route_url",
+    "route_fare_class",
+    "line_id",
+    "network_id",
+    "monday",
+    "tuesday",
+    "wednesday",
+    "thursday",
+    "friday",
+    "saturday",
+    "sunday",
+    "start_date",
+    "end_date",
+    "arrival_time",
+    "departure_time",
+    "stop_id",
+    "stop_sequence",
+    "stop_name",
+    "stop_desc",
+    "stop_lat",
+    "stop_lon",
+    "zone_id",
+    "arrival_s",
+    "departure_s",
+    "service_date",
+]
+
+# Text columns derived from the seconds columns when they are joined back
+TIME_COLUMNS = {"arrival_time": "arrival_s", "departure_time": "departure_s"}
+
+
+def gtfs_time(seconds: np.ndarray) -> np.ndarray:
+    """Format seconds past the service day start as GTFS HH:MM:SS times"""
+
+    hours, rest = np.divmod(seconds, 3600)
+    minutes, seconds = np.divmod(rest, 60)
+
+    return np.char.add(
+        np.char.add(
+            np.char.add(np.char.zfill(hours.astype(str), 2), ":"),
+            np.char.add(np.char.zfill(minutes.astype(str), 2), ":"),
+        ),
+        np.char.zfill(seconds.astype(str), 2),
+    ).astype(object)
+
+
+@dataclass
+class CompactSchedule:
+    """One service day's schedule as a narrow fact table and small dimensions
+
+    stop_times has one row of integer codes per scheduled stop. Its trip_idx and
+    stop_idx are row numbers of trips and stops, and each trip's route_idx is a
+    row number of routes. The wide, repetitive columns are stored once per trip,
+    route or stop and only joined back for the rows that are asked for. shapes
+    holds the points of each trip's shape_id.
+    """
+
+    stop_times: pa.Table
+    trips: pa.Table
+    routes: pa.Table
+    stops: pa.Table
+    shapes: pa.Table
+
+    @classmethod
+    def from_frame(
+        cls, schedule: pl.DataFrame, shapes: Optional[pl.DataFrame] = None
+    ) -> "CompactSchedule":
+        """Normalise a schedule with one wide row per stop
+
+        shapes are the points of shapes.txt in shape and sequence order, only
+        those of the schedule's trips are kept.
+        """
+
+        routes = (
+            schedule.select(ROUTE_COLUMNS)
+            .unique(subset="route_id")
+            .sort("route_id")
+            .with_row_count("route_idx")
+        )
+        stops = (
+            schedule.select(STOP_COLUMNS)
+            .unique(subset="stop_id")
+            .sort("stop_id")
+            .with_row_count("stop_idx")
+        )
+
+        # A trip running past midnight appears under two service days
+        trips = (
+            schedule.unique(subset=["trip_id", "service_date"])
+            .join(routes.select("route_id", "route_idx"), on="route_id")
+            .sort("route_idx", "trip_id", "service_date")
+            .with_row_count("trip_idx")
+        )
+
+        stop_times = (
+            schedule.join(
+                trips.select("trip_id", "service_date", "trip_idx"),
+                on=["trip_id", "service_date"],
+            )
+            .join(stops.select("stop_id", "stop_idx"), on="stop_id")
+            .select(STOP_TIME_COLUMNS)
+            .sort("trip_idx", "stop_sequence")
+        )
+
+        if shapes is None:
+            shapes = pl.DataFrame(
+                schema={
+                    "shape_id": pl.Utf8,
+                    "shape_pt_lat": pl.Float64,
+                    "shape_pt_lon": pl.Float64,
+                }
+            )
+        shapes = shapes.filter(pl.col("shape_id").is_in(trips["shape_id"].unique()))
+
+        return cls(
+            stop_times=stop_times.with_columns(pl.all().cast(pl.Int32)).to_arrow(),
+            trips=trips.select(TRIP_COLUMNS)
+            .with_columns(pl.col("route_idx").cast(pl.Int32))
+            .to_arrow(),
+            routes=routes.select(ROUTE_COLUMNS).to_arrow(),
+            stops=stops.select(STOP_COLUMNS).to_arrow(),
+            shapes=shapes.select(SHAPE_COLUMNS).to_arrow(),
+        )
+
+    def route_ids(self) -> FrozenSet[str]:
+        """Ids of the routes the schedule was built for"""
+
+        return frozenset(self.routes["route_id"].to_pylist())
+
+    def write(self, directory: Path, storage: StorageFormat) -> List[Path]:
+        """Write each table to <directory>/<table><suffix>"""
+
+        directory.mkdir(parents=True, exist_ok=True)
+
+        # Rows must stay in idx order, so the tables are written unsorted
+        storage = storage.with_options(sort_by=())
+
+        paths = []
+        for name in SCHEDULE_TABLES:
+            path = directory / f"{name}{storage.suffix}"
+            storage.write(getattr(self, name), path)
+            paths.append(path)
+
+        return paths
+
+    def frame(
+        self, rows: np.ndarray, columns: Optional[List[str]] = None
+    ) -> pd.DataFrame:
+        """Join the dimensions back onto the given stop_times rows
+
+        Only the requested columns, by default SCHEDULE_COLUMNS, are looked up.
+        """
+
+        columns = SCHEDULE_COLUMNS if columns is None else columns
+
+        stop_times = self.stop_times.take(pa.array(rows, pa.int64()))
+        tables = [stop_times]
+
+        # Dimensions are only looked up for the columns they hold
+        if set(columns) & set(TRIP_COLUMNS + ROUTE_COLUMNS):
+            trips = self.trips.take(stop_times["trip_idx"])
+            tables.append(trips)
+            if set(columns) & set(ROUTE_COLUMNS):
+                tables.append(self.routes.take(trips["route_idx"]))
+        if set(columns) & set(STOP_COLUMNS):
+            tables.append(self.stops.take(stop_times["stop_idx"]))
+
+        frame = {}
+        for column in columns:
+            if column in TIME_COLUMNS:
+                seconds = stop_times[TIME_COLUMNS[column]].to_numpy()
+                frame[column] = gtfs_time(seconds)
+                continue
+
+            for table in tables:
+                if column in table.column_names:
+                    frame[column] = table[column].to_pandas()
+                    break
+
+        return pd.DataFrame(frame)
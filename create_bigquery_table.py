@@ -1,74 +1,51 @@
+from google.cloud.bigquery import TimePartitioning, TimePartitioningType
 from prefect_gcp.bigquery import bigquery_create_table
-from google.cloud.bigquery import SchemaField
 from prefect_gcp import GcpCredentials
 from prefect import flow
+from write_bigquery_table import (
+    CLUSTERING_FIELDS,
+    DATASET,
+    LATE_SUBWAYS_SCHEMA,
+    PARTITION_FIELD,
+    RAW_TABLE,
+    STAGING_TABLE,
+)
+
+# Staged rows are merged within minutes, older partitions are dropped
+STAGING_EXPIRATION_MS = 3 * 24 * 60 * 60 * 1000
 
 
 @flow
 def create_biqquery_table():
+    """Create the raw table and the staging table it is merged from
+
+    An existing unpartitioned raw table is left as it is. It has to be copied into
+    a partitioned table with CREATE TABLE ... PARTITION BY ... AS SELECT.
+    """
+
     gcp_credentials = GcpCredentials.load("subway-credentials")
 
-    schema = [
-        SchemaField("route_id", field_type="STRING", mode="REQUIRED"),
-        SchemaField("service_id", field_type="STRING", mode="REQUIRED"),
-        SchemaField("trip_id", field_type="STRING", mode="REQUIRED"),
-        SchemaField("trip_headsign", field_type="STRING", mode="REQUIRED"),
-        SchemaField("direction_id", field_type="STRING", mode="REQUIRED"),
-        SchemaField("wheelchair_accessible", field_type="STRING", mode="NULLABLE"),
-        SchemaField("route_pattern_id", field_type="STRING", mode="NULLABLE"),
-        SchemaField("bikes_allowed", field_type="STRING", mode="NULLABLE"),
-        SchemaField("agency_id", field_type="STRING", mode="REQUIRED"),
-        SchemaField("route_short_name", field_type="STRING", mode="NULLABLE"),
-        SchemaField("route_long_name", field_type="STRING", mode="NULLABLE"),
-        SchemaField("route_desc", field_type="STRING", mode="NULLABLE"),
-        SchemaField("route_type", field_type="STRING", mode="NULLABLE"),
-        SchemaField("route_url", field_type="STRING", mode="NULLABLE"),
-        SchemaField("route_fare_class", field_type="STRING", mode="NULLABLE"),
-        SchemaField("line_id", field_type="STRING", mode="NULLABLE"),
-        SchemaField("network_id", field_type="STRING", mode="NULLABLE"),
-        SchemaField("monday", field_type="STRING", mode="NULLABLE"),
-        SchemaField("tuesday", field_type="STRING", mode="NULLABLE"),
-        SchemaField("wednesday", field_type="STRING", mode="NULLABLE"),
-        SchemaField("thursday", field_type="STRING", mode="NULLABLE"),
-        SchemaField("friday", field_type="STRING", mode="NULLABLE"),
-        SchemaField("saturday", field_type="STRING", mode="NULLABLE"),
-        SchemaField("sunday", field_type="STRING", mode="NULLABLE"),
-        SchemaField("start_date", field_type="DATE", mode="REQUIRED"),
-        SchemaField("end_date", field_type="DATE", mode="REQUIRED"),
-        SchemaField("arrival_time", field_type="TIME", mode="REQUIRED"),
-        SchemaField("departure_time", field_type="TIME", mode="REQUIRED"),
-        SchemaField("stop_id", field_type="STRING", mode="REQUIRED"),
-        SchemaField("stop_sequence", field_type="STRING", mode="NULLABLE"),
-        SchemaField("stop_name", field_type="STRING", mode="NULLABLE"),
-        SchemaField("stop_desc", field_type="STRING", mode="NULLABLE"),
-        SchemaField("stop_lat", field_type="FLOAT64", mode="REQUIRED"),
-        SchemaField("stop_lon", field_type="FLOAT64", mode="REQUIRED"),
-        SchemaField("zone_id", field_type="STRING", mode="NULLABLE"),
-        SchemaField("id", field_type="STRING", mode="REQUIRED"),
-        SchemaField("start_time", field_type="TIME", mode="REQUIRED"),
-        SchemaField("live_start_date", field_type="DATE", mode="REQUIRED"),
-        SchemaField("schedule_relationship", field_type="STRING", mode="NULLABLE"),
-        SchemaField("live_route_id", field_type="STRING", mode="REQUIRED"),
-        SchemaField("latitude", field_type="FLOAT64", mode="NULLABLE"),
-        SchemaField("longitude", field_type="FLOAT64", mode="NULLABLE"),
-        SchemaField("bearing", field_type="FLOAT64", mode="NULLABLE"),
-        SchemaField("speed", field_type="FLOAT64", mode="NULLABLE"),
-        SchemaField("current_stop", field_type="STRING", mode="NULLABLE"),
-        SchemaField("current_status", field_type="STRING", mode="NULLABLE"),
-        SchemaField("timestamp", field_type="STRING", mode="REQUIRED"),
-        SchemaField("live_stop_id", field_type="STRING", mode="NULLABLE"),
-        SchemaField("vehicle", field_type="STRING", mode="NULLABLE"),
-        SchemaField("label", field_type="STRING", mode="NULLABLE"),
-        SchemaField("arrival_time_fixed", field_type="STRING", mode="REQUIRED"),
-        SchemaField("departure_time_fixed", field_type="STRING", mode="REQUIRED"),
-        SchemaField("late_by", field_type="FLOAT64", mode="REQUIRED"),
-    ]
+    bigquery_create_table(
+        dataset=DATASET,
+        table=RAW_TABLE,
+        schema=LATE_SUBWAYS_SCHEMA,
+        gcp_credentials=gcp_credentials,
+        clustering_fields=CLUSTERING_FIELDS,
+        time_partitioning=TimePartitioning(
+            type_=TimePartitioningType.DAY, field=PARTITION_FIELD
+        ),
+    )
 
     bigquery_create_table(
-        dataset="subway_mbta",
-        table="raw_subway_mbta",
-        schema=schema,
+        dataset=DATASET,
+        table=STAGING_TABLE,
+        schema=LATE_SUBWAYS_SCHEMA,
         gcp_credentials=gcp_credentials,
+        time_partitioning=TimePartitioning(
+            type_=TimePartitioningType.DAY,
+            field=PARTITION_FIELD,
+            expiration_ms=STAGING_EXPIRATION_MS,
+        ),
     )
 
 
@@ -0,0 +1,255 @@
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Optional
+from zipfile import ZipFile
+import csv
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import urllib.error
+import urllib.request
+from state_file import write_json_atomic
+
+# Name of the file that remembers what was last downloaded into the cache
+FEED_STATE_FILENAME = "feed.json"
+
+
+@dataclass
+class FeedFile:
+    """A GTFS archive stored in the local cache under its content hash"""
+
+    path: Path
+    sha256: str
+    changed: bool
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    built_for: Optional[str] = None
+
+
+def _read_state(cache_dir: Path) -> dict:
+    """Read the cache state written by the previous download, if any"""
+
+    state_path = cache_dir / FEED_STATE_FILENAME
+
+    if not state_path.exists():
+        return {}
+
+    with open(state_path) as state_file:
+        return json.load(state_file)
+
+
+def _write_state(cache_dir: Path, state: dict) -> None:
+    """Atomically replace the cache state file"""
+
+    write_json_atomic(cache_dir / FEED_STATE_FILENAME, state, indent=2)
+
+
+def _prune(cache_dir: Path, keep: Path) -> None:
+    """Remove archives of feeds that have been superseded"""
+
+    for archive in cache_dir.glob("*.zip"):
+        if archive != keep:
+            archive.unlink()
+
+
+def fetch_feed(url: str, cache_dir: str, timeout: float = 60) -> FeedFile:
+    """Download the GTFS archive unless the cached copy is still current
+
+    A conditional request is sent with the ETag and Last-Modified values of the
+    cached copy. The archive is stored as <sha256>.zip so a feed that is served
+    again with new headers but identical bytes is still recognised as unchanged.
+    """
+
+    cache_path = Path(cache_dir)
+    cache_path.mkdir(parents=True, exist_ok=True)
+
+    state = _read_state(cache_path)
+    cached_path = cache_path / f"{state['sha256']}.zip" if state else None
+
+    request = urllib.request.Request(url)
+
+    # Only send validators if the cached archive is actually on disk
+    if cached_path is not None and cached_path.exists():
+        if state.get("etag"):
+            request.add_header("If-None-Match", state["etag"])
+        if state.get("last_modified"):
+            request.add_header("If-Modified-Since", state["last_modified"])
+
+    try:
+        response = urllib.request.urlopen(request, timeout=timeout)
+    except urllib.error.HTTPError as error:
+        if error.code != 304:
+            raise
+
+        return FeedFile(
+            path=cached_path,
+            sha256=state["sha256"],
+            changed=False,
+            etag=state.get("etag"),
+            last_modified=state.get("last_modified"),
+            built_for=state.get("built_for"),
+        )
+
+    # Stream the body to a temporary file while hashing it
+    digest = hashlib.sha256()
+    with response, tempfile.NamedTemporaryFile(
+        dir=cache_path, suffix=".part", delete=False
+    ) as tmp_file:
+        for chunk in iter(lambda: response.read(1024 * 1024), b""):
+            digest.update(chunk)
+            tmp_file.write(chunk)
+
+    sha256 = digest.hexdigest()
+    feed_path = cache_path / f"{sha256}.zip"
+    changed = sha256 != state.get("sha256")
+
+    if feed_path.exists():
+        os.remove(tmp_file.name)
+    else:
+        shutil.move(tmp_file.name, feed_path)
+
+    new_state = {
+        "url": url,
+        "sha256": sha256,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        # A changed feed has not been built for any service date yet
+        "built_for": None if changed else state.get("built_for"),
+    }
+    _write_state(cache_path, new_state)
+    _prune(cache_path, keep=feed_path)
+
+    return FeedFile(
+        path=feed_path,
+        sha256=sha256,
+        changed=changed,
+        etag=new_state["etag"],
+        last_modified=new_state["last_modified"],
+        built_for=new_state["built_for"],
+    )
+
+
+def mark_feed_built(cache_dir: str, feed: FeedFile, service_date: str) -> None:
+    """Record that the schedule for service_date was built from this feed"""
+
+    cache_path = Path(cache_dir)
+    state = _read_state(cache_path)
+
+    # The cache may have moved on to a newer feed in the meantime
+    if state.get("sha256") != feed.sha256:
+        return None
+
+    state["built_for"] = service_date
+    _write_state(cache_path, state)
+
+    return None
+
+
+def feed_fingerprint(feed_path: str) -> dict:
+    """Read the feed_info version and a hash of every member of the archive
+
+    Member hashes come from the CRC-32 and size stored in the zip directory, so
+    no member has to be decompressed to tell whether it changed.
+    """
+
+    with ZipFile(feed_path) as myzip:
+        members = {
+            info.filename: f"{info.CRC:08x}-{info.file_size}"
+            for info in myzip.infolist()
+        }
+
+        feed_version = None
+        if "feed_info.txt" in members:
+            with myzip.open("feed_info.txt") as feed_info:
+                rows = csv.DictReader(io.TextIOWrapper(feed_info, "utf-8-sig"))
+                feed_version = next(rows, {}).get("feed_version")
+
+    return {"feed_version": feed_version, "members": members}
+
+
+class ArtifactManifest:
+    """Persisted record of derived artifacts and the inputs they were built from"""
+
+    def __init__(self, cache_dir: str, filename: str = "manifest.json"):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.manifest_path = self.cache_dir / filename
+
+        if self.manifest_path.exists():
+            with open(self.manifest_path) as manifest_file:
+                self.artifacts = json.load(manifest_file)
+        else:
+            self.artifacts = {}
+
+    @staticmethod
+    def inputs_key(inputs: dict) -> str:
+        """Stable hash of the inputs of a stage"""
+
+        encoded = json.dumps(inputs, sort_keys=True).encode("utf-8")
+
+        return hashlib.sha256(encoded).hexdigest()
+
+    def lookup(self, name: str, inputs: dict) -> Optional[Path]:
+        """Return the artifact path if it was built from exactly these inputs"""
+
+        entry = self.artifacts.get(name)
+
+        if entry is None or entry["key"] != self.inputs_key(inputs):
+            return None
+
+        path = self.cache_dir / entry["path"]
+
+        return path if path.exists() else None
+
+    def record(self, name: str, inputs: dict, path: Path) -> None:
+        """Remember a freshly built artifact and drop the one it replaces"""
+
+        previous = self.artifacts.get(name)
+        if previous is not None and previous["path"] != path.name:
+            (self.cache_dir / previous["path"]).unlink(missing_ok=True)
+
+        self.artifacts[name] = {"key": self.inputs_key(inputs), "path": path.name}
+
+        write_json_atomic(self.manifest_path, self.artifacts, indent=2)
+
+        return None
+
+    def get_or_build(
+        self, name: str, inputs: dict, build: Callable[[Path], None], suffix: str
+    ) -> Path:
+        """Return the cached artifact, calling build(path) only if its inputs changed"""
+
+        path = self.lookup(name, inputs)
+        if path is not None:
+            return path
+
+        path = self.cache_dir / f"{name}-{self.inputs_key(inputs)[:16]}{suffix}"
+        build(path)
+        self.record(name, inputs, path)
+
+        return path
+
+
+def member_inputs(fingerprint: dict, members: list, **params) -> dict:
+    """Inputs of a stage: the hashes of the members it reads plus its parameters"""
+
+    return {
+        "members": {member: fingerprint["members"].get(member) for member in members},
+        **params,
+    }
+
+
+def extract_member(feed_path: str, member: str, to_dir: str) -> Path:
+    """Extract a single member of the archive so it can be scanned lazily"""
+
+    to_path = Path(to_dir) / member
+
+    with ZipFile(feed_path) as myzip, myzip.open(member) as source, open(
+        to_path, "wb"
+    ) as target:
+        shutil.copyfileobj(source, target, 1024 * 1024)
+
+    return to_path
@@ -0,0 +1,348 @@
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+from zipfile import ZipFile
+import csv
+import io
+import os
+import tempfile
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import csv as arrow_csv
+from gtfs_feed import extract_member
+
+# Ids are dictionary encoded, each distinct id is stored once per table
+ID = pa.dictionary(pa.int32(), pa.string())
+
+# Columns read from each member and their types. Times are int32 seconds past the
+# start of the service day and can be past 24:00.
+GTFS_SCHEMAS = {
+    "agency.txt": pa.schema([("agency_id", ID), ("agency_name", pa.string())]),
+    "routes.txt": pa.schema(
+        [
+            ("route_id", ID),
+            ("agency_id", ID),
+            ("route_short_name", pa.string()),
+            ("route_long_name", pa.string()),
+            ("route_desc", pa.string()),
+            ("route_type", pa.int8()),
+            ("route_url", pa.string()),
+            ("route_fare_class", pa.string()),
+            ("line_id", ID),
+            ("network_id", ID),
+        ]
+    ),
+    "trips.txt": pa.schema(
+        [
+            ("route_id", ID),
+            ("service_id", ID),
+            ("trip_id", ID),
+            ("trip_headsign", pa.string()),
+            ("direction_id", pa.int8()),
+            ("wheelchair_accessible", pa.int8()),
+            ("route_pattern_id", ID),
+            ("bikes_allowed", pa.int8()),
+            ("shape_id", ID),
+        ]
+    ),
+    "calendar.txt": pa.schema(
+        [
+            ("service_id", ID),
+            ("monday", pa.int8()),
+            ("tuesday", pa.int8()),
+            ("wednesday", pa.int8()),
+            ("thursday", pa.int8()),
+            ("friday", pa.int8()),
+            ("saturday", pa.int8()),
+            ("sunday", pa.int8()),
+            ("start_date", pa.date32()),
+            ("end_date", pa.date32()),
+        ]
+    ),
+    "stops.txt": pa.schema(
+        [
+            ("stop_id", ID),
+            ("stop_name", pa.string()),
+            ("stop_desc", pa.string()),
+            ("stop_lat", pa.float64()),
+            ("stop_lon", pa.float64()),
+            ("zone_id", ID),
+        ]
+    ),
+    "shapes.txt": pa.schema(
+        [
+            ("shape_id", ID),
+            ("shape_pt_lat", pa.float64()),
+            ("shape_pt_lon", pa.float64()),
+            ("shape_pt_sequence", pa.int32()),
+        ]
+    ),
+    "stop_times.txt": pa.schema(
+        [
+            ("trip_id", ID),
+            ("arrival_s", pa.int32()),
+            ("departure_s", pa.int32()),
+            ("stop_id", ID),
+            ("stop_sequence", pa.int32()),
+        ]
+    ),
+}
+
+# CSV columns that are parsed into other columns of the schema
+PARSED_COLUMNS = {"arrival_s": "arrival_time", "departure_s": "departure_time"}
+
+# Upper bound on the bytes of stop_times.txt one worker parses at a time
+CHUNK_BYTES = 64 * 1024 * 1024
+
+
+def schema_key(members: Iterable[str]) -> str:
+    """Text of the schemas of the members, so cached tables follow schema changes"""
+
+    return "\n".join(f"{member}: {GTFS_SCHEMAS[member]}" for member in members)
+
+
+def csv_column_types(schema: pa.Schema) -> Dict[str, pa.DataType]:
+    """Types the CSV reader should produce for the columns of a schema"""
+
+    column_types = {}
+    for field in schema:
+        if field.name in PARSED_COLUMNS:
+            column_types[PARSED_COLUMNS[field.name]] = pa.string()
+        elif pa.types.is_date32(field.type):
+            column_types[field.name] = pa.string()
+        elif pa.types.is_dictionary(field.type):
+            # Workers filter on plain ids and encode what is left
+            column_types[field.name] = pa.string()
+        else:
+            column_types[field.name] = field.type
+
+    return column_types
+
+
+def gtfs_seconds(times: pa.ChunkedArray) -> pa.ChunkedArray:
+    """Convert GTFS H:MM:SS times, which can be past 24:00, to int32 seconds"""
+
+    parts = pc.split_pattern(pc.utf8_trim_whitespace(times), ":")
+
+    return pc.add(
+        pc.add(
+            pc.multiply(pc.list_element(parts, 0).cast(pa.int32()), 3600),
+            pc.multiply(pc.list_element(parts, 1).cast(pa.int32()), 60),
+        ),
+        pc.list_element(parts, 2).cast(pa.int32()),
+    )
+
+
+def conform(table: pa.Table, schema: pa.Schema) -> pa.Table:
+    """Convert the parsed CSV columns to the types of the schema"""
+
+    arrays = []
+    for field in schema:
+        if field.name in PARSED_COLUMNS:
+            array = gtfs_seconds(table[PARSED_COLUMNS[field.name]])
+        elif pa.types.is_date32(field.type):
+            array = pc.strptime(table[field.name], format="%Y%m%d", unit="s").cast(
+                pa.date32()
+            )
+        elif pa.types.is_dictionary(field.type):
+            array = pc.dictionary_encode(table[field.name])
+        else:
+            array = table[field.name].cast(field.type)
+
+        arrays.append(array)
+
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def parse_csv(source, schema: pa.Schema, column_names=None) -> pa.Table:
+    """Parse GTFS CSV into a table of the given schema
+
+    Optional columns that the feed leaves out are filled with nulls.
+    """
+
+    column_types = csv_column_types(schema)
+
+    table = arrow_csv.read_csv(
+        source,
+        read_options=arrow_csv.ReadOptions(column_names=column_names),
+        convert_options=arrow_csv.ConvertOptions(
+            column_types=column_types,
+            include_columns=list(column_types),
+            include_missing_columns=True,
+            strings_can_be_null=True,
+        ),
+    )
+
+    return table
+
+
+def read_member(feed_path: str, member: str) -> pa.Table:
+    """Decode one member of the archive"""
+
+    with ZipFile(feed_path) as myzip, myzip.open(member) as source:
+        table = parse_csv(source, GTFS_SCHEMAS[member])
+
+    return conform(table, GTFS_SCHEMAS[member])
+
+
+def read_stop_times_chunk(
+    path: str,
+    column_names: List[str],
+    start: int,
+    end: int,
+    trip_ids: Optional[pa.Array] = None,
+    stop_ids: Optional[pa.Array] = None,
+) -> pa.Table:
+    """Decode the stop times between two line boundaries of stop_times.txt"""
+
+    with open(path, "rb") as source:
+        source.seek(start)
+        chunk = source.read(end - start)
+
+    schema = GTFS_SCHEMAS["stop_times.txt"]
+    table = parse_csv(io.BytesIO(chunk), schema, column_names=column_names)
+
+    # Drop unwanted rows before their times are parsed and sent back
+    if trip_ids is not None:
+        table = table.filter(pc.is_in(table["trip_id"], value_set=trip_ids))
+    if stop_ids is not None:
+        table = table.filter(pc.is_in(table["stop_id"], value_set=stop_ids))
+
+    return conform(table, schema)
+
+
+def line_ranges(path: str, chunk_bytes: int) -> Tuple[List[str], List[tuple]]:
+    """Split a CSV file into byte ranges that start and end on line boundaries
+
+    Returns the header columns and the (start, end) ranges of the rows.
+    """
+
+    size = os.path.getsize(path)
+
+    with open(path, "rb") as source:
+        header = source.readline()
+        column_names = next(csv.reader([header.decode("utf-8-sig").rstrip("\r\n")]))
+
+        ranges = []
+        start = source.tell()
+        while start < size:
+            # Move the boundary to the end of the line it falls in
+            source.seek(min(start + chunk_bytes, size))
+            source.readline()
+            end = min(source.tell(), size)
+            ranges.append((start, end))
+            start = end
+
+    return column_names, ranges
+
+
+def executor(workers: int) -> Optional[Executor]:
+    """Thread pool for the workers, or None to decode in the calling thread
+
+    Parsing, filtering and converting are done by pyarrow, which releases the GIL,
+    so threads run on separate cores without starting processes.
+    """
+
+    if workers <= 1:
+        return None
+
+    return ThreadPoolExecutor(max_workers=workers)
+
+
+def default_workers() -> int:
+    return os.cpu_count() or 1
+
+
+def encode_ids(tables: List[pa.Table], schema: pa.Schema) -> pa.Table:
+    """Concatenate tables decoded by separate workers under one dictionary per id"""
+
+    if not tables:
+        return schema.empty_table()
+
+    return pa.concat_tables(tables).unify_dictionaries().combine_chunks()
+
+
+def load_members(
+    feed_path: str, members: List[str], workers: Optional[int] = None
+) -> Dict[str, pa.Table]:
+    """Decode members of the archive in parallel, one member per worker"""
+
+    workers = min(workers or default_workers(), len(members))
+
+    pool = executor(workers)
+    if pool is None:
+        return {member: read_member(feed_path, member) for member in members}
+
+    with pool:
+        futures = {
+            member: pool.submit(read_member, feed_path, member) for member in members
+        }
+
+        return {member: future.result() for member, future in futures.items()}
+
+
+def load_stop_times(
+    feed_path: str,
+    trip_ids: Optional[Iterable[str]] = None,
+    stop_ids: Optional[Iterable[str]] = None,
+    workers: Optional[int] = None,
+    chunk_bytes: int = CHUNK_BYTES,
+    work_dir: Optional[str] = None,
+) -> pa.Table:
+    """Decode stop_times.txt in byte-range chunks spread over the workers
+
+    Only stop times of the given trips at the given stops are kept. The member
+    is extracted once, every worker then parses its own part of the file.
+    """
+
+    workers = workers or default_workers()
+
+    if trip_ids is not None:
+        trip_ids = pa.array(list(trip_ids), pa.string())
+    if stop_ids is not None:
+        stop_ids = pa.array(list(stop_ids), pa.string())
+
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp_dir:
+        path = str(extract_member(feed_path, "stop_times.txt", tmp_dir))
+
+        # A few chunks per worker keeps them all busy until the end
+        size = os.path.getsize(path)
+        chunk_bytes = max(min(chunk_bytes, size // (4 * workers)), 1024 * 1024)
+        column_names, ranges = line_ranges(path, chunk_bytes)
+
+        pool = executor(min(workers, len(ranges)))
+        if pool is None:
+            chunks = [
+                read_stop_times_chunk(
+                    path, column_names, start, end, trip_ids, stop_ids
+                )
+                for start, end in ranges
+            ]
+        else:
+            with pool:
+                futures = [
+                    pool.submit(
+                        read_stop_times_chunk,
+                        path,
+                        column_names,
+                        start,
+                        end,
+                        trip_ids,
+                        stop_ids,
+                    )
+                    for start, end in ranges
+                ]
+                chunks = [future.result() for future in futures]
+
+    return encode_ids(chunks, GTFS_SCHEMAS["stop_times.txt"])
+
+
+def decode_ids(table: pa.Table) -> pa.Table:
+    """Replace dictionary encoded ids with plain strings"""
+
+    return pa.Table.from_arrays(
+        [
+            column.cast(pa.string()) if pa.types.is_dictionary(column.type) else column
+            for column in table.columns
+        ],
+        names=table.column_names,
+    )
@@ -0,0 +1,206 @@
+from array import array
+from typing import Collection, Dict, Optional
+from google.transit.gtfs_realtime_pb2 import FeedHeader, FeedMessage
+import numpy as np
+
+VEHICLE_POSITIONS_URL = "https://cdn.mbta.com/realtime/VehiclePositions.pb"
+TRIP_UPDATES_URL = "https://cdn.mbta.com/realtime/TripUpdates.pb"
+
+
+def feed_header_timestamp(content: bytes) -> int:
+    """Read FeedHeader.timestamp without decoding the entities
+
+    The header is field 1 of FeedMessage and is written first, so only its bytes
+    are parsed. Anything unexpected falls back to decoding the whole message.
+    """
+
+    # Field 1 with wire type 2 (length-delimited)
+    if content[:1] == b"\x0a":
+        length, shift, position = 0, 0, 1
+        while position < len(content):
+            byte = content[position]
+            length |= (byte & 0x7F) << shift
+            position += 1
+            if not byte & 0x80:
+                return FeedHeader.FromString(
+                    content[position : position + length]
+                ).timestamp
+            shift += 7
+
+    message = FeedMessage()
+    message.ParseFromString(content)
+
+    return message.header.timestamp
+
+
+def decode_vehicle_positions(
+    content: bytes, route_ids: Optional[Collection[str]]
+) -> Dict[str, np.ndarray]:
+    """Decode a VehiclePositions feed into typed column arrays
+
+    The feed is walked once and entities whose route_id is not in route_ids are
+    skipped before any other field is read. Pass route_ids=None to keep every
+    vehicle. Timestamps are left as POSIX seconds.
+    """
+
+    message = FeedMessage()
+    message.ParseFromString(content)
+
+    ids = []
+    trip_ids = []
+    start_times = []
+    start_dates = []
+    schedule_relationships = array("l")
+    route_ids_out = []
+    direction_ids = array("l")
+    latitudes = array("d")
+    longitudes = array("d")
+    bearings = array("d")
+    speeds = array("d")
+    current_stops = array("l")
+    current_statuses = array("l")
+    timestamps = array("q")
+    stop_ids = []
+    vehicle_ids = []
+    labels = []
+
+    for entity in message.entity:
+        vehicle = entity.vehicle
+        trip = vehicle.trip
+        route_id = trip.route_id
+
+        # Drop vehicles on other routes before touching their other fields
+        if route_ids is not None and route_id not in route_ids:
+            continue
+
+        position = vehicle.position
+        descriptor = vehicle.vehicle
+
+        ids.append(entity.id)
+        trip_ids.append(trip.trip_id)
+        start_times.append(trip.start_time)
+        start_dates.append(trip.start_date)
+        schedule_relationships.append(trip.schedule_relationship)
+        route_ids_out.append(route_id)
+        direction_ids.append(trip.direction_id)
+        latitudes.append(position.latitude)
+        longitudes.append(position.longitude)
+        bearings.append(position.bearing)
+        speeds.append(position.speed)
+        current_stops.append(vehicle.current_stop_sequence)
+        current_statuses.append(vehicle.current_status)
+        timestamps.append(vehicle.timestamp)
+        stop_ids.append(vehicle.stop_id)
+        vehicle_ids.append(descriptor.id)
+        labels.append(descriptor.label)
+
+    return {
+        "id": np.array(ids, dtype=object),
+        "trip_id": np.array(trip_ids, dtype=object),
+        "start_time": np.array(start_times, dtype=object),
+        "start_date": np.array(start_dates, dtype=object),
+        "schedule_relationship": np.frombuffer(schedule_relationships, dtype=np.int_),
+        "route_id": np.array(route_ids_out, dtype=object),
+        "direction_id": np.frombuffer(direction_ids, dtype=np.int_),
+        "latitude": np.frombuffer(latitudes, dtype=np.float64),
+        "longitude": np.frombuffer(longitudes, dtype=np.float64),
+        "bearing": np.frombuffer(bearings, dtype=np.float64),
+        "speed": np.frombuffer(speeds, dtype=np.float64),
+        "current_stop": np.frombuffer(current_stops, dtype=np.int_),
+        "current_status": np.frombuffer(current_statuses, dtype=np.int_),
+        "timestamp": np.frombuffer(timestamps, dtype=np.int64),
+        "stop_id": np.array(stop_ids, dtype=object),
+        "vehicle": np.array(vehicle_ids, dtype=object),
+        "label": np.array(labels, dtype=object),
+    }
+
+
+def decode_trip_updates(
+    content: bytes, route_ids: Optional[Collection[str]]
+) -> Dict[str, np.ndarray]:
+    """Decode a TripUpdates feed into one row per StopTimeUpdate
+
+    Trips whose route_id is not in route_ids are skipped like in
+    decode_vehicle_positions. Arrival and departure delays and times are NaN
+    where the feed leaves them out. Times are POSIX seconds.
+    """
+
+    message = FeedMessage()
+    message.ParseFromString(content)
+
+    trip_ids = []
+    route_ids_out = []
+    direction_ids = array("l")
+    start_dates = []
+    vehicle_ids = []
+    stop_ids = []
+    stop_sequences = array("l")
+    schedule_relationships = array("l")
+    arrival_delays = array("d")
+    arrival_times = array("d")
+    departure_delays = array("d")
+    departure_times = array("d")
+
+    nan = float("nan")
+
+    for entity in message.entity:
+        if not entity.HasField("trip_update"):
+            continue
+
+        trip_update = entity.trip_update
+        trip = trip_update.trip
+        route_id = trip.route_id
+
+        # Drop trips on other routes before touching their stop time updates
+        if route_ids is not None and route_id not in route_ids:
+            continue
+
+        trip_id = trip.trip_id
+        direction_id = trip.direction_id
+        start_date = trip.start_date
+        vehicle_id = trip_update.vehicle.id
+
+        for update in trip_update.stop_time_update:
+            trip_ids.append(trip_id)
+            route_ids_out.append(route_id)
+            direction_ids.append(direction_id)
+            start_dates.append(start_date)
+            vehicle_ids.append(vehicle_id)
+            stop_ids.append(update.stop_id)
+            stop_sequences.append(update.stop_sequence)
+            schedule_relationships.append(update.schedule_relationship)
+
+            arrival = update.arrival
+            has_arrival = update.HasField("arrival")
+            arrival_delays.append(
+                arrival.delay if has_arrival and arrival.HasField("delay") else nan
+            )
+            arrival_times.append(
+                arrival.time if has_arrival and arrival.HasField("time") else nan
+            )
+
+            departure = update.departure
+            has_departure = update.HasField("departure")
+            departure_delays.append(
+                departure.delay
+                if has_departure and departure.HasField("delay")
+                else nan
+            )
+            departure_times.append(
+                departure.time if has_departure and departure.HasField("time") else nan
+            )
+
+    return {
+        "trip_id": np.array(trip_ids, dtype=object),
+        "route_id": np.array(route_ids_out, dtype=object),
+        "direction_id": np.frombuffer(direction_ids, dtype=np.int_),
+        "start_date": np.array(start_dates, dtype=object),
+        "vehicle": np.array(vehicle_ids, dtype=object),
+        "stop_id": np.array(stop_ids, dtype=object),
+        "stop_sequence": np.frombuffer(stop_sequences, dtype=np.int_),
+        "schedule_relationship": np.frombuffer(schedule_relationships, dtype=np.int_),
+        "arrival_delay": np.frombuffer(arrival_delays, dtype=np.float64),
+        "arrival_time": np.frombuffer(arrival_times, dtype=np.float64),
+        "departure_delay": np.frombuffer(departure_delays, dtype=np.float64),
+        "departure_time": np.frombuffer(departure_times, dtype=np.float64),
+    }
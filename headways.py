@@ -0,0 +1,219 @@
+from collections import deque
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+import json
+import numpy as np
+import pandas as pd
+from prefect import task
+from state_file import write_json_atomic
+from subway_locations_schedules import service_day_start, tz
+
+# VehicleStopStatus of a vehicle standing at its stop
+STOPPED_AT = 1
+
+# Columns of the headways emitted for each snapshot
+HEADWAY_COLUMNS = [
+    "route_id",
+    "stop_id",
+    "stop_name",
+    "direction_id",
+    "trip_id",
+    "vehicle",
+    "arrival",
+    "headway_s",
+    "scheduled_headway_s",
+    "bunched",
+]
+
+
+class HeadwayTracker:
+    """Observed and scheduled headways between trains at each stop
+
+    The last depth arrivals at each (stop_id, direction_id) are kept in a ring
+    buffer. A vehicle arrives at a stop the first time it is seen stopped there,
+    or when it is next seen heading further along its trip without having been
+    seen stopped. Each update only touches the buffers of the vehicles passed
+    in, so the work follows the vehicles that changed and not the day's
+    history. A train arriving less than bunching_ratio of the scheduled headway
+    after the one before is bunched.
+    """
+
+    def __init__(
+        self,
+        depth: int = 8,
+        bunching_ratio: float = 0.5,
+        state_path: Optional[str] = None,
+    ):
+        self.depth = depth
+        self.bunching_ratio = bunching_ratio
+        self.state_path = Path(state_path) if state_path is not None else None
+
+        # (stop_id, direction_id) -> (arrival, scheduled arrival, trip_id) tuples
+        self.arrivals: Dict[Tuple[str, int], deque] = {}
+
+        # vehicle -> the stop it was last seen at or heading to
+        self.vehicles: Dict[str, dict] = {}
+
+        if self.state_path is not None and self.state_path.exists():
+            with open(self.state_path) as state_file:
+                state = json.load(state_file)
+
+            self.arrivals = {
+                (stop_id, direction_id): deque(map(tuple, arrivals), maxlen=self.depth)
+                for stop_id, direction_id, arrivals in state["arrivals"]
+            }
+            self.vehicles = state["vehicles"]
+
+    def update(self, compare: pd.DataFrame) -> pd.DataFrame:
+        """Record the arrivals of one snapshot of matched vehicles
+
+        compare is laid out like ScheduleIndex.lookup. Returns one row of
+        HEADWAY_COLUMNS per arrival that follows an earlier one at its stop.
+        """
+
+        headways = []
+        if compare.empty:
+            return pd.DataFrame(headways, columns=HEADWAY_COLUMNS)
+
+        # Scheduled arrivals and vehicle timestamps as POSIX seconds
+        scheduled = service_day_start(compare["service_date"]) + compare[
+            "arrival_s"
+        ].to_numpy(dtype=np.int64)
+        timestamp = (
+            compare["timestamp"].to_numpy(dtype="datetime64[s]").astype(np.int64)
+        )
+
+        # Arrivals are recorded in the order they happened
+        order = np.argsort(timestamp, kind="stable")
+        columns = {
+            name: compare[name].to_numpy()[order]
+            for name in [
+                "route_id",
+                "stop_id_x",
+                "stop_name",
+                "direction_id",
+                "trip_id",
+                "vehicle",
+                "current_status",
+            ]
+        }
+
+        for row in range(len(order)):
+            vehicle = columns["vehicle"][row]
+            stop = {
+                "route_id": columns["route_id"][row],
+                "stop_id": columns["stop_id_x"][row],
+                "stop_name": columns["stop_name"][row],
+                "direction_id": int(columns["direction_id"][row]),
+                "trip_id": columns["trip_id"][row],
+                "scheduled": int(scheduled[order[row]]),
+                "arrived": False,
+            }
+            now = int(timestamp[order[row]])
+
+            # A stop the vehicle moved on from without being seen stopped at it
+            previous = self.vehicles.get(vehicle)
+            same_stop = (
+                previous is not None
+                and previous["trip_id"] == stop["trip_id"]
+                and previous["stop_id"] == stop["stop_id"]
+            )
+            if (
+                previous is not None
+                and previous["trip_id"] == stop["trip_id"]
+                and not same_stop
+                and not previous["arrived"]
+            ):
+                headways.append(self.arrive(previous, vehicle, now))
+
+            if same_stop:
+                stop["arrived"] = previous["arrived"]
+            if columns["current_status"][row] == STOPPED_AT and not stop["arrived"]:
+                headways.append(self.arrive(stop, vehicle, now))
+                stop["arrived"] = True
+
+            self.vehicles[vehicle] = stop
+
+        return pd.DataFrame(
+            [headway for headway in headways if headway is not None],
+            columns=HEADWAY_COLUMNS,
+        )
+
+    def arrive(self, stop: dict, vehicle: str, now: int) -> Optional[dict]:
+        """Add an arrival to the buffer of its stop and return its headway
+
+        Returns None for the first arrival at a stop, and for a trip that was
+        already recorded there.
+        """
+
+        key = (stop["stop_id"], stop["direction_id"])
+        arrivals = self.arrivals.setdefault(key, deque(maxlen=self.depth))
+        if any(trip_id == stop["trip_id"] for _, _, trip_id in arrivals):
+            return None
+
+        previous = arrivals[-1] if arrivals else None
+        arrivals.append((now, stop["scheduled"], stop["trip_id"]))
+        if previous is None:
+            return None
+
+        headway = now - previous[0]
+        scheduled_headway = stop["scheduled"] - previous[1]
+
+        return {
+            "route_id": stop["route_id"],
+            "stop_id": stop["stop_id"],
+            "stop_name": stop["stop_name"],
+            "direction_id": stop["direction_id"],
+            "trip_id": stop["trip_id"],
+            "vehicle": vehicle,
+            "arrival": pd.Timestamp(now, unit="s", tz="UTC").tz_convert(tz),
+            "headway_s": headway,
+            "scheduled_headway_s": scheduled_headway,
+            "bunched": 0 < headway < self.bunching_ratio * scheduled_headway,
+        }
+
+    def save(self) -> None:
+        """Write the arrival buffers and vehicle stops to state_path"""
+
+        if self.state_path is None:
+            return None
+
+        state = {
+            "arrivals": [
+                [stop_id, direction_id, [list(arrival) for arrival in arrivals]]
+                for (stop_id, direction_id), arrivals in self.arrivals.items()
+            ],
+            "vehicles": self.vehicles,
+        }
+
+        write_json_atomic(self.state_path, state)
+
+        return None
+
+
+def report_bunching(headways: pd.DataFrame) -> None:
+    """Print an alert for every bunched arrival"""
+
+    for headway in headways[headways["bunched"]].itertuples():
+        print(
+            f"Bunching on {headway.route_id} at {headway.stop_name}"
+            f" (direction {headway.direction_id}): {headway.headway_s / 60:.1f} min"
+            f" behind the train before, {headway.scheduled_headway_s / 60:.1f} min"
+            " scheduled"
+        )
+
+    return None
+
+
+@task(log_prints=True)
+def track_headways(compare: pd.DataFrame, state_path: str) -> pd.DataFrame:
+    """Update the headways kept at state_path with one snapshot of matched vehicles"""
+
+    tracker = HeadwayTracker(state_path=state_path)
+    headways = tracker.update(compare)
+    tracker.save()
+
+    print(f"{len(headways)} headways, {int(headways['bunched'].sum())} bunched")
+    report_bunching(headways)
+
+    return headways
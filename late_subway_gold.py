@@ -1,29 +1,55 @@
 from google.cloud import storage
+import numpy as np
 import pandas as pd
-from io import StringIO
+import pyarrow as pa
+import pyarrow.parquet as pq
 from prefect import task, flow
 from prefect_gcp.cloud_storage import GcsBucket
 from pathlib import Path
 import os
 
-client = storage.Client()
+
+# Display strings are looked up instead of formatted row by row
+CLOCK_TIMES = np.array(
+    [
+        f"{hour:02d}:{minute:02d} {'AM' if hour < 12 else 'PM'}"
+        for hour in range(24)
+        for minute in range(60)
+    ],
+    dtype=object,
+)
+LATE_TIMES = np.array(
+    [f"{minute:02d}:{second:02d}" for minute in range(60) for second in range(61)],
+    dtype=object,
+)
+LATE_BY = np.array(
+    [
+        f"{minute:02d} minutes and {second:02d} seconds"
+        for minute in range(60)
+        for second in range(61)
+    ],
+    dtype=object,
+)
 
 
 @task
-def read_csvfile(bucket_name: str, file_path: str):
+def read_parquetfile(bucket_name: str, file_path: str) -> bytes:
     """Retrieve GCS bucket content"""
 
+    # The client is made when the flow runs, so importing the module needs no
+    # credentials
+    client = storage.Client()
     bucket = client.bucket(bucket_name)
-    content = bucket.blob(file_path).download_as_string().decode("utf-8")
+    content = bucket.blob(file_path).download_as_bytes()
 
     return content
 
 
 @task
-def access_dataframe_from_gcsbucket(dataframe: pd.DataFrame):
-    """Reads the GCS bucket csv file and converts to a Pandas DataFrame"""
+def access_dataframe_from_gcsbucket(content: bytes) -> pd.DataFrame:
+    """Reads the GCS bucket parquet file and converts to a Pandas DataFrame"""
 
-    dataframe = pd.read_csv(StringIO(dataframe))
+    dataframe = pq.read_table(pa.BufferReader(content)).to_pandas()
 
     return dataframe
 
@@ -38,36 +64,25 @@ def transform_dataframe(
     column5: str,
 ):
     """Make changes to the dataframe to improve the visuals of the map"""
-    dataframe[column1] = dataframe[column1].apply(
-        lambda x: pd.to_datetime(x, format=("%H:%M:%S"))
-    )
-
-    dataframe[column1] = dataframe[column1].apply(lambda x: x.strftime("%H:%M %p"))
 
-    dataframe[column2] = dataframe[column2].apply(
-        lambda x: pd.to_datetime(x, format="%Y-%m-%d %H:%M:%S.%f")
+    # Scheduled time of day as minutes since midnight
+    microseconds = (
+        pa.array(dataframe[column1], type=pa.time64("us")).cast(pa.int64()).to_numpy()
     )
+    dataframe[column1] = CLOCK_TIMES[microseconds // 60_000_000]
 
-    dataframe[column3] = dataframe[column3].apply(
-        lambda x: pd.to_datetime(x, format="%Y-%m-%d %H:%M:%S.%f")
-    )
+    # Timestamps are stored in UTC, show them in the local time of the MBTA
+    dataframe[column2] = dataframe[column2].dt.tz_convert("US/Eastern")
 
-    dataframe[column4] = dataframe[column3] - dataframe[column2]
+    dataframe[column3] = dataframe[column3].dt.tz_convert("US/Eastern")
 
-    dataframe[column4] = (
-        dataframe[column4]
-        .dt.total_seconds()
-        .apply(lambda s: f"{(s % 3600) // 60:02.0f}:{s % 60:02.0f}")
-    )
+    # Minutes within the hour and seconds rounded half to even, which can be 60
+    seconds = (dataframe[column3] - dataframe[column2]).dt.total_seconds().to_numpy()
+    late = (seconds % 3600 // 60).astype(int) * 61 + np.round(seconds % 60).astype(int)
 
-    dataframe[column5] = dataframe[column4].astype(str)
+    dataframe[column4] = LATE_TIMES[late]
 
-    dataframe[column5] = (
-        dataframe[column5].str[:2]
-        + " minutes and "
-        + dataframe[column5].str[3:]
-        + " seconds"
-    )
+    dataframe[column5] = LATE_BY[late]
 
     return dataframe
 
@@ -84,18 +99,11 @@ def load_late_subways_gold_to_gcs(
     return None
 
 
-@flow
-def gold_flow(
-    bucket_name: str = "subway-mbta-location",
-    file_path: str = "late_subways.csv",
-    prefect_gcs_block_name: str = "subway-gcs-bucket",
-):
-    data = read_csvfile(bucket_name=bucket_name, file_path=file_path)
-
-    csv_data = access_dataframe_from_gcsbucket(dataframe=data)
+def write_gold(late_subways: pd.DataFrame, prefect_gcs_block_name: str) -> None:
+    """Transform the late subways and upload the gold file, called from a flow"""
 
-    gold_csv = transform_dataframe(
-        dataframe=csv_data,
+    gold = transform_dataframe(
+        dataframe=late_subways,
         column1="arrival_time",
         column2="arrival_time_fixed",
         column3="timestamp",
@@ -103,15 +111,30 @@ def gold_flow(
         column5="late by",
     )
 
-    gold_csv.to_csv("late_subways_gold.csv", index=False)
+    gold.to_parquet("late_subways_gold.parquet", index=False)
 
     load_late_subways_gold_to_gcs(
-        wait_for=[gold_csv],
-        late_subways_path="late_subways_gold.csv",
+        wait_for=[gold],
+        late_subways_path="late_subways_gold.parquet",
         prefect_gcs_block_name=prefect_gcs_block_name,
     )
 
-    os.remove("late_subways_gold.csv")
+    os.remove("late_subways_gold.parquet")
+
+    return None
+
+
+@flow
+def gold_flow(
+    bucket_name: str = "subway-mbta-location",
+    file_path: str = "late_subways.parquet",
+    prefect_gcs_block_name: str = "subway-gcs-bucket",
+):
+    data = read_parquetfile(bucket_name=bucket_name, file_path=file_path)
+
+    late_subways = access_dataframe_from_gcsbucket(content=data)
+
+    write_gold(late_subways, prefect_gcs_block_name)
 
 
 if __name__ == "__main__":
@@ -2,12 +2,20 @@ from subway_locations import flow_live_locations_subway
 from subway_locations_schedules import subway_times
 from write_bigquery_table import write_subways_to_bigquery
 from late_subway_gold import gold_flow
+from pipeline import in_memory_pipeline
 from prefect import flow
 
 
 @flow
-def main_flow():
-    """Flow that encompasses four other Prefect flows"""
+def main_flow(in_memory: bool = True):
+    """Flow that encompasses four other Prefect flows
+
+    By default the stages run in memory and only write their results at the end.
+    Set in_memory to False to chain the separate flows through GCS instead.
+    """
+
+    if in_memory:
+        return in_memory_pipeline()
 
     # Get the live subway data
     live = flow_live_locations_subway()
@@ -0,0 +1,205 @@
+from pathlib import Path
+import os
+import pyarrow as pa
+import pyarrow.parquet as pq
+from prefect import flow, task
+from prefect_gcp import GcpCredentials
+from prefect_gcp.bigquery import bigquery_load_file
+from gtfs_realtime import TRIP_UPDATES_URL
+from headways import track_headways
+from late_subway_gold import write_gold
+from schedule_index import ScheduleIndex
+from storage_format import DEFAULT_STORAGE_FORMAT
+from subway_locations import (
+    live_locations_storage,
+    live_locations_subway,
+    load_live_locations_subway_to_gcs,
+)
+from subway_locations_schedules import (
+    calculate_subway_lateness,
+    combine_live_trips_with_schedule,
+    load_late_subways_to_gcs,
+    predicted_delays,
+    schedule_from_gcs,
+    trip_updates_from_mbta,
+)
+from vehicle_history import append_live_locations_history
+from write_bigquery_table import (
+    DATASET,
+    LATE_SUBWAYS_SCHEMA,
+    STAGING_TABLE,
+    late_subways_table,
+    merge_late_subways,
+    stream_subways_to_bigquery,
+)
+
+
+@task(log_prints=True)
+def live_locations_stage(
+    dedup_state_path: str, dedup_window_seconds: int, schedule_index: ScheduleIndex
+) -> pa.Table:
+    """Fetch the vehicle positions that changed as an Arrow table
+
+    Only vehicles on the routes of the schedule are decoded.
+    """
+
+    live_locations = live_locations_subway(
+        dedup_state_path,
+        dedup_window_seconds,
+        schedule_index.schedule.route_ids(),
+    )
+
+    return pa.Table.from_pandas(live_locations, preserve_index=False)
+
+
+@task(log_prints=True)
+def schedule_index_stage(
+    current_schedule_filename: str, prefect_gcs_block_name: str, storage_format: str
+) -> ScheduleIndex:
+    """Load today's schedule from the local cache and index it in memory"""
+
+    schedule_today = schedule_from_gcs.fn(
+        current_schedule_filename,
+        prefect_gcs_block_name,
+        storage_format=storage_format,
+    )
+
+    return ScheduleIndex(schedule_today)
+
+
+@task(log_prints=True)
+def late_subways_stage(
+    live_locations: pa.Table,
+    schedule_index: ScheduleIndex,
+    use_trip_updates: bool,
+    trip_updates_url: str,
+    headway_state_path: str,
+) -> pa.Table:
+    """Match the live locations to the schedule and keep the late subways
+
+    The late subways are returned typed and laid out like the BigQuery table.
+    Headways between the matched trains are tracked along the way.
+    """
+
+    compare = combine_live_trips_with_schedule.fn(
+        schedule_index=schedule_index, live_locations=live_locations.to_pandas()
+    )
+
+    delays = None
+    if use_trip_updates:
+        delays = predicted_delays.fn(
+            trip_updates=trip_updates_from_mbta.fn(
+                route_ids=schedule_index.schedule.route_ids(),
+                trip_updates_url=trip_updates_url,
+            ),
+            schedule_index=schedule_index,
+        )
+
+    late_subways = calculate_subway_lateness.fn(
+        compare=compare, predicted_delays=delays
+    )
+
+    print(f"{len(late_subways)} late subways")
+
+    # Headways follow every matched vehicle, not only the late ones
+    track_headways.fn(compare, headway_state_path)
+
+    return late_subways_table(late_subways)
+
+
+@flow
+def in_memory_pipeline(
+    prefect_gcs_block_name: str = "subway-gcs-bucket",
+    current_schedule_filename: str = "schedule_today",
+    live_locations_filename: str = "live_location_subway",
+    dedup_state_path: str = "realtime_dedup.json",
+    dedup_window_seconds: int = 900,
+    headway_state_path: str = "headways.json",
+    history_root: str = "gs://subway-mbta-location/vehicle_history",
+    use_trip_updates: bool = True,
+    trip_updates_url: str = TRIP_UPDATES_URL,
+    gcp_credentials_block_name: str = "subway-credentials",
+    gcp_project_id: str = "subway-mbta",
+    storage_format: str = DEFAULT_STORAGE_FORMAT,
+    use_storage_write_api: bool = True,
+    stream_state_path: str = "bigquery_stream.json",
+):
+    """Run the main flow in one process, writing to GCS and BigQuery only at the end
+
+    Stages hand Arrow tables to each other in memory instead of uploading and
+    downloading files between flows. The files the separate flows read are still
+    written, so they keep working as a fallback.
+    """
+
+    schedule_index = schedule_index_stage(
+        current_schedule_filename, prefect_gcs_block_name, storage_format
+    )
+    live_locations = live_locations_stage(
+        dedup_state_path, dedup_window_seconds, schedule_index
+    )
+
+    late_subways = late_subways_stage(
+        live_locations=live_locations,
+        schedule_index=schedule_index,
+        use_trip_updates=use_trip_updates,
+        trip_updates_url=trip_updates_url,
+        headway_state_path=headway_state_path,
+    )
+
+    # Sink the live locations to the history store and the bucket
+    live_locations_format = live_locations_storage(storage_format)
+    live_locations_path = f"{live_locations_filename}{live_locations_format.suffix}"
+    live_locations_format.write(live_locations, live_locations_path)
+
+    append_live_locations_history(
+        live_locations_path=live_locations_path, history_root=history_root
+    )
+
+    load_live_locations_subway_to_gcs(
+        wait_for=[append_live_locations_history],
+        prefect_gcs_block_name=prefect_gcs_block_name,
+        from_path=live_locations_path,
+        to_path=f"live_location/{live_locations_path}",
+    )
+
+    # Sink the late subways to the bucket, BigQuery and the gold file
+    late_subways_path = Path("late_subways.parquet")
+    pq.write_table(late_subways, late_subways_path)
+
+    load_late_subways_to_gcs(
+        late_subways_path=late_subways_path,
+        prefect_gcs_block_name=prefect_gcs_block_name,
+    )
+
+    gcp_credentials = GcpCredentials.load(gcp_credentials_block_name)
+    if use_storage_write_api:
+        staged = stream_subways_to_bigquery(
+            late_subways=late_subways,
+            gcp_credentials=gcp_credentials,
+            gcp_project_id=gcp_project_id,
+            stream_state_path=stream_state_path,
+        )
+    else:
+        staged = bigquery_load_file(
+            dataset=DATASET,
+            table=STAGING_TABLE,
+            path=late_subways_path,
+            schema=LATE_SUBWAYS_SCHEMA,
+            gcp_credentials=gcp_credentials,
+            project=gcp_project_id,
+            job_config={"source_format": "PARQUET", "autodetect": False},
+        )
+
+    merge_late_subways(
+        wait_for=[staged],
+        gcp_credentials=gcp_credentials,
+        gcp_project_id=gcp_project_id,
+    )
+
+    write_gold(late_subways.to_pandas(), prefect_gcs_block_name)
+
+    os.remove(late_subways_path)
+
+
+if __name__ == "__main__":
+    in_memory_pipeline()
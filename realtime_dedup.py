@@ -0,0 +1,100 @@
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional
+import json
+import numpy as np
+from state_file import write_json_atomic
+
+
+class SnapshotDeduplicator:
+    """Drop realtime snapshots and vehicle positions that were already seen
+
+    Snapshots are keyed on FeedHeader.timestamp and vehicles on
+    (vehicle.id, timestamp). Keys older than window_seconds, measured against the
+    newest header timestamp, are evicted, and at most max_keys vehicle keys are
+    kept.
+    """
+
+    def __init__(
+        self,
+        window_seconds: int = 900,
+        max_keys: int = 100000,
+        state_path: Optional[str] = None,
+    ):
+        self.window_seconds = window_seconds
+        self.max_keys = max_keys
+        self.state_path = Path(state_path) if state_path is not None else None
+        self.header_timestamps = OrderedDict()
+        self.vehicle_keys = OrderedDict()
+
+        if self.state_path is not None and self.state_path.exists():
+            with open(self.state_path) as state_file:
+                state = json.load(state_file)
+
+            self.header_timestamps = OrderedDict.fromkeys(state["header_timestamps"])
+            self.vehicle_keys = OrderedDict(
+                ((vehicle, timestamp), timestamp)
+                for vehicle, timestamp in state["vehicle_keys"]
+            )
+
+    def is_new_snapshot(self, header_timestamp: int) -> bool:
+        """Record the header timestamp and return whether it was new"""
+
+        if header_timestamp in self.header_timestamps:
+            return False
+
+        self.header_timestamps[header_timestamp] = None
+        self.evict(header_timestamp)
+
+        return True
+
+    def new_vehicles(self, columns: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+        """Keep only the vehicle positions that have not been seen before"""
+
+        keep = np.zeros(len(columns["vehicle"]), dtype=bool)
+
+        for row, key in enumerate(zip(columns["vehicle"], columns["timestamp"])):
+            vehicle, timestamp = key[0], int(key[1])
+
+            if (vehicle, timestamp) not in self.vehicle_keys:
+                self.vehicle_keys[(vehicle, timestamp)] = timestamp
+                keep[row] = True
+
+        # Keep the number of remembered keys bounded, oldest first
+        while len(self.vehicle_keys) > self.max_keys:
+            self.vehicle_keys.popitem(last=False)
+
+        return {name: column[keep] for name, column in columns.items()}
+
+    def evict(self, newest_timestamp: int) -> None:
+        """Forget keys that fall outside the time window"""
+
+        cutoff = newest_timestamp - self.window_seconds
+
+        for header_timestamp in list(self.header_timestamps):
+            if header_timestamp < cutoff:
+                del self.header_timestamps[header_timestamp]
+
+        # Keys are roughly in arrival order, so stop at the first recent one
+        while self.vehicle_keys:
+            key, timestamp = next(iter(self.vehicle_keys.items()))
+            if timestamp >= cutoff:
+                break
+            del self.vehicle_keys[key]
+
+        return None
+
+    def save(self) -> None:
+        """Write the remembered keys to state_path"""
+
+        if self.state_path is None:
+            return None
+
+        state = {
+            "header_timestamps": list(self.header_timestamps),
+            "vehicle_keys": [list(key) for key in self.vehicle_keys],
+        }
+
+        write_json_atomic(self.state_path, state)
+
+        return None
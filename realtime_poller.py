@@ -0,0 +1,231 @@
+from datetime import datetime
+from http import HTTPStatus
+from typing import Callable, Optional
+import asyncio
+import httpx
+from prefect_gcp import GcpCredentials
+from gtfs_realtime import (
+    TRIP_UPDATES_URL,
+    VEHICLE_POSITIONS_URL,
+    decode_trip_updates,
+    decode_vehicle_positions,
+    feed_header_timestamp,
+)
+from bigquery_stream import LateSubwaysStreamSink
+from headways import HeadwayTracker, report_bunching
+from realtime_dedup import SnapshotDeduplicator
+from schedule_index import ScheduleIndex
+from storage_format import DEFAULT_STORAGE_FORMAT
+from subway_locations import live_locations_frame
+from subway_locations_schedules import (
+    calculate_subway_lateness,
+    combine_live_trips_with_schedule,
+    predicted_delays,
+    schedule_from_gcs,
+    tz,
+)
+from write_bigquery_table import (
+    late_subways_stream_sink,
+    late_subways_table,
+    merge_late_subways,
+)
+
+
+class FeedPoller:
+    """Fetch a GTFS-realtime feed, skipping responses that have not changed"""
+
+    def __init__(self, client: httpx.AsyncClient, url: str):
+        self.client = client
+        self.url = url
+        self.last_modified = None
+        self.header_timestamp = None
+
+    async def fetch(self) -> Optional[bytes]:
+        """Return the feed if it is newer than the last one, otherwise None"""
+
+        headers = {}
+        if self.last_modified is not None:
+            headers["If-Modified-Since"] = self.last_modified
+
+        response = await self.client.get(self.url, headers=headers)
+
+        if response.status_code == HTTPStatus.NOT_MODIFIED:
+            return None
+
+        response.raise_for_status()
+
+        self.last_modified = response.headers.get("Last-Modified", self.last_modified)
+
+        # The CDN can serve the same snapshot again with a new Last-Modified
+        header_timestamp = feed_header_timestamp(response.content)
+        if header_timestamp == self.header_timestamp:
+            return None
+
+        self.header_timestamp = header_timestamp
+
+        return response.content
+
+
+async def poll_feeds(
+    on_snapshot: Callable[[str, bytes], None],
+    interval: float = 10,
+    include_trip_updates: bool = False,
+    vehicle_positions_url: str = VEHICLE_POSITIONS_URL,
+    trip_updates_url: str = TRIP_UPDATES_URL,
+    max_polls: Optional[int] = None,
+) -> None:
+    """Poll the realtime feeds on an interval and pass each new snapshot on
+
+    One pooled HTTP/2 client is kept open for the whole loop, so each poll reuses
+    the TLS connection. on_snapshot is called with the feed name
+    ("vehicle_positions" or "trip_updates") and the raw feed bytes. Errors raised
+    by on_snapshot are printed and do not stop the loop.
+    """
+
+    async with httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(interval),
+        limits=httpx.Limits(max_keepalive_connections=2),
+    ) as client:
+        pollers = {"vehicle_positions": FeedPoller(client, vehicle_positions_url)}
+        if include_trip_updates:
+            pollers["trip_updates"] = FeedPoller(client, trip_updates_url)
+
+        loop = asyncio.get_running_loop()
+        polls = 0
+
+        while max_polls is None or polls < max_polls:
+            started = loop.time()
+
+            results = await asyncio.gather(
+                *(poller.fetch() for poller in pollers.values()),
+                return_exceptions=True,
+            )
+
+            for feed_name, content in zip(pollers, results):
+                # A failed poll is retried on the next interval
+                if isinstance(content, Exception):
+                    print(f"Polling {feed_name} failed: {content!r}")
+                    continue
+                if content is None:
+                    continue
+
+                # A snapshot that fails to process is skipped, polling goes on
+                try:
+                    on_snapshot(feed_name, content)
+                except Exception as error:
+                    print(f"Processing {feed_name} failed: {error!r}")
+
+            polls += 1
+            await asyncio.sleep(max(0, interval - (loop.time() - started)))
+
+    return None
+
+
+class LatenessStage:
+    """Compute late subways for each vehicle positions snapshot in-process
+
+    The schedule is downloaded once per service day instead of once per run. The
+    latest TripUpdates predictions are kept and preferred over the position-based
+    lateness of the stops they cover. If a sink is given the late subways of each
+    snapshot are streamed to BigQuery through it. The headways of each snapshot
+    are kept in self.headways and bunched trains are reported.
+    """
+
+    def __init__(
+        self,
+        current_schedule_filename: str = "schedule_today",
+        prefect_gcs_block_name: str = "subway-gcs-bucket",
+        dedup_window_seconds: int = 900,
+        storage_format: str = DEFAULT_STORAGE_FORMAT,
+        sink: Optional[LateSubwaysStreamSink] = None,
+    ):
+        self.deduplicator = SnapshotDeduplicator(window_seconds=dedup_window_seconds)
+        self.current_schedule_filename = current_schedule_filename
+        self.prefect_gcs_block_name = prefect_gcs_block_name
+        self.storage_format = storage_format
+        self.service_date = None
+        self.schedule_index = None
+        self.route_ids = None
+        self.delays = None
+        self.late_subways = None
+        self.headway_tracker = HeadwayTracker()
+        self.headways = None
+        self.sink = sink
+
+    def schedule(self) -> ScheduleIndex:
+        """Return the schedule index of the current service day"""
+
+        service_date = datetime.now(tz).date()
+
+        if service_date != self.service_date:
+            schedule_today = schedule_from_gcs.fn(
+                self.current_schedule_filename,
+                self.prefect_gcs_block_name,
+                storage_format=self.storage_format,
+            )
+            self.schedule_index = ScheduleIndex(schedule_today)
+            self.route_ids = schedule_today.route_ids()
+            self.service_date = service_date
+
+        return self.schedule_index
+
+    def __call__(self, feed_name: str, content: bytes) -> None:
+        # Only the routes of the schedule are decoded from either feed
+        schedule_index = self.schedule()
+
+        if feed_name == "trip_updates":
+            self.delays = predicted_delays.fn(
+                trip_updates=decode_trip_updates(content, self.route_ids),
+                schedule_index=schedule_index,
+            )
+            return None
+
+        if feed_name != "vehicle_positions":
+            return None
+
+        if not self.deduplicator.is_new_snapshot(feed_header_timestamp(content)):
+            return None
+
+        # Only vehicles whose position changed need their lateness recomputed
+        live_locations = live_locations_frame(
+            self.deduplicator.new_vehicles(
+                decode_vehicle_positions(content, self.route_ids)
+            )
+        )
+
+        compare = combine_live_trips_with_schedule.fn(
+            schedule_index=schedule_index, live_locations=live_locations
+        )
+        self.late_subways = calculate_subway_lateness.fn(
+            compare=compare, predicted_delays=self.delays
+        )
+
+        print(f"{len(self.late_subways)} late subways")
+
+        # Headways follow every matched vehicle, not only the late ones
+        self.headways = self.headway_tracker.update(compare)
+        report_bunching(self.headways)
+
+        if self.sink is not None:
+            self.sink.write(late_subways_table(self.late_subways))
+
+        return None
+
+
+if __name__ == "__main__":
+    gcp_credentials = GcpCredentials.load("subway-credentials")
+
+    # Each batch of staged rows is merged into the raw table once it is written
+    sink = late_subways_stream_sink(
+        gcp_credentials,
+        "subway-mbta",
+        state_path="bigquery_stream.json",
+        on_flush=lambda: merge_late_subways.fn(gcp_credentials, "subway-mbta"),
+    )
+
+    try:
+        asyncio.run(poll_feeds(LatenessStage(sink=sink), include_trip_updates=True))
+    finally:
+        # Rows still buffered when polling stops are not lost
+        sink.close()
@@ -0,0 +1,89 @@
+from dataclasses import asdict, dataclass
+from typing import Optional, Tuple
+import re
+import polars as pl
+
+
+@dataclass(frozen=True)
+class RouteSelection:
+    """Which routes and stops of a GTFS feed the pipeline follows
+
+    A route is selected if it belongs to one of agency_names, has one of
+    route_types and its route_id fully matches route_id_pattern. A stop is
+    selected if its zone_id is one of stop_zones. Criteria left empty match
+    everything.
+    """
+
+    agency_names: Tuple[str, ...] = ()
+    route_types: Tuple[int, ...] = ()
+    route_id_pattern: Optional[str] = None
+    stop_zones: Tuple[str, ...] = ()
+
+    @classmethod
+    def from_spec(cls, spec: Optional[dict]) -> "RouteSelection":
+        """Build a selection from a flow parameter, None selects the subway"""
+
+        if spec is None:
+            return SUBWAY
+
+        unknown = set(spec) - set(cls.__dataclass_fields__)
+        if unknown:
+            raise ValueError(f"Unknown route selection keys: {sorted(unknown)}")
+
+        selection = cls(
+            agency_names=tuple(spec.get("agency_names", ())),
+            route_types=tuple(
+                int(route_type) for route_type in spec.get("route_types", ())
+            ),
+            route_id_pattern=spec.get("route_id_pattern"),
+            stop_zones=tuple(spec.get("stop_zones", ())),
+        )
+
+        # A bad pattern fails when the flow starts, not halfway through the build
+        if selection.route_id_pattern is not None:
+            re.compile(selection.route_id_pattern)
+
+        return selection
+
+    def spec(self) -> dict:
+        """Plain dict of the selection, used in the inputs of cached stages"""
+
+        return asdict(self)
+
+    def select_routes(self, agency: pl.DataFrame, routes: pl.DataFrame) -> pl.DataFrame:
+        """Keep the selected routes"""
+
+        if self.agency_names:
+            agency_ids = agency.filter(
+                pl.col("agency_name").is_in(list(self.agency_names))
+            )["agency_id"]
+            routes = routes.filter(pl.col("agency_id").is_in(agency_ids))
+
+        if self.route_types:
+            routes = routes.filter(pl.col("route_type").is_in(list(self.route_types)))
+
+        if self.route_id_pattern is not None:
+            # Feeds have a few hundred routes, so the pattern is matched in Python
+            pattern = re.compile(self.route_id_pattern)
+            route_ids = [
+                route_id
+                for route_id in routes["route_id"].unique()
+                if pattern.fullmatch(route_id)
+            ]
+            routes = routes.filter(pl.col("route_id").is_in(route_ids))
+
+        return routes
+
+    def select_stops(self, stops: pl.DataFrame) -> pl.DataFrame:
+        """Keep the stops in the selected zones"""
+
+        if self.stop_zones:
+            stops = stops.filter(pl.col("zone_id").is_in(list(self.stop_zones)))
+
+        return stops
+
+
+# Light rail (0) and heavy rail (1) routes of the MBTA at rapid transit stops
+SUBWAY = RouteSelection(
+    agency_names=("MBTA",), route_types=(0, 1), stop_zones=("RapidTransit",)
+)
@@ -1,258 +1,284 @@
+from typing import Optional
 from zipfile import ZipFile
-import os
-import pandas as pd
+import shutil
 from prefect import flow, task
-import urllib.request
 import polars as pl
-import numpy as np
 import pytz
-from datetime import datetime
+from datetime import datetime, timedelta
+from pathlib import Path
 from prefect_gcp.cloud_storage import GcsBucket
+from compact_schedule import CompactSchedule
+from service_calendar import ServiceCalendar
+from storage_format import DEFAULT_STORAGE_FORMAT, StorageFormat, scan_table
+from route_selection import RouteSelection
+from gtfs_loader import (
+    GTFS_SCHEMAS,
+    decode_ids,
+    load_members,
+    load_stop_times,
+    schema_key,
+)
+from gtfs_feed import (
+    ArtifactManifest,
+    FeedFile,
+    feed_fingerprint,
+    fetch_feed,
+    mark_feed_built,
+    member_inputs,
+)
 
 
-@task(persist_result=True)
-def schedule_feed(schedule_url: str):
-    """Get newest schedule GTFS file from Massachusets Bay Transportation Authority"""
-
-    filename = "MBTA_GTFS.zip"
-
-    urllib.request.urlretrieve(schedule_url, filename)
-
-    with ZipFile(filename) as myzip:
-        agency = pd.read_csv(myzip.open("agency.txt"), low_memory=False)
-        routes = pd.read_csv(
-            myzip.open("routes.txt"),
-            low_memory=False,
-            usecols=[
-                "route_id",
-                "agency_id",
-                "route_short_name",
-                "route_long_name",
-                "route_desc",
-                "route_type",
-                "route_url",
-                "route_fare_class",
-                "line_id",
-                "network_id",
-            ],
-        )
-        trip = pd.read_csv(
-            myzip.open("trips.txt"),
-            low_memory=False,
-            usecols=[
-                "route_id",
-                "service_id",
-                "trip_id",
-                "trip_headsign",
-                "direction_id",
-                "wheelchair_accessible",
-                "route_pattern_id",
-                "bikes_allowed",
-            ],
-        )
-        calendar = pd.read_csv(myzip.open("calendar.txt"), low_memory=False)
+@task(log_prints=True)
+def download_schedule_feed(schedule_url: str, cache_dir: str) -> FeedFile:
+    """Download the GTFS archive once per run, reusing the cached copy if unchanged"""
 
-    return agency, routes, trip, calendar
+    feed = fetch_feed(schedule_url, cache_dir)
 
+    if feed.changed:
+        print(f"Downloaded new GTFS feed {feed.sha256}")
+    else:
+        print(f"GTFS feed {feed.sha256} has not changed")
 
-@task(persist_result=True)
-def stop_times_file(schedule_url: str):
-    filename = "MBTA_GTFS.zip"
-
-    urllib.request.urlretrieve(schedule_url, filename)
-
-    with ZipFile(filename) as myzip:
-        pl.read_csv(
-            myzip.open("stop_times.txt"),
-            dtypes={"trip_id": str, "stop_id": str, "stop_headsign": str},
-            columns=[
-                "trip_id",
-                "arrival_time",
-                "departure_time",
-                "stop_id",
-                "stop_sequence",
-            ],
-        ).write_parquet(
-            "stop_times.parquet.gzip", compression="gzip", row_group_size=100000
-        )
-        pl.read_csv(
-            myzip.open("stops.txt"),
-            dtypes={"stop_id": str, "stop_name": str, "stop_desc": str, "zone_id": str},
-            columns=[
-                "stop_id",
-                "stop_name",
-                "stop_desc",
-                "stop_lat",
-                "stop_lon",
-                "zone_id",
-            ],
-        ).write_parquet("stops.parquet.gzip", compression="gzip", row_group_size=1000)
+    return feed
+
+
+@task(log_prints=True)
+def read_feed_fingerprint(feed_path: str) -> dict:
+    """Read the feed version and member hashes that decide which stages to rebuild"""
+
+    fingerprint = feed_fingerprint(feed_path)
+
+    print(f"GTFS feed version: {fingerprint['feed_version']}")
+
+    return fingerprint
 
 
 @task(persist_result=True)
-def add_stops_stoptimes_schedule(
-    agency: pd.DataFrame,
-    routes: pd.DataFrame,
-    trip: pd.DataFrame,
-    calendar: pd.DataFrame,
-    agency_name: str,
-) -> pd.DataFrame:
-    """Add stops and stop times to each trip for the selected agency"""
+def schedule_feed(feed_path: str, workers: Optional[int] = None):
+    """Read the schedule GTFS file from Massachusets Bay Transportation Authority"""
+
+    # The members are decoded in parallel into tables with fixed types
+    tables = load_members(
+        feed_path,
+        ["agency.txt", "routes.txt", "trips.txt", "calendar.txt"],
+        workers=workers,
+    )
 
-    # Set agency id and agency name to MBTA only
-    agency_id = agency["agency_id"][agency["agency_name"] == agency_name].values[0]
+    # Ids are joined as plain strings across the separately decoded members
+    agency, routes, trip, calendar = (
+        pl.from_arrow(decode_ids(table)) for table in tables.values()
+    )
 
-    # Find associated routes for MBTA
-    routes = routes[routes.agency_id == agency_id]
+    return agency, routes, trip, calendar
 
-    # These are route id's for subway lines
-    subway_only = [
-        "Blue",
-        "Green-B",
-        "Green-C",
-        "Green-D",
-        "Green-E",
-        "Mattapan",
-        "Orange",
-        "Red",
-    ]
 
-    routes = routes[routes["route_id"].isin(subway_only)]
+@task
+def stop_times_file(
+    feed_path: str,
+    trips_routes_dates_path: str,
+    stops_path: str,
+    to_path: str,
+    storage_format: str = DEFAULT_STORAGE_FORMAT,
+    workers: Optional[int] = None,
+):
+    """Decode the stop times of the selected trips at the selected stops to disk"""
+
+    # The selected trips and stops are small, so their ids are collected up front
+    # and used to filter the stop times while decoding
+    trip_ids = scan_table(trips_routes_dates_path).select("trip_id").collect()
+    stop_ids = scan_table(stops_path).select("stop_id").collect()
+
+    # Workers each parse a byte range of stop_times.txt
+    stop_times = load_stop_times(
+        feed_path,
+        trip_ids=trip_ids["trip_id"],
+        stop_ids=stop_ids["stop_id"],
+        workers=workers,
+        work_dir=Path(to_path).parent,
+    )
 
-    trips_routes = trip.merge(routes, how="left", on="route_id")
+    StorageFormat.from_spec(storage_format).write(decode_ids(stop_times), to_path)
 
-    # Replace empty values with NaN
-    trips_routes["agency_id"].replace("", np.nan, inplace=True)
 
-    # Assert and remove trips that aren't part of the selected agency_name
-    trips_routes.dropna(subset=["agency_id"], inplace=True)
+@task
+def selected_stops(
+    feed_path: str,
+    to_path: str,
+    route_selection: RouteSelection,
+    storage_format: str = DEFAULT_STORAGE_FORMAT,
+):
+    """Keep the stops in the zones of the route selection"""
 
-    # # Add calendar data to trips_routes
-    trips_routes_dates = trips_routes.merge(calendar, how="left", on="service_id")
+    stops = load_members(feed_path, ["stops.txt"])["stops.txt"]
+    stops = route_selection.select_stops(pl.from_arrow(decode_ids(stops)))
 
-    return trips_routes_dates
+    StorageFormat.from_spec(storage_format, row_group_size=1000).write(stops, to_path)
 
 
 @task
-def stop_stop_times(trips_routes_dates: pd.DataFrame):
-    stop_times_pl = pl.read_parquet(
-        "stop_times.parquet.gzip",
-    )
+def selected_shapes(
+    feed_path: str,
+    trips_routes_dates_path: str,
+    to_path: str,
+    storage_format: str = DEFAULT_STORAGE_FORMAT,
+):
+    """Keep the points of the shapes the selected trips follow"""
+
+    shape_ids = scan_table(trips_routes_dates_path).select("shape_id").collect()
 
-    stops_pl = pl.read_parquet("stops.parquet.gzip").filter(
-        pl.col("zone_id") == "RapidTransit"
+    # shapes.txt is optional in GTFS
+    with ZipFile(feed_path) as myzip:
+        has_shapes = "shapes.txt" in myzip.namelist()
+
+    if has_shapes:
+        shapes = load_members(feed_path, ["shapes.txt"])["shapes.txt"]
+    else:
+        shapes = GTFS_SCHEMAS["shapes.txt"].empty_table()
+
+    # Points stay in sequence order, so each shape is a run of rows
+    shapes = (
+        pl.from_arrow(decode_ids(shapes))
+        .filter(pl.col("shape_id").is_in(shape_ids["shape_id"]))
+        .sort("shape_id", "shape_pt_sequence")
     )
 
-    trips_routes_dates_pl = pl.from_pandas(trips_routes_dates)
+    StorageFormat.from_spec(storage_format, sort_by=()).write(shapes, to_path)
+
+
+@task
+def service_calendar_index(feed_path: str, to_path: str):
+    """Build the service-day bitmap from calendar.txt and calendar_dates.txt"""
+
+    with ZipFile(feed_path) as myzip:
+        calendar = pl.read_csv(
+            myzip.open("calendar.txt"), dtypes={"service_id": pl.Utf8}
+        )
+
+        # calendar_dates.txt is optional in GTFS
+        calendar_dates = None
+        if "calendar_dates.txt" in myzip.namelist():
+            calendar_dates = pl.read_csv(
+                myzip.open("calendar_dates.txt"),
+                dtypes={"service_id": pl.Utf8, "date": pl.Utf8},
+                columns=["service_id", "date", "exception_type"],
+            )
+
+    ServiceCalendar.from_feed(calendar, calendar_dates).save(to_path)
+
+
+@task(persist_result=True)
+def add_stops_stoptimes_schedule(
+    agency: pl.DataFrame,
+    routes: pl.DataFrame,
+    trip: pl.DataFrame,
+    calendar: pl.DataFrame,
+    route_selection: RouteSelection,
+) -> pl.DataFrame:
+    """Add route and calendar data to each trip of the selected routes"""
+
+    routes = route_selection.select_routes(agency, routes)
+
+    # An inner join removes trips that aren't on the selected routes
+    trips_routes = trip.join(routes, how="inner", on="route_id")
+
+    # Add calendar data to trips_routes
+    trips_routes_dates = trips_routes.join(calendar, how="left", on="service_id")
+
+    return trips_routes_dates
+
+
+@task
+def stop_stop_times(
+    trips_routes_dates_path: str, stop_times_path: str, stops_path: str
+) -> pl.DataFrame:
+    """Add stops and stop times to the selected trips"""
 
     # Add stop times data to trips_routes_dates
-    trips_routes_dates_stoptimes = trips_routes_dates_pl.join(
-        stop_times_pl, left_on="trip_id", right_on="trip_id"
+    trips_routes_dates_stoptimes = scan_table(trips_routes_dates_path).join(
+        scan_table(stop_times_path), on="trip_id"
     )
 
     # Add stops data to trips_routes_dates_stoptimes
     trips_routes_dates_stoptimes_stops = trips_routes_dates_stoptimes.join(
-        stops_pl, left_on="stop_id", right_on="stop_id"
+        scan_table(stops_path), on="stop_id"
     )
 
-    trips_routes_dates_stoptimes = trips_routes_dates_stoptimes_stops.to_pandas()
-
-    return trips_routes_dates_stoptimes
+    return trips_routes_dates_stoptimes_stops.collect()
 
 
 @task
-def schedule_today(
-    trips_routes_dates_stoptimes: pd.DataFrame, current_trips_filename: str
-) -> pd.DataFrame:
-    """Transform all trip schedules to include only those running on the current (US/Eastern) day"""
-
-    # Set the timezone as UTC
+def schedule_service_days(
+    trips_routes_dates_stoptimes: pl.DataFrame,
+    service_calendar_path: str,
+    shapes_path: str,
+    current_trips_filename: str,
+    schedule_dir: str,
+    days_ahead: int,
+    storage_format: str = DEFAULT_STORAGE_FORMAT,
+) -> list:
+    """Partition the trip schedules by service day, starting today (US/Eastern)"""
+
+    # Set the timezone as US/Eastern
     tz = pytz.timezone("US/Eastern")
 
-    # Get the datetime of today
-    todays_date = datetime.now(tz)
+    # Get the date of today
+    todays_date = datetime.now(tz).date()
 
-    # Get the date in 'YearMonthDay' format
-    todays_date_string = todays_date.strftime("%Y%m%d")
+    # Trips and their stop times are numbered in route and trip order
+    storage = StorageFormat.from_spec(storage_format, row_group_size=20000)
 
-    # Convert todays_date_string to a Pandas datetime
-    todays_date_1 = pd.to_datetime(todays_date_string, format="%Y%m%d")
+    # Services per day, including calendar_dates exceptions
+    service_calendar = ServiceCalendar.load(service_calendar_path)
 
-    # Convert start & end dates to datetime
-    trips_routes_dates_stoptimes[
-        ["start_date", "end_date"]
-    ] = trips_routes_dates_stoptimes[["start_date", "end_date"]].apply(
-        pd.to_datetime, format="%Y%m%d"
-    )
+    trips = trips_routes_dates_stoptimes
+    shapes = scan_table(shapes_path).collect()
+
+    # Trips with stop times past 24:00 run into the next calendar day
+    overnight_trip_ids = trips.filter(pl.col("arrival_s") >= 24 * 3600)[
+        "trip_id"
+    ].unique()
+
+    partition_paths = []
+    for offset in range(days_ahead):
+        service_date = todays_date + timedelta(days=offset)
+        previous_date = service_date - timedelta(days=1)
+
+        # Only use trips whose service runs on this day
+        trips_service_date = trips.filter(
+            pl.col("service_id").is_in(service_calendar.services_on(service_date))
+        ).with_columns(pl.lit(service_date).alias("service_date"))
+
+        # Trips of the previous service day that are still running after midnight
+        trips_overnight = trips.filter(
+            pl.col("service_id").is_in(service_calendar.services_on(previous_date))
+            & pl.col("trip_id").is_in(overnight_trip_ids)
+        ).with_columns(pl.lit(previous_date).alias("service_date"))
+
+        partition_dir = (
+            Path(schedule_dir) / f"service_date={service_date.strftime('%Y%m%d')}"
+        )
+
+        # Each partition is a fact table of stop times plus its dimensions
+        schedule = CompactSchedule.from_frame(
+            pl.concat([trips_service_date, trips_overnight]), shapes
+        )
+        partition_paths.extend(
+            schedule.write(partition_dir / current_trips_filename, storage)
+        )
 
-    # Use these columns only
-    columns_only = [
-        "route_id",
-        "service_id",
-        "trip_id",
-        "trip_headsign",
-        "direction_id",
-        "wheelchair_accessible",
-        "route_pattern_id",
-        "bikes_allowed",
-        "agency_id",
-        "route_short_name",
-        "route_long_name",
-        "route_desc",
-        "route_type",
-        "route_url",
-        "route_fare_class",
-        "line_id",
-        "network_id",
-        "monday",
-        "tuesday",
-        "wednesday",
-        "thursday",
-        "friday",
-        "saturday",
-        "sunday",
-        "start_date",
-        "end_date",
-        "arrival_time",
-        "departure_time",
-        "stop_id",
-        "stop_sequence",
-        "stop_name",
-        "stop_desc",
-        "stop_lat",
-        "stop_lon",
-        "zone_id",
-    ]
-
-    # Only use these columns in the dataset
-    trips_routes_dates_stoptimes_1 = trips_routes_dates_stoptimes[columns_only]
-
-    # Only use data if current day is in the service interval
-    trips_today = trips_routes_dates_stoptimes_1[
-        (todays_date_1 >= trips_routes_dates_stoptimes_1["start_date"])
-        & (todays_date_1 <= trips_routes_dates_stoptimes_1["end_date"])
-    ]
-
-    # Apply string type to stop_id in order to successfully
-    # merge with df_3
-    trips_today["stop_id"] = trips_today["stop_id"].apply(str)
-
-    # Save and compress to parquet file type
-    trips_today.to_parquet(f"{current_trips_filename}.parquet.gzip", compression="gzip")
-
-    return trips_today
+    return partition_paths
 
 
 @task
 def load_schedules_to_gcs(
-    prefect_gcs_block_name: str, from_path: str, to_path: str
+    prefect_gcs_block_name: str, from_folder: str, to_folder: str
 ) -> None:
-    """Load the trips today schedule to Google Cloud Bucket"""
+    """Load the service day schedules to Google Cloud Bucket"""
 
     gcs_block = GcsBucket.load(prefect_gcs_block_name)
-    gcs_block.upload_from_path(from_path=from_path, to_path=to_path)
+    gcs_block.upload_from_folder(from_folder=from_folder, to_folder=to_folder)
 
-    os.remove(from_path)
+    shutil.rmtree(from_folder)
 
     return None
 
@@ -260,42 +286,149 @@ def load_schedules_to_gcs(
 @flow
 def schedules(
     schedule_url: str = "https://cdn.mbta.com/MBTA_GTFS.zip",
-    agency_name: str = "MBTA",
+    route_selection: Optional[dict] = None,
     current_schedule_filename: str = "schedule_today",
     prefect_gcs_block_name: str = "subway-gcs-bucket",
+    cache_dir: str = "gtfs_cache",
+    days_ahead: int = 7,
+    storage_format: str = DEFAULT_STORAGE_FORMAT,
+    workers: Optional[int] = None,
 ):
-    agency, routes, trip, calendar = schedule_feed(schedule_url)
+    """Build the service day schedules from the GTFS feed
+
+    The feed is decoded by a pool of workers, one per core unless workers is set.
+    route_selection is a RouteSelection spec, for example {"route_types": [3]}
+    for buses. By default the subway is selected.
+    """
+
+    selection = RouteSelection.from_spec(route_selection)
+
+    feed = download_schedule_feed(schedule_url, cache_dir)
+
+    # Skip the build if today's schedule was already built from this feed
+    service_date = datetime.now(pytz.timezone("US/Eastern")).strftime("%Y%m%d")
+    if not feed.changed and feed.built_for == service_date:
+        return None
+
+    fingerprint = read_feed_fingerprint(feed.path)
+    manifest = ArtifactManifest(cache_dir)
+    storage = StorageFormat.from_spec(storage_format)
+
+    # Each stage is only rebuilt when the members it reads have changed
+    trips_members = ["agency.txt", "routes.txt", "trips.txt", "calendar.txt"]
+    trips_inputs = member_inputs(
+        fingerprint,
+        trips_members,
+        route_selection=selection.spec(),
+        storage_format=storage_format,
+        schemas=schema_key(trips_members),
+    )
+
+    def build_trips_routes_dates(path):
+        agency, routes, trip, calendar = schedule_feed(feed.path, workers)
+        trips_routes_dates = add_stops_stoptimes_schedule(
+            agency=agency,
+            routes=routes,
+            trip=trip,
+            calendar=calendar,
+            route_selection=selection,
+        )
+        storage.write(trips_routes_dates, path)
+
+    trips_routes_dates_path = manifest.get_or_build(
+        "trips_routes_dates",
+        trips_inputs,
+        build_trips_routes_dates,
+        storage.suffix,
+    )
+    stops_inputs = member_inputs(
+        fingerprint,
+        ["stops.txt"],
+        route_selection=selection.spec(),
+        storage_format=storage_format,
+        schemas=schema_key(["stops.txt"]),
+    )
+
+    stops_path = manifest.get_or_build(
+        "selected_stops",
+        stops_inputs,
+        lambda path: selected_stops(feed.path, path, selection, storage_format),
+        storage.suffix,
+    )
 
-    stop_times_file(schedule_url)
+    stop_times_inputs = member_inputs(
+        fingerprint,
+        ["stop_times.txt"],
+        trips=manifest.inputs_key(trips_inputs),
+        stops=manifest.inputs_key(stops_inputs),
+        storage_format=storage_format,
+        schemas=schema_key(["stop_times.txt"]),
+    )
 
-    trips_routes_dates = add_stops_stoptimes_schedule(
-        agency=agency,
-        routes=routes,
-        trip=trip,
-        calendar=calendar,
-        agency_name=agency_name,
+    stop_times_path = manifest.get_or_build(
+        "stop_times",
+        stop_times_inputs,
+        lambda path: stop_times_file(
+            feed.path,
+            trips_routes_dates_path=trips_routes_dates_path,
+            stops_path=stops_path,
+            to_path=path,
+            storage_format=storage_format,
+            workers=workers,
+        ),
+        storage.suffix,
     )
 
-    trips_stops = stop_stop_times(trips_routes_dates=trips_routes_dates)
+    shapes_path = manifest.get_or_build(
+        "shapes",
+        member_inputs(
+            fingerprint,
+            ["shapes.txt"],
+            trips=manifest.inputs_key(trips_inputs),
+            storage_format=storage_format,
+            schemas=schema_key(["shapes.txt"]),
+        ),
+        lambda path: selected_shapes(
+            feed.path,
+            trips_routes_dates_path=trips_routes_dates_path,
+            to_path=path,
+            storage_format=storage_format,
+        ),
+        storage.suffix,
+    )
+
+    calendar_path = manifest.get_or_build(
+        "service_calendar",
+        member_inputs(fingerprint, ["calendar.txt", "calendar_dates.txt"]),
+        lambda path: service_calendar_index(feed.path, path),
+        ".npz",
+    )
 
-    trips_today = schedule_today(
+    trips_stops = stop_stop_times(
+        trips_routes_dates_path=trips_routes_dates_path,
+        stop_times_path=stop_times_path,
+        stops_path=stops_path,
+    )
+
+    partition_paths = schedule_service_days(
         wait_for=[trips_stops],
         trips_routes_dates_stoptimes=trips_stops,
+        service_calendar_path=calendar_path,
+        shapes_path=shapes_path,
         current_trips_filename=current_schedule_filename,
+        schedule_dir="current_schedule",
+        days_ahead=days_ahead,
+        storage_format=storage_format,
     )
 
     load_schedules_to_gcs(
-        wait_for=[trips_today],
+        wait_for=[partition_paths],
         prefect_gcs_block_name=prefect_gcs_block_name,
-        from_path=f"{current_schedule_filename}.parquet.gzip",
-        to_path=f"current_schedule/{current_schedule_filename}.parquet.gzip",
+        from_folder="current_schedule",
+        to_folder="current_schedule",
     )
 
-    os.remove("MBTA_GTFS.zip")
-
-    os.remove("stop_times.parquet.gzip")
-
-    os.remove("stops.parquet.gzip")
+    mark_feed_built(cache_dir, feed, service_date)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,157 @@
+from pathlib import Path, PurePosixPath
+from typing import Optional
+import hashlib
+import json
+import os
+import tempfile
+import time
+import pyarrow as pa
+import pyarrow.feather as feather
+from prefect_gcp.cloud_storage import GcsBucket
+from state_file import write_json_atomic
+from storage_format import read_table
+
+
+class GcsScheduleStore:
+    """Schedule objects in the bucket of a GcsBucket block"""
+
+    def __init__(self, gcs_block: GcsBucket):
+        self.gcs_block = gcs_block
+        self.bucket = gcs_block.gcp_credentials.get_cloud_storage_client().bucket(
+            gcs_block.bucket
+        )
+
+    def blob_name(self, path: str) -> str:
+        if self.gcs_block.bucket_folder:
+            return str(PurePosixPath(self.gcs_block.bucket_folder, path))
+        return path
+
+    def version(self, path: str) -> Optional[str]:
+        """Return the generation of the object, or None if it does not exist"""
+
+        blob = self.bucket.get_blob(self.blob_name(path))
+        if blob is None:
+            return None
+
+        return str(blob.generation)
+
+    def download(self, path: str, to_path: Path, version: str) -> None:
+        """Download exactly the given generation of the object"""
+
+        self.bucket.blob(self.blob_name(path)).download_to_filename(
+            str(to_path), if_generation_match=int(version)
+        )
+
+        return None
+
+
+class ScheduleCache:
+    """Local copies of schedule objects, keyed by their object version
+
+    Each object is kept as an uncompressed Feather file, so a hit memory-maps it
+    instead of decompressing the downloaded file again. The least recently used copies
+    are removed once the cache grows past max_bytes. store is anything with
+    version(path) and download(path, to_path, version), such as GcsScheduleStore.
+    """
+
+    def __init__(
+        self, store, cache_dir: str = "schedule_cache", max_bytes: int = 2**30
+    ):
+        self.store = store
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.manifest_path = self.cache_dir / "cache.json"
+        self.entries = {}
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        if self.manifest_path.exists():
+            with open(self.manifest_path) as manifest_file:
+                self.entries = json.load(manifest_file)
+
+    def read(self, path: str) -> pa.Table:
+        """Return the object at path, downloading it only if it changed"""
+
+        version = self.store.version(path)
+        if version is None:
+            raise FileNotFoundError(path)
+
+        entry = self.entries.get(path)
+        if (
+            entry is None
+            or entry["version"] != version
+            or not (self.cache_dir / entry["file"]).exists()
+        ):
+            entry = self.fill(path, version)
+
+        entry["last_used"] = time.time()
+        self.evict(keep=path)
+        self.save()
+
+        return feather.read_table(self.cache_dir / entry["file"], memory_map=True)
+
+    def fill(self, path: str, version: str) -> dict:
+        """Download one version of the object and store it as Feather"""
+
+        key = hashlib.sha256(path.encode()).hexdigest()[:16]
+        file_name = f"{key}-{version}.feather"
+
+        with tempfile.TemporaryDirectory(dir=self.cache_dir) as tmp_dir:
+            download_path = Path(tmp_dir) / PurePosixPath(path).name
+            self.store.download(path, download_path, version)
+
+            # Write next to the cache and rename, so readers never see half a file
+            tmp_path = Path(tmp_dir) / file_name
+            feather.write_feather(
+                read_table(download_path), tmp_path, compression="uncompressed"
+            )
+            os.replace(tmp_path, self.cache_dir / file_name)
+
+        # An older version of the same object is no longer needed
+        previous = self.entries.get(path)
+        if previous is not None and previous["file"] != file_name:
+            self.remove_file(previous["file"])
+
+        entry = {
+            "version": version,
+            "file": file_name,
+            "size": os.path.getsize(self.cache_dir / file_name),
+            "last_used": time.time(),
+        }
+        self.entries[path] = entry
+
+        return entry
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        """Drop least recently used copies until the cache fits in max_bytes"""
+
+        total = sum(entry["size"] for entry in self.entries.values())
+
+        for path, entry in sorted(
+            self.entries.items(), key=lambda item: item[1]["last_used"]
+        ):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+
+            self.remove_file(entry["file"])
+            del self.entries[path]
+            total -= entry["size"]
+
+        return None
+
+    def remove_file(self, file_name: str) -> None:
+        # A mapped file can be unlinked while a reader still has it open
+        try:
+            os.remove(self.cache_dir / file_name)
+        except FileNotFoundError:
+            pass
+
+        return None
+
+    def save(self) -> None:
+        """Write the cache manifest"""
+
+        write_json_atomic(self.manifest_path, self.entries)
+
+        return None
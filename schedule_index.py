@@ -0,0 +1,245 @@
+from typing import Tuple
+import numpy as np
+import pandas as pd
+from compact_schedule import CompactSchedule
+from spatial_index import SpatialIndex
+
+# A vehicle this far past a stop along its shape is still taken to be at it,
+# platforms are up to about 200m long
+STOP_REACH_M = 100
+
+
+class ScheduleIndex:
+    """Hash index over one service day's schedule for the live/schedule join
+
+    Rows are keyed by (service_date, trip_id, stop_id) and by
+    (service_date, trip_id, stop_sequence), so each vehicle is matched to the
+    scheduled stop it reports in O(1) instead of merging every stop of its trip.
+    Rows are rows of the schedule's stop_times table.
+
+    Vehicles are also snapped onto the shape of their trip. Their position picks
+    the scheduled stop when the one they report is missing or already behind
+    them, and the schedule is interpolated at it.
+    """
+
+    def __init__(self, schedule: CompactSchedule):
+        self.schedule = schedule
+
+        # Keys are formatted once per trip and per stop, then spread over the rows
+        trip_rows = schedule.stop_times["trip_idx"].to_numpy()
+        stop_rows = schedule.stop_times["stop_idx"].to_numpy()
+        trip_dates = pd.to_datetime(schedule.trips["service_date"].to_pandas())
+
+        trip_service_dates = trip_dates.dt.strftime("%Y%m%d").to_numpy()
+        service_dates = trip_service_dates[trip_rows]
+        trip_ids = schedule.trips["trip_id"].to_numpy(zero_copy_only=False)[trip_rows]
+        stop_ids = schedule.stops["stop_id"].to_numpy(zero_copy_only=False)[stop_rows]
+        stop_sequences = schedule.stop_times["stop_sequence"].to_numpy()
+        rows = range(schedule.stop_times.num_rows)
+
+        self.by_stop_id = dict(
+            zip(zip(service_dates.tolist(), trip_ids.tolist(), stop_ids.tolist()), rows)
+        )
+        self.by_stop_sequence = dict(
+            zip(
+                zip(service_dates.tolist(), trip_ids.tolist(), stop_sequences.tolist()),
+                rows,
+            )
+        )
+
+        # Rows are in trip order, so the stops of each trip are a range of rows
+        self.trip_rows = trip_rows
+        self.by_trip = dict(
+            zip(
+                zip(
+                    trip_service_dates.tolist(),
+                    schedule.trips["trip_id"].to_pylist(),
+                ),
+                range(schedule.trips.num_rows),
+            )
+        )
+        trips = np.arange(schedule.trips.num_rows)
+        self.trip_starts = np.searchsorted(trip_rows, trips)
+        self.trip_ends = np.searchsorted(trip_rows, trips, side="right")
+
+        # The last entry is -1, so trip -1 has no shape either
+        self.spatial = SpatialIndex(schedule.stops, schedule.shapes)
+        self.trip_shapes = np.append(
+            self.spatial.shape_codes_of(
+                schedule.trips["shape_id"].to_numpy(zero_copy_only=False)
+            ),
+            -1,
+        )
+
+        # Each stop is snapped once per shape that passes it
+        stops = max(schedule.stops.num_rows, 1)
+        pairs, pair_rows = np.unique(
+            (self.trip_shapes[trip_rows] + 1) * stops + stop_rows, return_inverse=True
+        )
+        stop_dist, _ = self.spatial.along_shape(
+            schedule.stops["stop_lat"].to_numpy(zero_copy_only=False)[pairs % stops],
+            schedule.stops["stop_lon"].to_numpy(zero_copy_only=False)[pairs % stops],
+            pairs // stops - 1,
+        )
+
+        # Distance along its trip's shape of each row. The last entry is NaN, so
+        # row -1 has no distance.
+        self.stop_dist = np.append(stop_dist[pair_rows], np.nan)
+
+    def rows(self, service_dates, trip_ids, stop_ids, stop_sequences) -> np.ndarray:
+        """Return the schedule row of each stop, or -1 where there is none
+
+        Stops are matched on stop_id first and stop_sequence second.
+        """
+
+        schedule_rows = np.full(len(trip_ids), -1)
+        for row, (service_date, trip_id, stop_id, stop_sequence) in enumerate(
+            zip(service_dates, trip_ids, stop_ids, stop_sequences)
+        ):
+            schedule_row = self.by_stop_id.get((service_date, trip_id, stop_id))
+            if schedule_row is None:
+                schedule_row = self.by_stop_sequence.get(
+                    (service_date, trip_id, stop_sequence), -1
+                )
+            schedule_rows[row] = schedule_row
+
+        return schedule_rows
+
+    def positions(
+        self, service_dates, trip_ids, latitudes, longitudes
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Trip of each vehicle and its distance along the trip's shape
+
+        The trip is -1 and the distance NaN where they are unknown.
+        """
+
+        trips = np.fromiter(
+            (self.by_trip.get(key, -1) for key in zip(service_dates, trip_ids)),
+            dtype=np.int64,
+            count=len(trip_ids),
+        )
+
+        # Snap every vehicle at once, those without a shape are left out
+        along, _ = self.spatial.along_shape(
+            np.asarray(latitudes, dtype=np.float64),
+            np.asarray(longitudes, dtype=np.float64),
+            self.trip_shapes[trips],
+        )
+
+        return trips, along
+
+    def next_stop_rows(self, trips: np.ndarray, along: np.ndarray) -> np.ndarray:
+        """First stop of each vehicle's trip it has not passed yet, or -1"""
+
+        located = np.flatnonzero((trips >= 0) & ~np.isnan(along))
+        counts = self.trip_ends[trips[located]] - self.trip_starts[trips[located]]
+
+        # One candidate per located vehicle and stop of its trip
+        vehicles = np.repeat(located, counts)
+        first = np.cumsum(counts) - counts
+        candidates = np.repeat(self.trip_starts[trips[located]], counts) + (
+            np.arange(counts.sum()) - np.repeat(first, counts)
+        )
+        ahead = self.stop_dist[candidates] >= along[vehicles] - STOP_REACH_M
+
+        # Candidates are in stop order, the first one ahead is the next stop
+        vehicles, candidates = vehicles[ahead], candidates[ahead]
+        first_ahead = np.ones(len(vehicles), dtype=bool)
+        first_ahead[1:] = vehicles[1:] != vehicles[:-1]
+
+        rows = np.full(len(trips), -1)
+        rows[vehicles[first_ahead]] = candidates[first_ahead]
+
+        return rows
+
+    def position_seconds(self, rows: np.ndarray, along: np.ndarray) -> np.ndarray:
+        """Scheduled time at each vehicle's position on its way to the stop at rows
+
+        The time is interpolated by distance between the departure from the
+        previous stop and the arrival at this one. NaN where the trip has no
+        previous stop or the vehicle is not on its shape.
+        """
+
+        stop_times = self.schedule.stop_times
+        previous = np.maximum(rows - 1, 0)
+        has_previous = (rows > 0) & (self.trip_rows[previous] == self.trip_rows[rows])
+
+        start = self.stop_dist[previous]
+        end = self.stop_dist[rows]
+        departure = stop_times["departure_s"].to_numpy()[previous]
+        arrival = stop_times["arrival_s"].to_numpy()[rows]
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            fraction = np.clip((along - start) / (end - start), 0, 1)
+
+        return np.where(
+            has_previous & (end > start),
+            departure + fraction * (arrival - departure),
+            np.nan,
+        )
+
+    def lookup(self, live_locations: pd.DataFrame, service_date: str) -> pd.DataFrame:
+        """Return one row per matched vehicle: its scheduled stop plus its live data
+
+        Vehicles are matched on their stop_id first and their current stop
+        sequence second. Where neither matches, or the stop is already behind
+        the vehicle, the next stop along its shape is used. Vehicles that do not
+        report a start date are looked up on service_date (YYYYMMDD). The
+        columns are laid out as a merge of the schedule with the live locations
+        on trip_id/direction_id/route_id, plus position_s, the scheduled time at
+        the vehicle's position in seconds past the service day start.
+        """
+
+        live_dates = live_locations["live_start_date"].dt.strftime("%Y%m%d")
+        live_dates = live_dates.fillna(service_date)
+
+        schedule_rows = self.rows(
+            live_dates,
+            live_locations["trip_id"],
+            live_locations["stop_id"],
+            live_locations["current_stop"],
+        )
+
+        trips, along = self.positions(
+            live_dates,
+            live_locations["trip_id"],
+            live_locations["latitude"],
+            live_locations["longitude"],
+        )
+        position_rows = self.next_stop_rows(trips, along)
+
+        # A reported stop the vehicle has left behind is stale
+        stale = (schedule_rows >= 0) & (
+            self.stop_dist[schedule_rows] < along - STOP_REACH_M
+        )
+        schedule_rows = np.where(
+            (position_rows >= 0) & ((schedule_rows < 0) | stale),
+            position_rows,
+            schedule_rows,
+        )
+        matched = schedule_rows >= 0
+
+        # Both sides have a stop_id, so keep the merge suffixes
+        scheduled = self.schedule.frame(schedule_rows[matched]).rename(
+            columns={"stop_id": "stop_id_x"}
+        )
+        scheduled["position_s"] = self.position_seconds(
+            schedule_rows[matched], along[matched]
+        )
+        live = live_locations[matched].reset_index(drop=True)
+
+        compare = pd.concat(
+            [
+                scheduled,
+                live.drop(columns=["trip_id", "direction_id"]).rename(
+                    columns={"stop_id": "stop_id_y"}
+                ),
+            ],
+            axis=1,
+        )
+
+        # Only keep vehicles that agree with the schedule on route and direction
+        return compare[
+            (compare["route_id"] == compare["live_route_id"])
+            & (scheduled["direction_id"] == live["direction_id"])
+        ]
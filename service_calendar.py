@@ -0,0 +1,141 @@
+from datetime import date, datetime
+from typing import List, Optional
+import numpy as np
+import polars as pl
+
+WEEKDAYS = [
+    "monday",
+    "tuesday",
+    "wednesday",
+    "thursday",
+    "friday",
+    "saturday",
+    "sunday",
+]
+
+# calendar_dates.txt exception types
+SERVICE_ADDED = 1
+SERVICE_REMOVED = 2
+
+
+def _parse_dates(column: pl.Series) -> np.ndarray:
+    """Convert a column of YYYYMMDD values to numpy days"""
+
+    return (
+        column.cast(pl.Utf8)
+        .str.strptime(pl.Date, "%Y%m%d")
+        .to_numpy()
+        .astype("datetime64[D]")
+    )
+
+
+class ServiceCalendar:
+    """Bitmap of the days each service_id runs across the feed's date range
+
+    Row i of the bitmap belongs to service_ids[i] and column j to the day
+    first_day + j. Weekday flags and calendar_dates exceptions are applied when
+    the index is built, so a lookup never has to look at the trips.
+    """
+
+    def __init__(self, service_ids: np.ndarray, first_day: date, bitmap: np.ndarray):
+        self.service_ids = service_ids
+        self.first_day = np.datetime64(first_day, "D")
+        self.bitmap = bitmap
+
+    @classmethod
+    def from_feed(
+        cls, calendar: pl.DataFrame, calendar_dates: Optional[pl.DataFrame] = None
+    ) -> "ServiceCalendar":
+        """Build the index from calendar.txt and (optionally) calendar_dates.txt"""
+
+        if calendar_dates is None:
+            calendar_dates = pl.DataFrame(
+                {"service_id": [], "date": [], "exception_type": []},
+                schema={
+                    "service_id": pl.Utf8,
+                    "date": pl.Utf8,
+                    "exception_type": pl.Int64,
+                },
+            )
+
+        start_dates = _parse_dates(calendar["start_date"])
+        end_dates = _parse_dates(calendar["end_date"])
+        exception_dates = _parse_dates(calendar_dates["date"])
+
+        all_dates = np.concatenate([start_dates, end_dates, exception_dates])
+        first_day = all_dates.min()
+        n_days = int((all_dates.max() - first_day).astype(int)) + 1
+
+        # Services that only appear in calendar_dates still need a row
+        calendar_services = calendar["service_id"].to_list()
+        exception_only_services = sorted(
+            set(calendar_dates["service_id"].to_list()) - set(calendar_services)
+        )
+        service_ids = np.array(calendar_services + exception_only_services, dtype=str)
+        row_of = {service_id: row for row, service_id in enumerate(service_ids)}
+
+        days = first_day + np.arange(n_days)
+
+        # 1970-01-01 was a Thursday, so shift to make Monday weekday 0
+        weekdays = (days.astype(int) + 3) % 7
+
+        weekday_flags = calendar.select(WEEKDAYS).to_numpy().astype(bool)
+
+        bitmap = np.zeros((len(service_ids), n_days), dtype=bool)
+        bitmap[: len(calendar)] = (
+            weekday_flags[:, weekdays]
+            & (days >= start_dates[:, None])
+            & (days <= end_dates[:, None])
+        )
+
+        rows = np.array(
+            [row_of[service_id] for service_id in calendar_dates["service_id"]],
+            dtype=int,
+        )
+        columns = (exception_dates - first_day).astype(int)
+        exception_types = calendar_dates["exception_type"].to_numpy()
+
+        added = exception_types == SERVICE_ADDED
+        removed = exception_types == SERVICE_REMOVED
+        bitmap[rows[added], columns[added]] = True
+        bitmap[rows[removed], columns[removed]] = False
+
+        return cls(service_ids, first_day, bitmap)
+
+    def services_on(self, service_date: date) -> List[str]:
+        """Return the service_ids that run on service_date"""
+
+        column = int((np.datetime64(service_date, "D") - self.first_day).astype(int))
+
+        if column < 0 or column >= self.bitmap.shape[1]:
+            return []
+
+        return self.service_ids[self.bitmap[:, column]].tolist()
+
+    def save(self, path: str) -> None:
+        """Save the index with the bitmap packed to one bit per day"""
+
+        with open(path, "wb") as index_file:
+            np.savez_compressed(
+                index_file,
+                service_ids=self.service_ids,
+                first_day=np.array(str(self.first_day)),
+                n_days=np.array(self.bitmap.shape[1]),
+                bitmap=np.packbits(self.bitmap, axis=1),
+            )
+
+        return None
+
+    @classmethod
+    def load(cls, path: str) -> "ServiceCalendar":
+        """Load an index written by save"""
+
+        with np.load(path) as index_file:
+            n_days = int(index_file["n_days"])
+            bitmap = np.unpackbits(index_file["bitmap"], axis=1, count=n_days)
+
+            return cls(
+                index_file["service_ids"],
+                datetime.strptime(str(index_file["first_day"]), "%Y-%m-%d").date(),
+                bitmap.astype(bool),
+            )
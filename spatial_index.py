@@ -0,0 +1,284 @@
+from typing import Optional, Tuple
+import numpy as np
+import pyarrow as pa
+
+# Mean Earth radius in meters
+EARTH_RADIUS_M = 6371008.8
+
+
+def local_xy(
+    lat: np.ndarray, lon: np.ndarray, origin_lat: float
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Project coordinates onto a plane in meters
+
+    An equirectangular projection around origin_lat, accurate to well under a
+    meter across a city.
+    """
+
+    x = np.radians(lon) * EARTH_RADIUS_M * np.cos(np.radians(origin_lat))
+    y = np.radians(lat) * EARTH_RADIUS_M
+
+    return x, y
+
+
+class PointGrid:
+    """Points bucketed into square cells, searched in bulk with numpy
+
+    Points can be split into groups, a query only sees the points of its own
+    group. A query looks at the 3x3 cells around its own, so every point within
+    cell_size of it is found and farther points are not.
+    """
+
+    def __init__(
+        self,
+        x: np.ndarray,
+        y: np.ndarray,
+        cell_size: float,
+        groups: Optional[np.ndarray] = None,
+    ):
+        self.x = x
+        self.y = y
+        self.cell_size = cell_size
+
+        if groups is None:
+            groups = np.zeros(len(x), dtype=np.int64)
+
+        cell_x, cell_y = self.cells(x, y)
+        located = np.isfinite(x) & np.isfinite(y)
+
+        # A margin of one cell keeps the neighbours of every point on the grid
+        self.origin_x = cell_x[located].min(initial=0) - 1
+        self.origin_y = cell_y[located].min(initial=0) - 1
+        self.width = cell_x[located].max(initial=0) - self.origin_x + 2
+        self.height = cell_y[located].max(initial=0) - self.origin_y + 2
+
+        # Points are sorted by cell, so each cell is a range of self.order.
+        # Points without coordinates get a key no query has.
+        keys = np.where(located, self.keys(groups, cell_x, cell_y), -1)
+        self.order = np.argsort(keys, kind="stable")
+        self.cell_keys, self.starts = np.unique(keys[self.order], return_index=True)
+        self.ends = np.append(self.starts[1:], len(keys))
+
+    def cells(self, x: np.ndarray, y: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # Missing coordinates are put in cell 0, the distance check rejects them
+        def cell(coordinate):
+            return np.floor(
+                np.nan_to_num(coordinate / self.cell_size, posinf=0, neginf=0)
+            ).astype(np.int64)
+
+        return cell(x), cell(y)
+
+    def keys(
+        self, groups: np.ndarray, cell_x: np.ndarray, cell_y: np.ndarray
+    ) -> np.ndarray:
+        # Cells off the grid are moved onto its edge, where no point is in reach
+        cell_x = np.clip(cell_x - self.origin_x, 0, self.width - 1)
+        cell_y = np.clip(cell_y - self.origin_y, 0, self.height - 1)
+
+        return (groups * self.height + cell_y) * self.width + cell_x
+
+    def nearest(
+        self, x: np.ndarray, y: np.ndarray, groups: Optional[np.ndarray] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Nearest point of each query and its distance
+
+        The index is -1 and the distance inf where no point is within cell_size.
+        Queries in a negative group never match.
+        """
+
+        queries = len(x)
+        if groups is None:
+            groups = np.zeros(queries, dtype=np.int64)
+
+        index = np.full(queries, -1)
+        distance = np.full(queries, np.inf)
+        if not queries or not len(self.cell_keys):
+            return index, distance
+
+        # Keys of the 3x3 cells around each query
+        cell_x, cell_y = self.cells(x, y)
+        offset_x, offset_y = np.meshgrid([-1, 0, 1], [-1, 0, 1])
+        keys = self.keys(
+            groups[:, None],
+            cell_x[:, None] + offset_x.ravel(),
+            cell_y[:, None] + offset_y.ravel(),
+        ).ravel()
+
+        # Ranges of points in the cells that hold any
+        position = np.minimum(
+            np.searchsorted(self.cell_keys, keys), len(self.cell_keys) - 1
+        )
+        found = (self.cell_keys[position] == keys) & np.repeat(groups >= 0, 9)
+        starts = np.where(found, self.starts[position], 0)
+        counts = np.where(found, self.ends[position] - starts, 0)
+
+        # One candidate per query and point in its cells
+        candidate_queries = np.repeat(np.repeat(np.arange(queries), 9), counts)
+        first = np.cumsum(counts) - counts
+        within = np.arange(counts.sum()) - np.repeat(first, counts)
+        candidates = self.order[np.repeat(starts, counts) + within]
+
+        squared = (self.x[candidates] - x[candidate_queries]) ** 2 + (
+            self.y[candidates] - y[candidate_queries]
+        ) ** 2
+        reach = squared <= self.cell_size**2
+        candidate_queries = candidate_queries[reach]
+        candidates = candidates[reach]
+        squared = squared[reach]
+
+        if not len(candidates):
+            return index, distance
+
+        # Candidates are grouped by query, so the closest is found without sorting
+        first = np.ones(len(candidates), dtype=bool)
+        first[1:] = candidate_queries[1:] != candidate_queries[:-1]
+        starts = np.flatnonzero(first)
+        lowest = np.minimum.reduceat(squared, starts)
+        closest = np.flatnonzero(
+            squared == np.repeat(lowest, np.diff(starts, append=len(squared)))
+        )
+
+        # Ties keep the first candidate
+        best = np.ones(len(closest), dtype=bool)
+        best[1:] = candidate_queries[closest[1:]] != candidate_queries[closest[:-1]]
+        closest = closest[best]
+
+        index[candidate_queries[closest]] = candidates[closest]
+        distance[candidate_queries[closest]] = np.sqrt(squared[closest])
+
+        return index, distance
+
+
+class SpatialIndex:
+    """Snap positions onto route shapes
+
+    Positions are projected around the mean stop_lat of stops. shapes has one
+    row per shape point with shape_id, shape_pt_lat and shape_pt_lon, sorted by
+    shape and point sequence. Segments are sampled every half shape_radius_m, so whole
+    arrays of positions are snapped with a few grid lookups.
+    """
+
+    def __init__(
+        self,
+        stops: pa.Table,
+        shapes: pa.Table,
+        shape_radius_m: float = 150,
+    ):
+        stop_lat = stops["stop_lat"].to_numpy(zero_copy_only=False)
+        self.origin_lat = float(np.nanmean(stop_lat)) if len(stop_lat) else 0.0
+
+        shape_ids = shapes["shape_id"].to_numpy(zero_copy_only=False).astype(str)
+        self.shape_ids, shape_codes = np.unique(shape_ids, return_inverse=True)
+        x, y = self.xy(
+            shapes["shape_pt_lat"].to_numpy(), shapes["shape_pt_lon"].to_numpy()
+        )
+
+        # Segment i runs from shape point i to i + 1 of the same shape
+        self.shape_codes = shape_codes
+        self.start_x, self.start_y = x, y
+        self.segment = np.zeros(len(x), dtype=bool)
+        self.segment[:-1] = shape_codes[1:] == shape_codes[:-1]
+        self.delta_x = np.where(self.segment, np.diff(x, append=x[-1:]), 0)
+        self.delta_y = np.where(self.segment, np.diff(y, append=y[-1:]), 0)
+        self.length = np.hypot(self.delta_x, self.delta_y)
+
+        # Distance along the shape of each shape point
+        along = np.cumsum(self.length) - self.length
+        shape_starts = np.flatnonzero(np.append(True, ~self.segment[:-1]))[: len(x)]
+        self.shape_dist = along - np.repeat(
+            along[shape_starts], np.diff(shape_starts, append=len(x))
+        )
+
+        # Sample points on each segment, dense enough that one is always in reach
+        samples = np.where(
+            self.segment, np.ceil(self.length / (shape_radius_m / 2)), 1
+        ).astype(np.int64)
+        sample_segments = np.repeat(np.arange(len(samples)), samples)
+        fraction = (
+            np.arange(samples.sum()) - np.repeat(np.cumsum(samples) - samples, samples)
+        ) / np.repeat(samples, samples)
+        self.sample_segments = sample_segments
+        self.samples = PointGrid(
+            x[sample_segments] + fraction * self.delta_x[sample_segments],
+            y[sample_segments] + fraction * self.delta_y[sample_segments],
+            shape_radius_m,
+            groups=shape_codes[sample_segments],
+        )
+
+    def xy(self, lat: np.ndarray, lon: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        return local_xy(
+            np.asarray(lat, dtype=np.float64),
+            np.asarray(lon, dtype=np.float64),
+            self.origin_lat,
+        )
+
+    def shape_codes_of(self, shape_ids: np.ndarray) -> np.ndarray:
+        """Code of each shape id, -1 for ids without shape points"""
+
+        shape_ids = np.asarray(shape_ids).astype(str)
+        if not len(self.shape_ids):
+            return np.full(len(shape_ids), -1)
+
+        codes = np.minimum(
+            np.searchsorted(self.shape_ids, shape_ids), len(self.shape_ids) - 1
+        )
+
+        return np.where(self.shape_ids[codes] == shape_ids, codes, -1)
+
+    def along_shape(
+        self, lat: np.ndarray, lon: np.ndarray, shape_codes: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Distance along the shape of each position and its distance off it
+
+        Both are NaN where the shape is unknown or too far away.
+        """
+
+        x, y = self.xy(lat, lon)
+        sample, _ = self.samples.nearest(x, y, shape_codes)
+        snapped = sample >= 0
+        along = np.full(len(x), np.nan)
+        off = np.full(len(x), np.nan)
+        if not snapped.any():
+            return along, off
+
+        x, y = x[snapped], y[snapped]
+        nearest = self.sample_segments[sample[snapped]]
+
+        # The closest point is on the sampled segment or one of its neighbours
+        best_along = np.zeros(len(x))
+        best_off = np.full(len(x), np.inf)
+        for step in (-1, 0, 1):
+            segment = np.clip(nearest + step, 0, len(self.segment) - 1)
+            usable = self.segment[segment] & (
+                self.shape_codes[segment] == self.shape_codes[nearest]
+            )
+
+            length_squared = np.maximum(self.length[segment] ** 2, 1e-9)
+            fraction = np.clip(
+                (
+                    (x - self.start_x[segment]) * self.delta_x[segment]
+                    + (y - self.start_y[segment]) * self.delta_y[segment]
+                )
+                / length_squared,
+                0,
+                1,
+            )
+            distance = np.hypot(
+                self.start_x[segment] + fraction * self.delta_x[segment] - x,
+                self.start_y[segment] + fraction * self.delta_y[segment] - y,
+            )
+
+            better = usable & (distance < best_off)
+            best_off = np.where(better, distance, best_off)
+            best_along = np.where(
+                better,
+                self.shape_dist[segment] + fraction * self.length[segment],
+                best_along,
+            )
+
+        # A shape of a single point has no segments to project onto
+        found = np.isfinite(best_off)
+        along[np.flatnonzero(snapped)[found]] = best_along[found]
+        off[np.flatnonzero(snapped)[found]] = best_off[found]
+
+        return along, off
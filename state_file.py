@@ -0,0 +1,25 @@
+from pathlib import Path
+from typing import Optional, Union
+import json
+import os
+
+
+def write_json_atomic(
+    path: Union[str, Path], payload, indent: Optional[int] = None
+) -> None:
+    """Write payload to path as JSON, replacing the file in one step
+
+    The JSON goes to a .tmp file next to path that is then renamed over it, so
+    a run that stops mid-write leaves the previous file whole. Classes that
+    take a state_path save through this, so their state survives between runs.
+    """
+
+    path = Path(path)
+    tmp_path = path.with_suffix(".tmp")
+
+    with open(tmp_path, "w") as json_file:
+        json.dump(payload, json_file, indent=indent)
+
+    os.replace(tmp_path, path)
+
+    return None
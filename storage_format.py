@@ -0,0 +1,114 @@
+from dataclasses import dataclass, replace
+from pathlib import Path
+from typing import Optional, Tuple, Union
+import pandas as pd
+import polars as pl
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+DEFAULT_STORAGE_FORMAT = "parquet-zstd"
+
+# Codecs each container can be written with
+CODECS = {
+    "parquet": ("zstd", "lz4", "snappy", "gzip", "uncompressed"),
+    "feather": ("zstd", "lz4", "uncompressed"),
+}
+
+
+@dataclass(frozen=True)
+class StorageFormat:
+    """How an intermediate table is written to disk
+
+    Formats are named by specs such as "parquet-zstd", "parquet-lz4" or
+    "feather-uncompressed". Rows are sorted on the sort_by columns a table has
+    before writing, so each row group covers a narrow range of them and readers
+    can skip row groups on their statistics.
+    """
+
+    container: str = "parquet"
+    codec: str = "zstd"
+    row_group_size: int = 100000
+    sort_by: Tuple[str, ...] = ("route_id", "trip_id")
+
+    @classmethod
+    def from_spec(cls, spec: str, **options) -> "StorageFormat":
+        container, _, codec = spec.partition("-")
+        if codec not in CODECS.get(container, ()):
+            raise ValueError(f"Unsupported storage format {spec!r}")
+
+        return cls(container, codec, **options)
+
+    @property
+    def spec(self) -> str:
+        return f"{self.container}-{self.codec}"
+
+    @property
+    def suffix(self) -> str:
+        """File suffix such as .parquet.zstd, or .feather when uncompressed"""
+
+        if self.codec == "uncompressed":
+            return f".{self.container}"
+        return f".{self.container}.{self.codec}"
+
+    def with_options(self, **options) -> "StorageFormat":
+        return replace(self, **options)
+
+    def sort_columns(self, columns) -> list:
+        return [column for column in self.sort_by if column in columns]
+
+    def write(
+        self, table: Union[pa.Table, pl.DataFrame, pd.DataFrame], path: Path
+    ) -> None:
+        """Sort and write a table"""
+
+        if isinstance(table, pl.DataFrame):
+            table = table.to_arrow()
+        elif isinstance(table, pd.DataFrame):
+            table = pa.Table.from_pandas(table, preserve_index=False)
+
+        sort_columns = self.sort_columns(table.column_names)
+        if sort_columns:
+            table = table.sort_by([(column, "ascending") for column in sort_columns])
+
+        if self.container == "feather":
+            feather.write_feather(
+                table,
+                path,
+                compression=self.codec,
+                chunksize=self.row_group_size,
+            )
+        else:
+            pq.write_table(
+                table,
+                path,
+                compression="none" if self.codec == "uncompressed" else self.codec,
+                row_group_size=self.row_group_size,
+            )
+
+        return None
+
+
+def is_feather(path: Union[str, Path]) -> bool:
+    return ".feather" in Path(path).suffixes
+
+
+def read_table(path: Union[str, Path], columns: Optional[list] = None) -> pa.Table:
+    """Read a table written by StorageFormat, telling the container by its suffix
+
+    Feather files are memory-mapped rather than copied into memory.
+    """
+
+    if is_feather(path):
+        return feather.read_table(path, columns=columns, memory_map=True)
+
+    return pq.read_table(path, columns=columns)
+
+
+def scan_table(path: Union[str, Path]) -> pl.LazyFrame:
+    """Lazily scan a table written by StorageFormat"""
+
+    if is_feather(path):
+        return pl.scan_ipc(path, memory_map=True)
+
+    return pl.scan_parquet(path)
@@ -6,7 +6,7 @@ from streamlit_folium import st_folium
 from datetime import datetime
 import pytz
 import pandas as pd
-from io import StringIO
+from io import BytesIO
 
 
 def refresh_map():
@@ -22,22 +22,22 @@ def refresh_map():
 
     client = storage.Client(credentials=credentials)
 
-    def read_csvfile(bucket_name: str, file_path: str):
+    def read_parquetfile(bucket_name: str, file_path: str):
         """Retrieve GCS bucket content"""
 
         bucket = client.bucket(bucket_name)
-        content = bucket.blob(file_path).download_as_string().decode("utf-8")
+        content = bucket.blob(file_path).download_as_bytes()
 
         return content
 
     def access_dataframe_from_gcsbucket():
-        """Reads the GCS bucket csv file and converts to a Pandas DataFrame"""
+        """Reads the GCS bucket parquet file and converts to a Pandas DataFrame"""
 
         bucket_name = "subway-mbta-location"
-        file_path = "late_subways_gold.csv"
+        file_path = "late_subways_gold.parquet"
 
-        data = read_csvfile(bucket_name, file_path)
-        dataframe = pd.read_csv(StringIO(data))
+        data = read_parquetfile(bucket_name, file_path)
+        dataframe = pd.read_parquet(BytesIO(data))
 
         return dataframe
 
@@ -66,7 +66,7 @@ def refresh_map():
         return marker
 
     try:
-        # Uncomment this when going live to read csv file from GCP
+        # Uncomment this when going live to read parquet file from GCP
         dataframe = access_dataframe_from_gcsbucket()
 
         dataframe["late_by"] = dataframe["late_by"].round(2)
@@ -79,8 +79,8 @@ def refresh_map():
             stop_name = row["stop_name"]
             late_by = row["late by"]
             route = row["route_long_name"] + " - " + row["trip_headsign"]
-            scheduled_time = row["arrival_time_fixed"].split("+", 1)[0]
-            actual_time = row["timestamp"].split("+", 1)[0]
+            scheduled_time = row["arrival_time_fixed"].strftime("%Y-%m-%d %H:%M:%S")
+            actual_time = row["timestamp"].strftime("%Y-%m-%d %H:%M:%S")
 
             try:
                 marker = create_marker(
@@ -1,4 +1,3 @@
-from google.transit.gtfs_realtime_pb2 import FeedMessage
 from datetime import datetime
 import requests
 import pandas as pd
@@ -7,52 +6,22 @@ import pytz
 import os
 from prefect import flow, task
 from prefect_gcp.cloud_storage import GcsBucket
+from typing import Collection
+from gtfs_realtime import decode_vehicle_positions, feed_header_timestamp
+from realtime_dedup import SnapshotDeduplicator
+from subway_locations_schedules import schedule_route_ids
+from storage_format import DEFAULT_STORAGE_FORMAT, StorageFormat
+from vehicle_history import append_live_locations_history
 
 
-@task(log_prints=True)
-def et_live_locations_subway(filename: str) -> None:
-    """Live bus data extracted from the Massachusets Bay Transportation Authority GTFS feed"""
+def live_locations_frame(columns: dict) -> pd.DataFrame:
+    """Turn decoded vehicle position columns into today's live locations"""
 
-    url = "https://cdn.mbta.com/realtime/VehiclePositions.pb"
-
-    # requests will fetch the results from the url, which are the vehicle positions
-    response = requests.get(url)
+    # Create a DataFrame from the columns and drop any duplicate data
+    df_1 = pd.DataFrame(columns).drop_duplicates()
 
-    # Get the data only if the HTTPStatus is OK
-    if response.status_code == HTTPStatus.OK:
-        message = FeedMessage()
-        message.ParseFromString(response.content)
-
-    # Pass and append the data to the list
-    trips = []
-    for t in message.entity:
-        trips.append(t)
-
-    # Unpack the nested data and expand to these columns
-    rows = [
-        {
-            "id": t.id,
-            "trip_id": t.vehicle.trip.trip_id,
-            "start_time": t.vehicle.trip.start_time,
-            "start_date": t.vehicle.trip.start_date,
-            "schedule_relationship": t.vehicle.trip.schedule_relationship,
-            "route_id": t.vehicle.trip.route_id,
-            "direction_id": t.vehicle.trip.direction_id,
-            "latitude": t.vehicle.position.latitude,
-            "longitude": t.vehicle.position.longitude,
-            "bearing": t.vehicle.position.bearing,
-            "speed": t.vehicle.position.speed,
-            "current_stop": t.vehicle.current_stop_sequence,
-            "current_status": t.vehicle.current_status,
-            "timestamp": datetime.utcfromtimestamp(t.vehicle.timestamp),
-            "stop_id": t.vehicle.stop_id,
-            "vehicle": t.vehicle.vehicle.id,
-            "label": t.vehicle.vehicle.label,
-        }
-        for t in trips
-    ]
-    # Create a DataFrame with rows as data and dropping any duplicate data
-    df_1 = pd.DataFrame(rows).drop_duplicates()
+    # Vehicle timestamps are POSIX seconds
+    df_1["timestamp"] = pd.to_datetime(df_1["timestamp"], unit="s")
 
     # Timestamps are in UTC, tz_localize is used keep it UTC
     # and not switch to local time
@@ -79,24 +48,65 @@ def et_live_locations_subway(filename: str) -> None:
     # Convert start & end dates to datetime
     df_3["live_start_date"] = pd.to_datetime(df_3["live_start_date"], format="%Y-%m-%d")
 
-    # These are route id's for subway lines
-    subway_only = [
-        "Blue",
-        "Green-B",
-        "Green-C",
-        "Green-D",
-        "Green-E",
-        "Mattapan",
-        "Orange",
-        "Red",
-    ]
+    return df_3
 
-    df_3 = df_3[df_3["live_route_id"].isin(subway_only)]
 
-    # Convert the DataFrame to parquet file type that is compressed
-    df_3.to_parquet(f"{filename}.parquet.gzip", engine="pyarrow", compression="gzip")
+def live_locations_subway(
+    dedup_state_path: str, dedup_window_seconds: int, route_ids: Collection[str]
+) -> pd.DataFrame:
+    """Fetch positions of the selected routes that changed since earlier snapshots"""
 
-    return None
+    url = "https://cdn.mbta.com/realtime/VehiclePositions.pb"
+
+    # requests will fetch the results from the url, which are the vehicle positions
+    response = requests.get(url)
+
+    # Get the data only if the HTTPStatus is OK
+    if response.status_code == HTTPStatus.OK:
+        # Decode vehicles of the selected routes straight into columns
+        columns = decode_vehicle_positions(response.content, route_ids)
+
+        deduplicator = SnapshotDeduplicator(
+            window_seconds=dedup_window_seconds, state_path=dedup_state_path
+        )
+
+        # Only pass on vehicle positions that changed since earlier snapshots
+        if deduplicator.is_new_snapshot(feed_header_timestamp(response.content)):
+            columns = deduplicator.new_vehicles(columns)
+        else:
+            columns = {name: column[:0] for name, column in columns.items()}
+
+        deduplicator.save()
+
+        print(f"{len(columns['vehicle'])} new vehicle positions")
+
+    return live_locations_frame(columns)
+
+
+def live_locations_storage(storage_format: str) -> StorageFormat:
+    """Storage format of the live locations, sorted by route and trip"""
+
+    return StorageFormat.from_spec(storage_format, sort_by=("live_route_id", "trip_id"))
+
+
+@task(log_prints=True)
+def et_live_locations_subway(
+    filename: str,
+    dedup_state_path: str,
+    dedup_window_seconds: int,
+    route_ids: Collection[str],
+    storage_format: str = DEFAULT_STORAGE_FORMAT,
+) -> str:
+    """Live bus data extracted from the Massachusets Bay Transportation Authority GTFS feed"""
+
+    df_3 = live_locations_subway(dedup_state_path, dedup_window_seconds, route_ids)
+
+    # Write the live locations sorted by route and trip
+    live_locations_format = live_locations_storage(storage_format)
+    live_locations_path = f"{filename}{live_locations_format.suffix}"
+    live_locations_format.write(df_3, live_locations_path)
+
+    return live_locations_path
 
 
 @task
@@ -119,19 +129,40 @@ def load_live_locations_subway_to_gcs(
 @flow
 def flow_live_locations_subway(
     prefect_gcs_block_name: str = "subway-gcs-bucket",
+    current_schedule_filename: str = "schedule_today",
     live_locations_filename: str = "live_location_subway",
+    dedup_state_path: str = "realtime_dedup.json",
+    dedup_window_seconds: int = 900,
+    history_root: str = "gs://subway-mbta-location/vehicle_history",
+    storage_format: str = DEFAULT_STORAGE_FORMAT,
 ):
+    # Only vehicles of the routes in today's schedule are decoded
+    route_ids = schedule_route_ids(
+        current_schedule_filename, prefect_gcs_block_name, storage_format=storage_format
+    )
+
     # Prefect task 1
-    et_live_locations_subway(
+    live_locations_path = et_live_locations_subway(
         filename=live_locations_filename,
+        dedup_state_path=dedup_state_path,
+        dedup_window_seconds=dedup_window_seconds,
+        route_ids=route_ids,
+        storage_format=storage_format,
     )
 
     # Prefect task 2
-    load_live_locations_subway_to_gcs(
+    append_live_locations_history(
         wait_for=[et_live_locations_subway],
+        live_locations_path=live_locations_path,
+        history_root=history_root,
+    )
+
+    # Prefect task 3
+    load_live_locations_subway_to_gcs(
+        wait_for=[append_live_locations_history],
         prefect_gcs_block_name=prefect_gcs_block_name,
-        from_path=f"{live_locations_filename}.parquet.gzip",
-        to_path=f"live_location/{live_locations_filename}.parquet.gzip",
+        from_path=live_locations_path,
+        to_path=f"live_location/{live_locations_path}",
     )
 
 
@@ -1,42 +1,112 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+from typing import Collection, Dict, FrozenSet, Iterable, Optional
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import pytz
+import requests
 from prefect import flow, task
 from prefect_gcp.cloud_storage import GcsBucket
 from pathlib import Path
 import os
+from gtfs_realtime import TRIP_UPDATES_URL, decode_trip_updates
+from compact_schedule import SCHEDULE_TABLES, CompactSchedule
+from schedule_cache import GcsScheduleStore, ScheduleCache
+from schedule_index import ScheduleIndex
+from storage_format import DEFAULT_STORAGE_FORMAT, StorageFormat, read_table
+from write_bigquery_table import late_subways_table
 
 # Set the timezone
 tz = pytz.timezone("US/Eastern")
 
-# Get the current timestamp
-now = datetime.now(tz)
 
-# Reset the time to have a clean datetime
-dt = now.replace(hour=0, minute=0, second=0, microsecond=0)
+def schedule_tables_from_gcs(
+    names: Iterable[str],
+    current_schedule_filename: str,
+    prefect_gcs_block_name: str,
+    schedule_cache_dir: str,
+    max_cache_bytes: int,
+    storage_format: str,
+) -> Dict[str, pa.Table]:
+    """Read tables of today's service day schedule through the local cache"""
+
+    # The partition of today also holds yesterday's trips running past midnight
+    service_date = datetime.now(tz).strftime("%Y%m%d")
+
+    suffix = StorageFormat.from_spec(storage_format).suffix
+    gcs_dir = (
+        f"current_schedule/service_date={service_date}/{current_schedule_filename}"
+    )
+    gcs_block = GcsBucket.load(prefect_gcs_block_name)
+
+    # The cache is shared by the runs of a worker and keyed by object generation
+    schedule_cache = ScheduleCache(
+        GcsScheduleStore(gcs_block), schedule_cache_dir, max_cache_bytes
+    )
+
+    return {name: schedule_cache.read(f"{gcs_dir}/{name}{suffix}") for name in names}
 
 
 @task(log_prints=True)
 def schedule_from_gcs(
-    current_schedule_filename: str, prefect_gcs_block_name: str
-) -> Path:
-    """Retrieve current schedule from Google Cloud Storage bucket"""
+    current_schedule_filename: str,
+    prefect_gcs_block_name: str,
+    schedule_cache_dir: str = "schedule_cache",
+    max_cache_bytes: int = 2**30,
+    storage_format: str = DEFAULT_STORAGE_FORMAT,
+) -> CompactSchedule:
+    """Retrieve today's service day schedule, downloading it only when it changed"""
+
+    return CompactSchedule(
+        **schedule_tables_from_gcs(
+            SCHEDULE_TABLES,
+            current_schedule_filename,
+            prefect_gcs_block_name,
+            schedule_cache_dir,
+            max_cache_bytes,
+            storage_format,
+        )
+    )
 
-    gcs_path = f"current_schedule/{current_schedule_filename}.parquet.gzip"
-    gcs_block = GcsBucket.load(prefect_gcs_block_name)
-    # Download schedule to cwd
-    gcs_block.get_directory(from_path=gcs_path)
 
-    return Path(gcs_path)
+@task(log_prints=True)
+def schedule_route_ids(
+    current_schedule_filename: str,
+    prefect_gcs_block_name: str,
+    schedule_cache_dir: str = "schedule_cache",
+    max_cache_bytes: int = 2**30,
+    storage_format: str = DEFAULT_STORAGE_FORMAT,
+) -> FrozenSet[str]:
+    """Ids of the routes today's schedule was built for
+
+    The schedules flow compiles its route selection into the routes table, so
+    the realtime decoders skip vehicles of any other route. Only that small
+    table is read.
+    """
+
+    routes = schedule_tables_from_gcs(
+        ["routes"],
+        current_schedule_filename,
+        prefect_gcs_block_name,
+        schedule_cache_dir,
+        max_cache_bytes,
+        storage_format,
+    )["routes"]
+
+    return frozenset(routes["route_id"].to_pylist())
 
 
 @task(log_prints=True)
 def subway_live_locations_from_gcs(
-    live_locations_filename: str, prefect_gcs_block_name: str
+    live_locations_filename: str,
+    prefect_gcs_block_name: str,
+    storage_format: str = DEFAULT_STORAGE_FORMAT,
 ) -> Path:
     """Retrieve live locations from Google Cloud Storage bucket"""
 
-    gcs_path = f"live_location/{live_locations_filename}.parquet.gzip"
+    suffix = StorageFormat.from_spec(storage_format).suffix
+    gcs_path = f"live_location/{live_locations_filename}{suffix}"
     gcs_block = GcsBucket.load(prefect_gcs_block_name)
     # Download live locations to cwd
     gcs_block.get_directory(from_path=gcs_path)
@@ -46,58 +116,176 @@ def subway_live_locations_from_gcs(
 
 @task()
 def combine_live_trips_with_schedule(
-    trips_today: pd.DataFrame, live_locations: pd.DataFrame
+    schedule_index: ScheduleIndex, live_locations: pd.DataFrame
 ) -> pd.DataFrame:
-    """Merge all scheduled trips with live trip data"""
+    """Match each live trip to its scheduled stop"""
 
-    compare = trips_today.merge(
-        live_locations,
-        left_on=["trip_id", "direction_id", "route_id"],
-        right_on=["trip_id", "direction_id", "live_route_id"],
+    compare = schedule_index.lookup(
+        live_locations, service_date=datetime.now(tz).strftime("%Y%m%d")
     )
 
     return compare
 
 
+@task(log_prints=True)
+def trip_updates_from_mbta(
+    route_ids: Collection[str], trip_updates_url: str = TRIP_UPDATES_URL
+) -> dict:
+    """Retrieve the TripUpdates of the selected routes as column arrays"""
+
+    response = requests.get(trip_updates_url)
+    response.raise_for_status()
+
+    return decode_trip_updates(response.content, route_ids)
+
+
+def service_day_start(service_dates: pd.Series) -> np.ndarray:
+    """POSIX seconds at which each service day's GTFS clock starts
+
+    GTFS times count from noon minus 12 hours, which is midnight except on the
+    days daylight saving time starts or ends.
+    """
+
+    service_dates = pd.to_datetime(service_dates)
+
+    # Only a handful of distinct service days, so localize each one once
+    starts = {
+        service_date: int(
+            (
+                tz.localize(service_date.to_pydatetime().replace(hour=12))
+                - timedelta(hours=12)
+            ).timestamp()
+        )
+        for service_date in service_dates.drop_duplicates()
+    }
+
+    return service_dates.map(starts).to_numpy(dtype=np.int64)
+
+
 @task()
-def calculate_subway_lateness(compare: pd.DataFrame) -> pd.DataFrame:
-    """Calculate difference between subway scheduled time and actual live time"""
+def predicted_delays(trip_updates: dict, schedule_index: ScheduleIndex) -> pd.DataFrame:
+    """Predicted delay in seconds of every stop left on each trip
 
-    # Resolve times that flow over to next day (e.g., 26:00 hours)
-    compare.loc[:, "arrival_time_fixed"] = dt + pd.to_timedelta(compare["arrival_time"])
-    compare.loc[:, "departure_time_fixed"] = dt + pd.to_timedelta(
-        compare["departure_time"]
+    The feed's own arrival delay is used when it sends one. Otherwise the
+    predicted arrival time, or failing that the departure, is compared with the
+    schedule, so only those stops need the schedule lookup.
+    """
+
+    updates = pd.DataFrame(trip_updates)
+    updates["start_date"] = updates["start_date"].replace(
+        "", datetime.now(tz).strftime("%Y%m%d")
     )
 
-    # Compare current time at stop with expected arrival time
-    compare["arrival_time_fixed"] = pd.to_datetime(
-        compare["arrival_time_fixed"], utc=True
+    delay = updates["arrival_delay"].to_numpy()
+    delay = np.where(np.isnan(delay), updates["departure_delay"].to_numpy(), delay)
+
+    # Stops with only a predicted time are compared against the schedule
+    missing = np.isnan(delay)
+    if missing.any():
+        missing_updates = updates[missing]
+        schedule_rows = schedule_index.rows(
+            missing_updates["start_date"],
+            missing_updates["trip_id"],
+            missing_updates["stop_id"],
+            missing_updates["stop_sequence"],
+        )
+        matched = schedule_rows >= 0
+
+        scheduled = schedule_index.schedule.frame(
+            schedule_rows[matched], ["service_date", "arrival_s", "departure_s"]
+        )
+        day_start = service_day_start(scheduled["service_date"])
+        arrival = day_start + scheduled["arrival_s"].to_numpy(dtype=np.int64)
+        departure = day_start + scheduled["departure_s"].to_numpy(dtype=np.int64)
+
+        arrival_time = missing_updates["arrival_time"].to_numpy()[matched]
+        departure_time = missing_updates["departure_time"].to_numpy()[matched]
+
+        missing_delay = np.full(len(missing_updates), np.nan)
+        missing_delay[matched] = np.where(
+            np.isnan(arrival_time), departure_time - departure, arrival_time - arrival
+        )
+        delay[missing] = missing_delay
+
+    delays = updates[["trip_id", "stop_id", "stop_sequence", "start_date"]].assign(
+        predicted_delay=delay
     )
 
-    # Convert arrival_time & departure_time to UTC timezone
-    compare["arrival_time_fixed"] = compare["arrival_time_fixed"].dt.tz_convert(
-        tz="US/Eastern"
+    return delays[~np.isnan(delay)].reset_index(drop=True)
+
+
+@task()
+def calculate_subway_lateness(
+    compare: pd.DataFrame, predicted_delays: Optional[pd.DataFrame] = None
+) -> pd.DataFrame:
+    """Calculate difference between subway scheduled time and actual live time
+
+    Where predicted_delays has a TripUpdates prediction for a vehicle's stop,
+    that prediction is used instead of the position-based estimate.
+    arrival_time_fixed is the time late_by is measured from, so the two agree
+    either way.
+    """
+
+    # Get the current time on every call, a worker can run past midnight
+    now = int(datetime.now(tz).timestamp())
+
+    # Resolve times that flow over to next day (e.g., 26:00 hours)
+    day_start = service_day_start(compare["service_date"])
+    arrival = day_start + compare["arrival_s"].to_numpy(dtype=np.int64)
+    departure = day_start + compare["departure_s"].to_numpy(dtype=np.int64)
+
+    # Vehicle timestamps as POSIX seconds, converted once per snapshot
+    timestamp = compare["timestamp"].to_numpy(dtype="datetime64[s]").astype(np.int64)
+
+    # Vehicles snapped onto their shape are compared with the schedule at their
+    # position instead of at the stop ahead, to the second
+    position = day_start + compare["position_s"].to_numpy(dtype=np.float64)
+    compared = np.where(np.isnan(position), arrival, np.round(position)).astype(
+        np.int64
     )
 
+    # Prefer the feed's own prediction for the stop when there is one, the
+    # vehicle is then compared with the schedule shifted by the predicted delay
+    if predicted_delays is not None and not predicted_delays.empty:
+        prediction = (
+            predicted_delays.drop_duplicates(["trip_id", "stop_id"], keep="last")
+            .set_index(["trip_id", "stop_id"])["predicted_delay"]
+            .reindex(
+                pd.MultiIndex.from_arrays([compare["trip_id"], compare["stop_id_x"]])
+            )
+            .to_numpy()
+        )
+        compared = np.where(
+            np.isnan(prediction), compared, timestamp - np.round(prediction)
+        ).astype(np.int64)
+
     # Create column that calculates how late subways are
     # if value is negative that means it is on the way to the
     # first stop
-    compare["late_by"] = (
-        compare["timestamp"] - compare["arrival_time_fixed"]
-    ) / pd.Timedelta(minutes=1)
-
-    # Remove timestamps that are not within the last 90 mins
-    late_subways = compare[(now - compare["timestamp"]) / pd.Timedelta(minutes=1) <= 90]
-
-    # Get subways later than _ minutes and less than 30 minutes at specific stop and remove current_status == 1
-    late_subways_2 = late_subways[
-        (late_subways["late_by"] > 3) & (late_subways["late_by"] < 30)
-    ]
+    late_by = (timestamp - compared) / 60
+
+    # Keep timestamps within the last 90 mins, subways later than 3 minutes and
+    # less than 30 minutes at the stop, and trains not headed to the first stop
+    late = (
+        ((now - timestamp) / 60 <= 90)
+        & (late_by > 3)
+        & (late_by < 30)
+        & (compare["stop_sequence"].to_numpy() != 1)
+    )
 
-    # Only include trains that are not headed to the first stop
-    late_subways_3 = late_subways_2[late_subways_2["stop_sequence"] != 1]
+    # Only build the scheduled datetimes for the late subways. The arrival is the
+    # scheduled time late_by was measured against, so the two always agree.
+    late_subways = compare[late].assign(
+        arrival_time_fixed=pd.to_datetime(
+            compared[late], unit="s", utc=True
+        ).tz_convert(tz),
+        departure_time_fixed=pd.to_datetime(
+            departure[late], unit="s", utc=True
+        ).tz_convert(tz),
+        late_by=late_by[late],
+    )
 
-    return late_subways_3
+    return late_subways
 
 
 @task()
@@ -117,38 +305,55 @@ def subway_times(
     current_schedule_filename: str = "schedule_today",
     live_locations_filename: str = "live_location_subway",
     prefect_gcs_block_name: str = "subway-gcs-bucket",
+    use_trip_updates: bool = True,
+    trip_updates_url: str = TRIP_UPDATES_URL,
+    storage_format: str = DEFAULT_STORAGE_FORMAT,
 ):
-    trips_today_path = schedule_from_gcs(
-        current_schedule_filename, prefect_gcs_block_name
+    schedule_today = schedule_from_gcs(
+        current_schedule_filename,
+        prefect_gcs_block_name,
+        storage_format=storage_format,
     )
-    trips_today = pd.read_parquet(trips_today_path)
 
     live_locations_path = subway_live_locations_from_gcs(
-        live_locations_filename, prefect_gcs_block_name
+        live_locations_filename, prefect_gcs_block_name, storage_format
     )
-    live_locations = pd.read_parquet(live_locations_path)
+    live_locations = read_table(live_locations_path).to_pandas()
+
+    schedule_index = ScheduleIndex(schedule_today)
 
     compare = combine_live_trips_with_schedule(
-        wait_for=[trips_today, live_locations],
-        trips_today=trips_today,
+        wait_for=[schedule_today, live_locations],
+        schedule_index=schedule_index,
         live_locations=live_locations,
     )
 
-    os.remove(trips_today_path)
+    # Per-stop predictions from TripUpdates take precedence over positions
+    delays = None
+    if use_trip_updates:
+        delays = predicted_delays(
+            trip_updates=trip_updates_from_mbta(
+                route_ids=schedule_today.route_ids(),
+                trip_updates_url=trip_updates_url,
+            ),
+            schedule_index=schedule_index,
+        )
+
     os.remove(live_locations_path)
-    os.rmdir("current_schedule")
     os.rmdir("live_location")
 
-    late_subways = calculate_subway_lateness(wait_for=[compare], compare=compare)
-    late_subways.to_csv("late_subways.csv", index=False)
+    late_subways = calculate_subway_lateness(
+        wait_for=[compare], compare=compare, predicted_delays=delays
+    )
+    pq.write_table(late_subways_table(late_subways), "late_subways.parquet")
 
     load_late_subways_to_gcs(
         wait_for=[late_subways],
-        late_subways_path="late_subways.csv",
+        late_subways_path="late_subways.parquet",
         prefect_gcs_block_name=prefect_gcs_block_name,
     )
 
-    os.remove("late_subways.csv")
+    os.remove("late_subways.parquet")
 
 
 if __name__ == "__main__":
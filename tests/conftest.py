@@ -0,0 +1,61 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import pytest
+
+
+class FeedServer:
+    """Serve one feed over HTTP, answering conditional requests with 304
+
+    The feed is served with ETag and Last-Modified headers. A request whose
+    If-None-Match or If-Modified-Since matches them gets an empty 304.
+    """
+
+    def __init__(self):
+        self.body = b"feed v1"
+        self.etag = '"v1"'
+        self.last_modified = "Mon, 07 Aug 2023 10:00:00 GMT"
+        self.requests = []
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests.append(dict(self.headers))
+
+                if (
+                    self.headers.get("If-None-Match") == server.etag
+                    or self.headers.get("If-Modified-Since") == server.last_modified
+                ):
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+
+                self.send_response(200)
+                self.send_header("ETag", server.etag)
+                self.send_header("Last-Modified", server.last_modified)
+                self.send_header("Content-Length", str(len(server.body)))
+                self.end_headers()
+                self.wfile.write(server.body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}/feed"
+
+    def publish(self, body: bytes, etag: str, last_modified: str) -> None:
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+
+
+@pytest.fixture
+def feed_server():
+    server = FeedServer()
+    thread = threading.Thread(target=server.httpd.serve_forever, daemon=True)
+    thread.start()
+
+    yield server
+
+    server.httpd.shutdown()
+    server.httpd.server_close()
@@ -0,0 +1,158 @@
+import json
+from google.api_core import exceptions
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import bigquery
+from google.cloud.bigquery_storage_v1 import types
+import pyarrow as pa
+import pytest
+import bigquery_stream
+from bigquery_stream import (
+    BigQueryWriteStreamClient,
+    LateSubwaysStreamSink,
+    OffsetAlreadyExists,
+    StreamNotFound,
+    WriteStreamClient,
+)
+
+
+class FakeWriteStreamClient(WriteStreamClient):
+    """Committed write streams kept in memory
+
+    Appends at a written offset are rejected like ALREADY_EXISTS. Responses
+    listed in lose_responses are dropped after their rows land, and streams in
+    lost_streams reject appends like a finalized stream.
+    """
+
+    def __init__(self):
+        self.streams = {}
+        self.finalized = set()
+        self.lose_responses = 0
+        self.lost_streams = set()
+
+    def create_stream(self) -> str:
+        stream_name = f"stream-{len(self.streams)}"
+        self.streams[stream_name] = []
+
+        return stream_name
+
+    def append(self, stream_name: str, rows: pa.Table, offset: int) -> None:
+        if stream_name in self.finalized or stream_name in self.lost_streams:
+            raise StreamNotFound(stream_name)
+
+        written = self.streams[stream_name]
+        if offset < len(written):
+            raise OffsetAlreadyExists(offset)
+
+        written.extend(rows["trip_id"].to_pylist())
+
+        if self.lose_responses:
+            self.lose_responses -= 1
+            raise exceptions.ServiceUnavailable("Response lost")
+
+        return None
+
+    def finalize(self, stream_name: str) -> int:
+        self.finalized.add(stream_name)
+
+        return len(self.streams[stream_name])
+
+    def rows(self) -> list:
+        return [row for written in self.streams.values() for row in written]
+
+
+def trips(*trip_ids: str) -> pa.Table:
+    return pa.table({"trip_id": list(trip_ids)})
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(bigquery_stream.time, "sleep", lambda seconds: None)
+
+
+def test_batches_follow_each_other_on_the_stream(tmp_path):
+    client = FakeWriteStreamClient()
+    sink = LateSubwaysStreamSink(
+        client, max_rows=2, state_path=str(tmp_path / "stream.json")
+    )
+
+    sink.write(trips("T1"))
+    sink.write(trips("T2", "T3"))
+    sink.write(trips("T4"))
+    sink.close()
+
+    assert client.streams == {"stream-0": ["T1", "T2", "T3", "T4"]}
+    assert json.loads((tmp_path / "stream.json").read_text()) == {
+        "stream_name": "stream-0",
+        "offset": 4,
+    }
+
+
+def test_lost_response_is_not_written_twice():
+    client = FakeWriteStreamClient()
+    sink = LateSubwaysStreamSink(client, max_rows=1)
+
+    client.lose_responses = 1
+    sink.write(trips("T1"))
+    sink.write(trips("T2"))
+
+    assert client.rows() == ["T1", "T2"]
+
+
+def test_stale_offset_does_not_drop_the_batch(tmp_path):
+    client = FakeWriteStreamClient()
+    state_path = str(tmp_path / "stream.json")
+
+    LateSubwaysStreamSink(client, max_rows=1, state_path=state_path).write(trips("T1"))
+    # The next batch landed, but the run stopped before saving the offset
+    client.append("stream-0", trips("T2"), 1)
+
+    LateSubwaysStreamSink(client, max_rows=1, state_path=state_path).write(trips("T3"))
+
+    assert client.rows() == ["T1", "T2", "T3"]
+    assert client.finalized == {"stream-0"}
+
+
+def test_lost_stream_starts_a_new_one():
+    client = FakeWriteStreamClient()
+    sink = LateSubwaysStreamSink(client, max_rows=1)
+
+    sink.write(trips("T1"))
+    client.lost_streams.add("stream-0")
+    sink.write(trips("T2"))
+
+    assert client.streams == {"stream-0": ["T1"], "stream-1": ["T2"]}
+
+
+def test_client_without_finalize_cannot_be_created():
+    class AppendOnlyClient(WriteStreamClient):
+        def create_stream(self) -> str:
+            return "stream-0"
+
+        def append(self, stream_name: str, rows: pa.Table, offset: int) -> None:
+            return None
+
+    with pytest.raises(TypeError, match="finalize"):
+        AppendOnlyClient()
+
+
+def test_append_routes_to_the_stream():
+    client = BigQueryWriteStreamClient(
+        "project",
+        "dataset",
+        "table",
+        [bigquery.SchemaField("trip_id", "STRING", mode="REQUIRED")],
+        credentials=AnonymousCredentials(),
+    )
+    calls = []
+
+    def append_rows(requests, metadata=()):
+        calls.append((list(requests), metadata))
+        return iter([types.AppendRowsResponse()])
+
+    client.client.append_rows = append_rows
+
+    client.append("projects/p/streams/s", pa.table({"trip_id": ["T1"]}), 0)
+
+    [(requests, metadata)] = calls
+    assert requests[0].write_stream == "projects/p/streams/s"
+    assert metadata == (("x-goog-request-params", "write_stream=projects/p/streams/s"),)
@@ -0,0 +1,49 @@
+import hashlib
+from gtfs_feed import fetch_feed, mark_feed_built
+
+
+def test_first_fetch_downloads_the_archive(feed_server, tmp_path):
+    feed = fetch_feed(feed_server.url, tmp_path)
+
+    assert feed.changed
+    assert feed.sha256 == hashlib.sha256(b"feed v1").hexdigest()
+    assert feed.path == tmp_path / f"{feed.sha256}.zip"
+    assert feed.path.read_bytes() == b"feed v1"
+    assert "If-None-Match" not in feed_server.requests[0]
+
+
+def test_unchanged_feed_is_not_downloaded_again(feed_server, tmp_path):
+    first = fetch_feed(feed_server.url, tmp_path)
+    mark_feed_built(tmp_path, first, "20230807")
+
+    feed = fetch_feed(feed_server.url, tmp_path)
+
+    assert feed_server.requests[1]["If-None-Match"] == '"v1"'
+    assert feed_server.requests[1]["If-Modified-Since"] == feed_server.last_modified
+    assert not feed.changed
+    assert feed.path == first.path
+    assert feed.built_for == "20230807"
+
+
+def test_changed_feed_replaces_the_cached_archive(feed_server, tmp_path):
+    first = fetch_feed(feed_server.url, tmp_path)
+    mark_feed_built(tmp_path, first, "20230807")
+
+    feed_server.publish(b"feed v2", '"v2"', "Tue, 08 Aug 2023 10:00:00 GMT")
+    feed = fetch_feed(feed_server.url, tmp_path)
+
+    assert feed.changed
+    assert feed.path.read_bytes() == b"feed v2"
+    assert feed.built_for is None
+    assert not first.path.exists()
+
+
+def test_same_bytes_with_new_headers_are_unchanged(feed_server, tmp_path):
+    first = fetch_feed(feed_server.url, tmp_path)
+
+    feed_server.publish(b"feed v1", '"v1-again"', "Tue, 08 Aug 2023 10:00:00 GMT")
+    feed = fetch_feed(feed_server.url, tmp_path)
+
+    assert not feed.changed
+    assert feed.path == first.path
+    assert feed.etag == '"v1-again"'
@@ -0,0 +1,30 @@
+import pandas as pd
+from late_subway_gold import transform_dataframe
+from benchmarks.bench_gold_transform import (
+    COLUMNS,
+    late_subways_frame,
+    row_wise_transform,
+)
+
+
+def test_matches_the_row_wise_transform():
+    late_subways = late_subways_frame(20_000)
+
+    # Rounding edges of the old formatting
+    late_subways.loc[:3, "timestamp"] = late_subways.loc[
+        :3, "arrival_time_fixed"
+    ] + pd.to_timedelta([14.5, 15.5, 59.6, -0.5], unit="s")
+
+    pd.testing.assert_frame_equal(
+        transform_dataframe.fn(late_subways.copy(), *COLUMNS),
+        row_wise_transform(late_subways.copy(), *COLUMNS),
+    )
+
+
+def test_empty_frame():
+    late_subways = late_subways_frame(10).iloc[:0]
+
+    gold = transform_dataframe.fn(late_subways, *COLUMNS)
+
+    assert list(gold.columns) == list(COLUMNS)
+    assert gold.empty
@@ -0,0 +1,86 @@
+import asyncio
+import httpx
+from google.transit.gtfs_realtime_pb2 import FeedMessage
+from realtime_poller import FeedPoller, poll_feeds
+
+
+def vehicle_positions(timestamp: int) -> bytes:
+    message = FeedMessage()
+    message.header.gtfs_realtime_version = "2.0"
+    message.header.timestamp = timestamp
+
+    entity = message.entity.add()
+    entity.id = "y1"
+    entity.vehicle.trip.route_id = "Red"
+
+    return message.SerializeToString()
+
+
+def fetch_all(url: str, fetches: int, between=None) -> list:
+    """Fetch the feed with one poller, calling between(fetch) before each fetch"""
+
+    async def fetch():
+        async with httpx.AsyncClient() as client:
+            poller = FeedPoller(client, url)
+            contents = []
+            for number in range(fetches):
+                if between is not None:
+                    between(number)
+                contents.append(await poller.fetch())
+            return contents
+
+    return asyncio.run(fetch())
+
+
+def test_unmodified_feed_is_skipped(feed_server):
+    feed_server.publish(vehicle_positions(100), '"a"', "Mon, 07 Aug 2023 10:00:00 GMT")
+
+    first, second = fetch_all(feed_server.url, 2)
+
+    assert first == vehicle_positions(100)
+    assert second is None
+    assert "If-Modified-Since" not in feed_server.requests[0]
+    assert feed_server.requests[1]["If-Modified-Since"] == feed_server.last_modified
+
+
+def test_repeated_header_timestamp_is_skipped(feed_server):
+    snapshots = [
+        (vehicle_positions(100), "Mon, 07 Aug 2023 10:00:00 GMT"),
+        # The same snapshot served again under a new Last-Modified
+        (vehicle_positions(100), "Mon, 07 Aug 2023 10:00:10 GMT"),
+        (vehicle_positions(110), "Mon, 07 Aug 2023 10:00:20 GMT"),
+    ]
+
+    def publish(number):
+        body, last_modified = snapshots[number]
+        feed_server.publish(body, f'"{number}"', last_modified)
+
+    contents = fetch_all(feed_server.url, 3, between=publish)
+
+    assert contents == [vehicle_positions(100), None, vehicle_positions(110)]
+
+
+def test_failing_snapshot_does_not_stop_polling(feed_server):
+    timestamps = iter(range(100, 200, 10))
+    seen = []
+
+    def on_snapshot(feed_name, content):
+        seen.append(feed_name)
+
+        # Every poll serves a new snapshot
+        feed_server.publish(
+            vehicle_positions(next(timestamps)), f'"{len(seen)}"', f"{len(seen)}"
+        )
+        raise ValueError("boom")
+
+    feed_server.publish(vehicle_positions(90), '"0"', "0")
+    asyncio.run(
+        poll_feeds(
+            on_snapshot,
+            interval=0.01,
+            vehicle_positions_url=feed_server.url,
+            max_polls=3,
+        )
+    )
+
+    assert seen == ["vehicle_positions"] * 3
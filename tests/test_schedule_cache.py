@@ -0,0 +1,163 @@
+from pathlib import Path
+from types import SimpleNamespace
+import shutil
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from schedule_cache import GcsScheduleStore, ScheduleCache
+
+
+class FakeGcsStore:
+    """Objects in a local directory with GCS-style generations
+
+    Every upload bumps the object's generation, and a download fails unless it
+    asks for the current one, like if_generation_match.
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.generations = {}
+        self.downloads = []
+
+    def upload(self, path: str, table: pa.Table) -> None:
+        (self.root / path).parent.mkdir(parents=True, exist_ok=True)
+        pq.write_table(table, self.root / path)
+        self.generations[path] = self.generations.get(path, 1000) + 1
+
+    def version(self, path: str):
+        generation = self.generations.get(path)
+        return None if generation is None else str(generation)
+
+    def download(self, path: str, to_path: Path, version: str) -> None:
+        if version != self.version(path):
+            raise RuntimeError(f"Generation {version} of {path} is not current")
+
+        self.downloads.append(path)
+        shutil.copyfile(self.root / path, to_path)
+
+
+def schedule(rows: int, trip: str = "T") -> pa.Table:
+    return pa.table(
+        {
+            "trip_id": [f"{trip}{row}" for row in range(rows)],
+            "arrival_s": list(range(rows)),
+        }
+    )
+
+
+@pytest.fixture
+def store(tmp_path):
+    return FakeGcsStore(tmp_path / "bucket")
+
+
+def cached_files(cache: ScheduleCache) -> set:
+    return {path.name for path in cache.cache_dir.glob("*.feather")}
+
+
+def test_same_generation_is_read_from_the_cache(store, tmp_path):
+    store.upload("today/stop_times.parquet", schedule(100))
+    cache = ScheduleCache(store, tmp_path / "cache")
+
+    first = cache.read("today/stop_times.parquet")
+    second = cache.read("today/stop_times.parquet")
+
+    assert store.downloads == ["today/stop_times.parquet"]
+    assert first.equals(schedule(100))
+    assert second.equals(schedule(100))
+
+
+def test_cache_survives_restarts(store, tmp_path):
+    store.upload("today/stop_times.parquet", schedule(100))
+    ScheduleCache(store, tmp_path / "cache").read("today/stop_times.parquet")
+
+    table = ScheduleCache(store, tmp_path / "cache").read("today/stop_times.parquet")
+
+    assert store.downloads == ["today/stop_times.parquet"]
+    assert table.equals(schedule(100))
+
+
+def test_new_generation_replaces_the_cached_copy(store, tmp_path):
+    store.upload("today/stop_times.parquet", schedule(100))
+    cache = ScheduleCache(store, tmp_path / "cache")
+    cache.read("today/stop_times.parquet")
+    old_files = cached_files(cache)
+
+    store.upload("today/stop_times.parquet", schedule(50, trip="U"))
+    table = cache.read("today/stop_times.parquet")
+
+    assert len(store.downloads) == 2
+    assert table.equals(schedule(50, trip="U"))
+    assert len(cached_files(cache)) == 1
+    assert not cached_files(cache) & old_files
+
+
+def test_missing_object_raises(store, tmp_path):
+    cache = ScheduleCache(store, tmp_path / "cache")
+
+    with pytest.raises(FileNotFoundError):
+        cache.read("today/stop_times.parquet")
+
+
+def test_least_recently_used_copy_is_evicted(store, tmp_path, monkeypatch):
+    for name in "abc":
+        store.upload(f"{name}.parquet", schedule(1000, trip=name))
+
+    # A clock that ticks on every read keeps the use order unambiguous
+    clock = iter(range(1000))
+    monkeypatch.setattr("schedule_cache.time.time", lambda: next(clock))
+
+    cache = ScheduleCache(store, tmp_path / "cache")
+    cache.read("a.parquet")
+    one_copy = cache.entries["a.parquet"]["size"]
+    cache.max_bytes = 2 * one_copy
+
+    cache.read("b.parquet")
+    cache.read("a.parquet")
+    cache.read("c.parquet")
+
+    # b was used least recently, a was read again after it
+    assert set(cache.entries) == {"a.parquet", "c.parquet"}
+    assert len(cached_files(cache)) == 2
+
+    cache.read("b.parquet")
+
+    assert store.downloads == ["a.parquet", "b.parquet", "c.parquet", "b.parquet"]
+    assert set(cache.entries) == {"c.parquet", "b.parquet"}
+
+
+class FakeBucket:
+    """The parts of a google.cloud.storage bucket GcsScheduleStore uses"""
+
+    def __init__(self, store: FakeGcsStore):
+        self.store = store
+
+    def get_blob(self, name):
+        version = self.store.version(name)
+        if version is None:
+            return None
+        return SimpleNamespace(generation=int(version))
+
+    def blob(self, name):
+        def download_to_filename(filename, if_generation_match):
+            self.store.download(name, Path(filename), str(if_generation_match))
+
+        return SimpleNamespace(download_to_filename=download_to_filename)
+
+
+def test_gcs_store_reads_objects_under_the_bucket_folder(store, tmp_path):
+    store.upload("mbta/today/stop_times.parquet", schedule(10))
+    bucket = FakeBucket(store)
+    gcs_block = SimpleNamespace(
+        bucket="subway-mbta-location",
+        bucket_folder="mbta",
+        gcp_credentials=SimpleNamespace(
+            get_cloud_storage_client=lambda: SimpleNamespace(bucket=lambda _: bucket)
+        ),
+    )
+
+    cache = ScheduleCache(GcsScheduleStore(gcs_block), tmp_path / "cache")
+
+    assert cache.read("today/stop_times.parquet").equals(schedule(10))
+    assert store.downloads == ["mbta/today/stop_times.parquet"]
+    with pytest.raises(FileNotFoundError):
+        cache.read("today/stops.parquet")
@@ -0,0 +1,124 @@
+from datetime import date, datetime, timedelta
+import numpy as np
+import pandas as pd
+import pytest
+import subway_locations_schedules
+from subway_locations_schedules import (
+    calculate_subway_lateness,
+    service_day_start,
+    tz,
+)
+
+
+def compare_frame(minutes_late: float) -> pd.DataFrame:
+    """Two vehicles whose stop was scheduled minutes_late minutes ago"""
+
+    now = pd.Timestamp(datetime.now(tz).replace(microsecond=0))
+    service_dates = pd.Series([now.date(), now.date()])
+    arrival_s = int(now.timestamp() - minutes_late * 60) - service_day_start(
+        service_dates
+    )
+
+    return pd.DataFrame(
+        {
+            "trip_id": ["T1", "T2"],
+            "stop_id_x": ["70061", "70063"],
+            "stop_sequence": [5, 7],
+            "service_date": service_dates,
+            "arrival_s": arrival_s,
+            "departure_s": arrival_s + 30,
+            "position_s": np.nan,
+            "timestamp": [now, now],
+        }
+    )
+
+
+def shown_late_by(late_subways: pd.DataFrame) -> np.ndarray:
+    """Minutes late as the gold file derives them"""
+
+    seconds = late_subways["timestamp"] - late_subways["arrival_time_fixed"]
+
+    return seconds.dt.total_seconds().to_numpy() / 60
+
+
+def test_arrival_matches_late_by_at_a_stop():
+    late_subways = calculate_subway_lateness.fn(compare_frame(minutes_late=10))
+
+    np.testing.assert_allclose(late_subways["late_by"], [10, 10])
+    np.testing.assert_allclose(shown_late_by(late_subways), late_subways["late_by"])
+
+
+def test_arrival_matches_late_by_at_a_position():
+    compare = compare_frame(minutes_late=10)
+
+    # The first vehicle is where the schedule had it 40.25 s before the stop
+    compare.loc[0, "position_s"] = compare.loc[0, "arrival_s"] - 40.25
+
+    late_subways = calculate_subway_lateness.fn(compare)
+
+    np.testing.assert_allclose(late_subways["late_by"], [640 / 60, 10])
+    np.testing.assert_allclose(shown_late_by(late_subways), late_subways["late_by"])
+
+
+def test_arrival_matches_predicted_delay():
+    compare = compare_frame(minutes_late=10)
+    predicted_delays = pd.DataFrame(
+        {"trip_id": ["T2"], "stop_id": ["70063"], "predicted_delay": [245.0]}
+    )
+
+    late_subways = calculate_subway_lateness.fn(compare, predicted_delays)
+
+    np.testing.assert_allclose(late_subways["late_by"], [10, 245 / 60])
+    np.testing.assert_allclose(shown_late_by(late_subways), late_subways["late_by"])
+
+
+@pytest.mark.parametrize(
+    "service_date, day_start",
+    [
+        # Clocks spring forward at 02:00, so the GTFS day starts at 23:00 before
+        (date(2023, 3, 12), "2023-03-11 23:00-05:00"),
+        # Clocks fall back at 02:00, so the GTFS day starts at the first 01:00
+        (date(2023, 11, 5), "2023-11-05 01:00-04:00"),
+        (date(2023, 8, 7), "2023-08-07 00:00-04:00"),
+    ],
+)
+def test_service_day_starts_at_noon_minus_12_hours(service_date, day_start):
+    [start] = service_day_start(pd.Series([service_date]))
+
+    assert start == datetime.fromisoformat(day_start).timestamp()
+
+
+@pytest.mark.parametrize(
+    "service_date, arrival_s, arrival_time_fixed",
+    [
+        (date(2023, 3, 12), 8 * 3600, "2023-03-12 08:00"),
+        (date(2023, 11, 5), 8 * 3600, "2023-11-05 08:00"),
+        # 25:30:00 on the service day is 01:30 the next calendar day
+        (date(2023, 8, 6), 25 * 3600 + 1800, "2023-08-07 01:30"),
+    ],
+)
+def test_arrival_is_on_the_local_clock(
+    monkeypatch, service_date, arrival_s, arrival_time_fixed
+):
+    arrival = tz.localize(datetime.fromisoformat(arrival_time_fixed))
+    timestamp = pd.Timestamp(arrival + timedelta(minutes=10))
+
+    class FixedDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return timestamp.to_pydatetime().astimezone(tz)
+
+    monkeypatch.setattr(subway_locations_schedules, "datetime", FixedDatetime)
+
+    compare = compare_frame(minutes_late=0).iloc[:1]
+    compare = compare.assign(
+        service_date=[service_date],
+        arrival_s=arrival_s,
+        departure_s=arrival_s + 30,
+        timestamp=[timestamp],
+    )
+
+    late_subways = calculate_subway_lateness.fn(compare)
+
+    np.testing.assert_allclose(late_subways["late_by"], [10])
+    assert late_subways["arrival_time_fixed"].tolist() == [pd.Timestamp(arrival)]
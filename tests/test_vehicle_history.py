@@ -0,0 +1,47 @@
+from datetime import datetime
+import pandas as pd
+import pytz
+from vehicle_history import VehicleHistory
+
+tz = pytz.timezone("US/Eastern")
+
+
+def snapshot(times) -> pd.DataFrame:
+    timestamps = pd.to_datetime(times).tz_localize(tz)
+
+    return pd.DataFrame(
+        {
+            "vehicle": [f"v{number}" for number in range(len(times))],
+            "live_route_id": "Red",
+            "live_start_date": timestamps.tz_localize(None).normalize(),
+            "timestamp": timestamps,
+        }
+    )
+
+
+def test_scan_localizes_naive_times(tmp_path):
+    history = VehicleHistory(str(tmp_path))
+    history.append(
+        snapshot(["2023-08-07 07:59:00", "2023-08-07 08:00:00", "2023-08-07 09:00:00"])
+    )
+
+    naive = history.scan(datetime(2023, 8, 7, 8), datetime(2023, 8, 7, 9))
+    aware = history.scan(
+        tz.localize(datetime(2023, 8, 7, 8)), tz.localize(datetime(2023, 8, 7, 9))
+    )
+
+    assert naive.column("vehicle").to_pylist() == ["v1"]
+    assert aware.column("vehicle").to_pylist() == ["v1"]
+
+
+def test_scan_converts_aware_times(tmp_path):
+    history = VehicleHistory(str(tmp_path))
+    history.append(snapshot(["2023-08-07 08:00:00"]))
+
+    # 12:00 UTC is 08:00 US/Eastern
+    table = history.scan(
+        pd.Timestamp("2023-08-07 12:00", tz="UTC"),
+        pd.Timestamp("2023-08-07 12:01", tz="UTC"),
+    )
+
+    assert table.column("vehicle").to_pylist() == ["v0"]
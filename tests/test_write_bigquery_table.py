@@ -0,0 +1,114 @@
+from datetime import date, time
+import numpy as np
+import pandas as pd
+import pytest
+from write_bigquery_table import (
+    LATE_SUBWAYS_SCHEMA,
+    RAW_TABLE,
+    STAGING_TABLE,
+    late_subways_table,
+    merge_late_subways_sql,
+)
+
+# A value of each BigQuery type as calculate_subway_lateness returns it
+VALUES = {
+    "STRING": "1",
+    "INT64": 30000,
+    "FLOAT64": 42.35,
+    "DATE": pd.Timestamp("2023-08-07"),
+    "TIME": "08:20:00",
+    "TIMESTAMP": pd.Timestamp("2023-08-07 08:30:00", tz="US/Eastern"),
+}
+
+
+def late_subways_frame(rows: int = 2, **columns) -> pd.DataFrame:
+    """Late subways laid out as calculate_subway_lateness returns them"""
+
+    frame = pd.DataFrame(
+        {field.name: [VALUES[field.field_type]] * rows for field in LATE_SUBWAYS_SCHEMA}
+    ).rename(columns={"stop_id": "stop_id_x", "live_stop_id": "stop_id_y"})
+    frame["service_date"] = date(2023, 8, 7)
+    frame["late_by"] = 10.0
+
+    return frame.assign(**columns)
+
+
+def test_missing_live_start_date_is_the_service_date():
+    late_subways = late_subways_frame(
+        live_start_date=[pd.Timestamp("2023-08-06"), pd.NaT],
+        service_date=[date(2023, 8, 6), date(2023, 8, 7)],
+    )
+
+    table = late_subways_table(late_subways)
+
+    assert table["live_start_date"].to_pylist() == [date(2023, 8, 6), date(2023, 8, 7)]
+
+
+def test_missing_start_time_is_null():
+    late_subways = late_subways_frame(start_time=["", "08:20:00"])
+
+    table = late_subways_table(late_subways)
+
+    assert table["start_time"].to_pylist() == [None, time(8, 20)]
+
+
+def test_missing_required_value_raises():
+    late_subways = late_subways_frame(late_by=[10.0, np.nan])
+
+    with pytest.raises(ValueError, match="late_by is required"):
+        late_subways_table(late_subways)
+
+
+def test_table_is_laid_out_like_the_schema():
+    table = late_subways_table(late_subways_frame())
+
+    assert table.column_names == [field.name for field in LATE_SUBWAYS_SCHEMA]
+    assert table["stop_id"].to_pylist() == ["1", "1"]
+    assert table["arrival_time_fixed"].type.tz == "UTC"
+
+
+def test_merge_keeps_the_latest_observation_once():
+    duckdb = pytest.importorskip("duckdb")
+    observed = pd.to_datetime(
+        ["2023-08-07 08:30", "2023-08-07 08:31", "2023-08-07 08:30"]
+    ).tz_localize("US/Eastern")
+    staged = late_subways_table(
+        late_subways_frame(3, vehicle=["1", "1", None], timestamp=observed)
+    ).to_pandas()
+
+    connection = duckdb.connect()
+    connection.register("staged", staged)
+    connection.execute(f"CREATE TABLE {STAGING_TABLE} AS SELECT * FROM staged")
+    connection.execute(f"CREATE TABLE {RAW_TABLE} AS SELECT * FROM staged LIMIT 0")
+
+    def merge() -> int:
+        [(rows,)] = connection.execute(
+            merge_late_subways_sql(date(2023, 8, 7))
+        ).fetchall()
+        return rows
+
+    def merged() -> list:
+        return connection.execute(
+            f"SELECT vehicle, timestamp FROM {RAW_TABLE} ORDER BY vehicle NULLS FIRST"
+        ).fetchall()
+
+    # Both observations of vehicle 1 share a key, the missing vehicle has its own
+    assert merge() == 2
+    assert [(vehicle, time.minute) for vehicle, time in merged()] == [
+        (None, 30),
+        ("1", 31),
+    ]
+
+    # Merging the same rows again changes nothing
+    assert merge() == 0
+
+    # A later observation of the missing vehicle updates its row
+    connection.execute(
+        f"UPDATE {STAGING_TABLE} SET timestamp = timestamp + INTERVAL 5 MINUTE "
+        "WHERE vehicle IS NULL"
+    )
+    assert merge() == 1
+    assert [(vehicle, time.minute) for vehicle, time in merged()] == [
+        (None, 35),
+        ("1", 31),
+    ]
@@ -0,0 +1,176 @@
+from datetime import datetime, timedelta
+from typing import Collection, Optional
+import uuid
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+import pytz
+from prefect import flow, task
+from storage_format import read_table
+
+# Hive-style partition keys, service_date is YYYYMMDD
+PARTITIONING = ds.partitioning(
+    pa.schema([("service_date", pa.string()), ("route_id", pa.string())]),
+    flavor="hive",
+)
+
+
+class VehicleHistory:
+    """Append-only store of vehicle position snapshots
+
+    Snapshots are written as parquet files under
+    <root>/service_date=YYYYMMDD/route_id=<route>/. root is a local directory or
+    a URI such as gs://bucket/vehicle_history.
+    """
+
+    def __init__(self, root: str):
+        if "://" in root:
+            self.filesystem, self.root = pafs.FileSystem.from_uri(root)
+        else:
+            self.filesystem, self.root = pafs.LocalFileSystem(), root
+
+    def append(self, live_locations: pd.DataFrame) -> None:
+        """Write one snapshot as new files, never touching existing ones"""
+
+        if live_locations.empty:
+            return None
+
+        # Trips belong to the service day they started on, which can differ
+        # from the calendar date of the timestamp after midnight
+        service_date = live_locations["live_start_date"].fillna(
+            live_locations["timestamp"].dt.tz_localize(None).dt.normalize()
+        )
+
+        snapshot = live_locations.assign(
+            service_date=service_date.dt.strftime("%Y%m%d"),
+            route_id=live_locations["live_route_id"],
+        )
+
+        pq.write_to_dataset(
+            pa.Table.from_pandas(snapshot, preserve_index=False),
+            self.root,
+            partitioning=PARTITIONING,
+            filesystem=self.filesystem,
+            basename_template=f"part-{uuid.uuid4().hex}-{{i}}.parquet",
+            existing_data_behavior="overwrite_or_ignore",
+        )
+
+        return None
+
+    def compact(self, service_date: str, row_group_size: int = 128 * 1024) -> None:
+        """Rewrite the small snapshot files of one service day as one file per route
+
+        Rows are sorted by timestamp so each row group covers a narrow time range.
+        """
+
+        partition_dir = f"{self.root}/service_date={service_date}"
+
+        selector = pafs.FileSelector(partition_dir, allow_not_found=True)
+        for route_dir in self.filesystem.get_file_info(selector):
+            if route_dir.type != pafs.FileType.Directory:
+                continue
+
+            files = [
+                info.path
+                for info in self.filesystem.get_file_info(
+                    pafs.FileSelector(route_dir.path)
+                )
+                if info.type == pafs.FileType.File
+            ]
+            if len(files) < 2:
+                continue
+
+            table = ds.dataset(
+                files, format="parquet", filesystem=self.filesystem
+            ).to_table()
+            table = table.sort_by("timestamp")
+
+            # Write the compacted file before removing the snapshots it replaces
+            compacted_path = f"{route_dir.path}/compacted-{uuid.uuid4().hex}.parquet"
+            pq.write_table(
+                table,
+                compacted_path,
+                filesystem=self.filesystem,
+                row_group_size=row_group_size,
+            )
+
+            for path in files:
+                self.filesystem.delete_file(path)
+
+        return None
+
+    def scan(
+        self,
+        start: datetime,
+        end: datetime,
+        route_ids: Optional[Collection[str]] = None,
+        columns: Optional[list] = None,
+    ) -> pa.Table:
+        """Read the vehicle positions with start <= timestamp < end
+
+        Partitions are pruned on service_date and route_id, and the timestamp
+        filter is pushed down to the parquet row group statistics. Naive start
+        and end times are taken as US/Eastern.
+        """
+
+        tz = pytz.timezone("US/Eastern")
+        start, end = (
+            pd.Timestamp(time).tz_localize(tz)
+            if pd.Timestamp(time).tzinfo is None
+            else pd.Timestamp(time).tz_convert(tz)
+            for time in (start, end)
+        )
+
+        # A trip can be reported up to a day after its service date
+        service_dates = pd.date_range(
+            (start - timedelta(days=1)).date(), end.date()
+        ).strftime("%Y%m%d")
+
+        dataset = ds.dataset(
+            self.root,
+            format="parquet",
+            partitioning=PARTITIONING,
+            filesystem=self.filesystem,
+        )
+
+        timestamp_type = dataset.schema.field("timestamp").type
+
+        expression = (
+            pc.field("service_date").isin(list(service_dates))
+            & (pc.field("timestamp") >= pa.scalar(start, type=timestamp_type))
+            & (pc.field("timestamp") < pa.scalar(end, type=timestamp_type))
+        )
+        if route_ids is not None:
+            expression = expression & pc.field("route_id").isin(list(route_ids))
+
+        return dataset.to_table(columns=columns, filter=expression)
+
+
+@task
+def append_live_locations_history(live_locations_path: str, history_root: str) -> None:
+    """Append the latest vehicle positions to the history store"""
+
+    VehicleHistory(history_root).append(read_table(live_locations_path).to_pandas())
+
+    return None
+
+
+@flow
+def compact_vehicle_history(
+    history_root: str = "gs://subway-mbta-location/vehicle_history",
+    service_date: Optional[str] = None,
+):
+    """Compact the snapshot files of a finished service day (yesterday by default)"""
+
+    if service_date is None:
+        yesterday = datetime.now(pytz.timezone("US/Eastern")) - timedelta(days=1)
+        service_date = yesterday.strftime("%Y%m%d")
+
+    VehicleHistory(history_root).compact(service_date)
+
+
+if __name__ == "__main__":
+    compact_vehicle_history()
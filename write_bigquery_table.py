@@ -1,10 +1,217 @@
 from prefect import flow, task
 from prefect_gcp import GcpCredentials
 from prefect_gcp.bigquery import bigquery_load_file
-from google.cloud.bigquery import SchemaField
+from google.cloud.bigquery import QueryJobConfig, SchemaField
+from datetime import date, datetime, timedelta
 from pathlib import Path
 from prefect_gcp.cloud_storage import GcsBucket
 import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytz
+from bigquery_stream import BigQueryWriteStreamClient, LateSubwaysStreamSink
+
+DATASET = "subway_mbta"
+
+# Late subways are appended to the staging table and merged into the raw table
+RAW_TABLE = "raw_subway_mbta"
+STAGING_TABLE = "raw_subway_mbta_staging"
+
+# One row of the raw table per train at a stop on a service day
+MERGE_KEY = ("trip_id", "stop_id", "vehicle", "service_date")
+
+# The raw table is partitioned by service day and clustered for the dashboard
+PARTITION_FIELD = "service_date"
+CLUSTERING_FIELDS = ["route_id", "stop_id"]
+
+# Columns of late_subways.parquet, BigQuery loads them by name
+LATE_SUBWAYS_SCHEMA = [
+    SchemaField("route_id", field_type="STRING", mode="REQUIRED"),
+    SchemaField("service_id", field_type="STRING", mode="REQUIRED"),
+    SchemaField("trip_id", field_type="STRING", mode="REQUIRED"),
+    SchemaField("trip_headsign", field_type="STRING", mode="REQUIRED"),
+    SchemaField("direction_id", field_type="STRING", mode="REQUIRED"),
+    SchemaField("wheelchair_accessible", field_type="STRING", mode="NULLABLE"),
+    SchemaField("route_pattern_id", field_type="STRING", mode="NULLABLE"),
+    SchemaField("bikes_allowed", field_type="STRING", mode="NULLABLE"),
+    SchemaField("agency_id", field_type="STRING", mode="REQUIRED"),
+    SchemaField("route_short_name", field_type="STRING", mode="NULLABLE"),
+    SchemaField("route_long_name", field_type="STRING", mode="NULLABLE"),
+    SchemaField("route_desc", field_type="STRING", mode="NULLABLE"),
+    SchemaField("route_type", field_type="STRING", mode="NULLABLE"),
+    SchemaField("route_url", field_type="STRING", mode="NULLABLE"),
+    SchemaField("route_fare_class", field_type="STRING", mode="NULLABLE"),
+    SchemaField("line_id", field_type="STRING", mode="NULLABLE"),
+    SchemaField("network_id", field_type="STRING", mode="NULLABLE"),
+    SchemaField("monday", field_type="STRING", mode="NULLABLE"),
+    SchemaField("tuesday", field_type="STRING", mode="NULLABLE"),
+    SchemaField("wednesday", field_type="STRING", mode="NULLABLE"),
+    SchemaField("thursday", field_type="STRING", mode="NULLABLE"),
+    SchemaField("friday", field_type="STRING", mode="NULLABLE"),
+    SchemaField("saturday", field_type="STRING", mode="NULLABLE"),
+    SchemaField("sunday", field_type="STRING", mode="NULLABLE"),
+    SchemaField("start_date", field_type="DATE", mode="REQUIRED"),
+    SchemaField("end_date", field_type="DATE", mode="REQUIRED"),
+    SchemaField("arrival_time", field_type="TIME", mode="REQUIRED"),
+    SchemaField("departure_time", field_type="TIME", mode="REQUIRED"),
+    SchemaField("stop_id", field_type="STRING", mode="REQUIRED"),
+    SchemaField("stop_sequence", field_type="STRING", mode="NULLABLE"),
+    SchemaField("stop_name", field_type="STRING", mode="NULLABLE"),
+    SchemaField("stop_desc", field_type="STRING", mode="NULLABLE"),
+    SchemaField("stop_lat", field_type="FLOAT64", mode="REQUIRED"),
+    SchemaField("stop_lon", field_type="FLOAT64", mode="REQUIRED"),
+    SchemaField("zone_id", field_type="STRING", mode="NULLABLE"),
+    SchemaField("arrival_s", field_type="INT64", mode="REQUIRED"),
+    SchemaField("departure_s", field_type="INT64", mode="REQUIRED"),
+    SchemaField("service_date", field_type="DATE", mode="REQUIRED"),
+    SchemaField("id", field_type="STRING", mode="REQUIRED"),
+    # GTFS-realtime vehicles may leave out the trip start time
+    SchemaField("start_time", field_type="TIME", mode="NULLABLE"),
+    SchemaField("live_start_date", field_type="DATE", mode="REQUIRED"),
+    SchemaField("schedule_relationship", field_type="STRING", mode="NULLABLE"),
+    SchemaField("live_route_id", field_type="STRING", mode="REQUIRED"),
+    SchemaField("latitude", field_type="FLOAT64", mode="NULLABLE"),
+    SchemaField("longitude", field_type="FLOAT64", mode="NULLABLE"),
+    SchemaField("bearing", field_type="FLOAT64", mode="NULLABLE"),
+    SchemaField("speed", field_type="FLOAT64", mode="NULLABLE"),
+    SchemaField("current_stop", field_type="STRING", mode="NULLABLE"),
+    SchemaField("current_status", field_type="STRING", mode="NULLABLE"),
+    SchemaField("timestamp", field_type="TIMESTAMP", mode="REQUIRED"),
+    SchemaField("live_stop_id", field_type="STRING", mode="NULLABLE"),
+    SchemaField("vehicle", field_type="STRING", mode="NULLABLE"),
+    SchemaField("label", field_type="STRING", mode="NULLABLE"),
+    SchemaField("arrival_time_fixed", field_type="TIMESTAMP", mode="REQUIRED"),
+    SchemaField("departure_time_fixed", field_type="TIMESTAMP", mode="REQUIRED"),
+    SchemaField("late_by", field_type="FLOAT64", mode="REQUIRED"),
+]
+
+# Arrow types that BigQuery reads back as the schema's types
+ARROW_TYPES = {
+    "STRING": pa.string(),
+    "INT64": pa.int64(),
+    "FLOAT64": pa.float64(),
+    "DATE": pa.date32(),
+    "TIME": pa.time64("us"),
+    "TIMESTAMP": pa.timestamp("us", tz="UTC"),
+}
+
+
+def late_subways_table(late_subways: pd.DataFrame) -> pa.Table:
+    """Convert the late subways to a typed Arrow table laid out like the schema"""
+
+    # Both the schedule and the live locations have a stop_id
+    late_subways = late_subways.rename(
+        columns={"stop_id_x": "stop_id", "stop_id_y": "live_stop_id"}
+    )
+
+    # Vehicles that do not report a start date were matched on the service day
+    late_subways = late_subways.assign(
+        live_start_date=late_subways["live_start_date"].fillna(
+            pd.to_datetime(late_subways["service_date"])
+        )
+    )
+
+    arrays = []
+    for field in LATE_SUBWAYS_SCHEMA:
+        column = late_subways[field.name]
+        arrow_type = ARROW_TYPES[field.field_type]
+
+        if field.field_type == "TIME":
+            # GTFS times past 24:00 belong to the next calendar day
+            time_of_day = pd.to_timedelta(column) % pd.Timedelta(days=1)
+            array = pa.array(
+                time_of_day.to_numpy("timedelta64[us]").astype("int64"),
+                type=arrow_type,
+                mask=time_of_day.isna().to_numpy(),
+            )
+        else:
+            if field.field_type == "STRING":
+                column = column.astype("string")
+            elif field.field_type == "DATE":
+                column = pd.to_datetime(column).dt.date
+            elif field.field_type == "TIMESTAMP":
+                column = column.dt.tz_convert("UTC")
+
+            array = pa.array(column, type=arrow_type, from_pandas=True)
+
+        if field.mode == "REQUIRED" and array.null_count:
+            raise ValueError(f"{field.name} is required but has missing values")
+
+        arrays.append(array)
+
+    schema = pa.schema(
+        [
+            pa.field(
+                field.name,
+                ARROW_TYPES[field.field_type],
+                nullable=field.mode != "REQUIRED",
+            )
+            for field in LATE_SUBWAYS_SCHEMA
+        ]
+    )
+
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def merge_late_subways_sql(
+    window_start: date, target: str = RAW_TABLE, staging: str = STAGING_TABLE
+) -> str:
+    """MERGE the staged late subways of recent service days into the raw table
+
+    Only the latest observation of each key is kept, so merging the same rows
+    again changes nothing. Both tables are only read from window_start on, which
+    limits the scan to a few partitions.
+    """
+
+    columns = [field.name for field in LATE_SUBWAYS_SCHEMA]
+    key = ", ".join(MERGE_KEY)
+
+    # The vehicle can be missing, and a missing vehicle still has to match
+    on = " AND ".join(
+        f"target.{name} IS NOT DISTINCT FROM source.{name}" for name in MERGE_KEY
+    )
+    updates = ", ".join(f"{name} = source.{name}" for name in columns)
+
+    return f"""
+MERGE INTO {target} AS target
+USING (
+    SELECT *
+    FROM {staging}
+    WHERE {PARTITION_FIELD} >= DATE '{window_start.isoformat()}'
+    QUALIFY ROW_NUMBER() OVER (
+        PARTITION BY {key} ORDER BY timestamp DESC, late_by DESC
+    ) = 1
+) AS source
+ON target.{PARTITION_FIELD} >= DATE '{window_start.isoformat()}' AND {on}
+WHEN MATCHED AND source.timestamp > target.timestamp THEN
+    UPDATE SET {updates}
+WHEN NOT MATCHED THEN
+    INSERT ({", ".join(columns)})
+    VALUES ({", ".join(f"source.{name}" for name in columns)})
+"""
+
+
+@task(retries=3)
+def merge_late_subways(
+    gcp_credentials: GcpCredentials, gcp_project_id: str, merge_window_days: int = 1
+) -> int:
+    """Merge the staged late subways into the raw table and return the rows changed"""
+
+    # Trains still running after midnight belong to the previous service day
+    today = datetime.now(pytz.timezone("US/Eastern")).date()
+    query = merge_late_subways_sql(today - timedelta(days=merge_window_days))
+
+    client = gcp_credentials.get_bigquery_client(project=gcp_project_id)
+    job = client.query(
+        query,
+        job_config=QueryJobConfig(default_dataset=f"{gcp_project_id}.{DATASET}"),
+    )
+    job.result()
+
+    print(f"Merged {job.num_dml_affected_rows} late subways into {RAW_TABLE}")
+
+    return job.num_dml_affected_rows
 
 
 @task(retries=3)
@@ -18,85 +225,89 @@ def subways_from_gcs(late_subways_filename: str, prefect_gcs_block_name: str) ->
     return Path(gcs_path)
 
 
+def late_subways_stream_sink(
+    gcp_credentials: GcpCredentials, gcp_project_id: str, **options
+) -> LateSubwaysStreamSink:
+    """Sink that streams late subways to the staging table"""
+
+    client = BigQueryWriteStreamClient(
+        project=gcp_project_id,
+        dataset=DATASET,
+        table=STAGING_TABLE,
+        schema=LATE_SUBWAYS_SCHEMA,
+        credentials=gcp_credentials.get_credentials_from_service_account(),
+    )
+
+    return LateSubwaysStreamSink(client, **options)
+
+
+@task(retries=3)
+def stream_subways_to_bigquery(
+    late_subways: pa.Table,
+    gcp_credentials: GcpCredentials,
+    gcp_project_id: str,
+    stream_state_path: str,
+) -> int:
+    """Append late subways to the staging table without running a load job"""
+
+    sink = late_subways_stream_sink(
+        gcp_credentials, gcp_project_id, state_path=stream_state_path
+    )
+    sink.write(late_subways)
+    sink.close()
+
+    return late_subways.num_rows
+
+
 @flow
-def write_subways_to_bigquery():
+def write_subways_to_bigquery(
+    use_storage_write_api: bool = True,
+    stream_state_path: str = "bigquery_stream.json",
+):
+    """Write the late subways to BigQuery
+
+    The rows are staged and then merged into the raw table, so a train that stays
+    late across runs is stored once. Streaming through the Storage Write API does
+    not count against the daily load job quota. Set use_storage_write_api to False
+    to stage them with a load job instead.
+    """
+
     gcp_project_id = "subway-mbta"
     gcp_credentials = GcpCredentials.load("subway-credentials")
 
     prefect_gcs_block_name = "subway-gcs-bucket"
-    late_subways_filename = "late_subways.csv"
+    late_subways_filename = "late_subways.parquet"
 
     late_subways_path = subways_from_gcs(
         late_subways_filename=late_subways_filename,
         prefect_gcs_block_name=prefect_gcs_block_name,
     )
 
-    schema = [
-        SchemaField("route_id", field_type="STRING", mode="REQUIRED"),
-        SchemaField("service_id", field_type="STRING", mode="REQUIRED"),
-        SchemaField("trip_id", field_type="STRING", mode="REQUIRED"),
-        SchemaField("trip_headsign", field_type="STRING", mode="REQUIRED"),
-        SchemaField("direction_id", field_type="STRING", mode="REQUIRED"),
-        SchemaField("wheelchair_accessible", field_type="STRING", mode="NULLABLE"),
-        SchemaField("route_pattern_id", field_type="STRING", mode="NULLABLE"),
-        SchemaField("bikes_allowed", field_type="STRING", mode="NULLABLE"),
-        SchemaField("agency_id", field_type="STRING", mode="REQUIRED"),
-        SchemaField("route_short_name", field_type="STRING", mode="NULLABLE"),
-        SchemaField("route_long_name", field_type="STRING", mode="NULLABLE"),
-        SchemaField("route_desc", field_type="STRING", mode="NULLABLE"),
-        SchemaField("route_type", field_type="STRING", mode="NULLABLE"),
-        SchemaField("route_url", field_type="STRING", mode="NULLABLE"),
-        SchemaField("route_fare_class", field_type="STRING", mode="NULLABLE"),
-        SchemaField("line_id", field_type="STRING", mode="NULLABLE"),
-        SchemaField("network_id", field_type="STRING", mode="NULLABLE"),
-        SchemaField("monday", field_type="STRING", mode="NULLABLE"),
-        SchemaField("tuesday", field_type="STRING", mode="NULLABLE"),
-        SchemaField("wednesday", field_type="STRING", mode="NULLABLE"),
-        SchemaField("thursday", field_type="STRING", mode="NULLABLE"),
-        SchemaField("friday", field_type="STRING", mode="NULLABLE"),
-        SchemaField("saturday", field_type="STRING", mode="NULLABLE"),
-        SchemaField("sunday", field_type="STRING", mode="NULLABLE"),
-        SchemaField("start_date", field_type="DATE", mode="REQUIRED"),
-        SchemaField("end_date", field_type="DATE", mode="REQUIRED"),
-        SchemaField("arrival_time", field_type="TIME", mode="REQUIRED"),
-        SchemaField("departure_time", field_type="TIME", mode="REQUIRED"),
-        SchemaField("stop_id", field_type="STRING", mode="REQUIRED"),
-        SchemaField("stop_sequence", field_type="STRING", mode="NULLABLE"),
-        SchemaField("stop_name", field_type="STRING", mode="NULLABLE"),
-        SchemaField("stop_desc", field_type="STRING", mode="NULLABLE"),
-        SchemaField("stop_lat", field_type="FLOAT64", mode="REQUIRED"),
-        SchemaField("stop_lon", field_type="FLOAT64", mode="REQUIRED"),
-        SchemaField("zone_id", field_type="STRING", mode="NULLABLE"),
-        SchemaField("id", field_type="STRING", mode="REQUIRED"),
-        SchemaField("start_time", field_type="TIME", mode="REQUIRED"),
-        SchemaField("live_start_date", field_type="DATE", mode="REQUIRED"),
-        SchemaField("schedule_relationship", field_type="STRING", mode="NULLABLE"),
-        SchemaField("live_route_id", field_type="STRING", mode="REQUIRED"),
-        SchemaField("latitude", field_type="FLOAT64", mode="NULLABLE"),
-        SchemaField("longitude", field_type="FLOAT64", mode="NULLABLE"),
-        SchemaField("bearing", field_type="FLOAT64", mode="NULLABLE"),
-        SchemaField("speed", field_type="FLOAT64", mode="NULLABLE"),
-        SchemaField("current_stop", field_type="STRING", mode="NULLABLE"),
-        SchemaField("current_status", field_type="STRING", mode="NULLABLE"),
-        SchemaField("timestamp", field_type="STRING", mode="REQUIRED"),
-        SchemaField("live_stop_id", field_type="STRING", mode="NULLABLE"),
-        SchemaField("vehicle", field_type="STRING", mode="NULLABLE"),
-        SchemaField("label", field_type="STRING", mode="NULLABLE"),
-        SchemaField("arrival_time_fixed", field_type="STRING", mode="REQUIRED"),
-        SchemaField("departure_time_fixed", field_type="STRING", mode="REQUIRED"),
-        SchemaField("late_by", field_type="FLOAT64", mode="REQUIRED"),
-    ]
-
-    result = bigquery_load_file(
-        dataset="subway_mbta",
-        table="raw_subway_mbta",
-        path=late_subways_path,
-        schema=schema,
+    if use_storage_write_api:
+        staged = stream_subways_to_bigquery(
+            late_subways=pq.read_table(late_subways_path),
+            gcp_credentials=gcp_credentials,
+            gcp_project_id=gcp_project_id,
+            stream_state_path=stream_state_path,
+        )
+    else:
+        staged = bigquery_load_file(
+            dataset=DATASET,
+            table=STAGING_TABLE,
+            path=late_subways_path,
+            schema=LATE_SUBWAYS_SCHEMA,
+            gcp_credentials=gcp_credentials,
+            project=gcp_project_id,
+            job_config={"source_format": "PARQUET", "autodetect": False},
+        )
+
+    result = merge_late_subways(
+        wait_for=[staged],
         gcp_credentials=gcp_credentials,
-        project=gcp_project_id,
+        gcp_project_id=gcp_project_id,
     )
 
-    os.remove("late_subways.csv")
+    os.remove(late_subways_path)
 
     return result
 